@@ -0,0 +1,618 @@
+import asyncio
+import time
+from replies import (HANDSHAKE, ReplyMatcher, TelloConnectionError, is_state_packet,
+                     parse_sdk_version)
+from telemetry import StateParser
+from video import PacketAssembler, decode_frames
+
+
+class _FutureWaiter:
+    """A command waiting for its reply on the event loop, the asyncio counterpart of CommandWaiter."""
+
+    def __init__(self, command, loop):
+        self.command = command
+        self.response = None
+        self.sent_at = None
+        self._future = loop.create_future()
+
+    def set_response(self, response):
+        """Deliver the reply and wake up whoever is waiting on it."""
+        self.response = response
+        self.cancel()
+
+    def cancel(self):
+        """Wake up the waiting coroutine without a reply."""
+        if not self._future.done():
+            self._future.set_result(None)
+
+    async def wait(self, timeout=None):
+        """
+        Wait until the reply arrives or the timeout expires.
+
+        :param timeout (float|None): Seconds to wait, None waits forever.
+        :return (bool): True if the waiter was resolved before the timeout.
+        """
+        done, _ = await asyncio.wait({self._future}, timeout=timeout)
+        return bool(done)
+
+    @property
+    def done(self):
+        return self._future.done()
+
+
+class _CommandProtocol(asyncio.DatagramProtocol):
+    """Datagram endpoint for commands, handing replies to the client's ReplyMatcher."""
+
+    def __init__(self, client):
+        self.client = client
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.client.response = data
+        if is_state_packet(data):
+            return
+        self.client._replies.dispatch(data)
+
+    def error_received(self, exc):
+        print(("Caught exception socket.error : %s" % exc))
+
+    def connection_lost(self, exc):
+        self.client._replies.cancel_all()
+
+
+class _StateProtocol(asyncio.DatagramProtocol):
+    """Datagram endpoint for the state broadcast on UDP 8890."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def datagram_received(self, data, addr):
+        self.client._publish_state(data)
+
+
+class _VideoProtocol(asyncio.DatagramProtocol):
+    """Datagram endpoint for the raw h264 stream on UDP 11111."""
+
+    def __init__(self, client):
+        self.client = client
+        self.assembler = PacketAssembler(end_packet_size=1460)
+
+    def datagram_received(self, data, addr):
+        access_unit = self.assembler.feed(data)
+        while access_unit is not None:
+            # taken without a copy, the decode loop recycles it
+            self.client._queue_access_unit(self.assembler.take(), self.assembler.keyframe)
+            access_unit = self.assembler.feed(None) if self.assembler.pending else None
+
+
+class AsyncTello:
+    """asyncio counterpart of tello.Tello.
+
+    Commands are coroutines, while the state broadcast and the video stream are
+    exposed as async iterators. Command, state and video sockets are asyncio
+    datagram endpoints, so any number of drones can share one event loop. The only
+    work that leaves the loop is h264 decoding, which runs in the default executor.
+    """
+
+    def __init__(self, local_ip, local_port, command_timeout=.3, tello_ip='192.168.10.1',
+                 tello_port=8889, state_port=8890, video_port=11111):
+        """
+        :param local_ip (str): Local IP address to bind.
+        :param local_port (int): Local port to bind for commands.
+        :param command_timeout (int|float): Number of seconds to wait for a response to a command.
+        :param tello_ip (str): Tello IP.
+        :param tello_port (int): Tello port.
+        :param state_port (int|None): Local port of the state broadcast, None to ignore it.
+        :param video_port (int|None): Local port of the video stream, None to ignore it.
+        """
+
+        self.command_timeout = command_timeout
+        self.response = None  # last datagram received on the command socket
+        self.state = None  # STATE_DTYPE record of the last state broadcast
+        self.malformed = 0  # state packets that were not a state string
+        self.frame = None  # numpy array RGB -- current camera output frame
+        self.local_ip = local_ip
+        self.local_port = local_port
+        self.tello_address = (tello_ip, tello_port)
+        self.local_state_port = state_port
+        self.local_video_port = video_port
+        self.last_height = 0
+        self.sdk = 0.0
+
+        self.decoder = None
+        self._replies = ReplyMatcher()  # commands waiting for a reply
+        self._state_parser = StateParser(1)  # every state is published as a copy of its record
+        self._command = None
+        self._transports = []
+        self._state_queues = []
+        self._frame_queues = []
+        self._access_units = None
+        self._assembler = None  # PacketAssembler of the video endpoint, access units go back to it
+        self._skipping = False  # dropping access units until the next keyframe
+        self._decode_task = None
+
+    async def connect(self, streamon=True, timeout=10.0):
+        """
+        Open the datagram endpoints and put the Tello into command mode.
+
+        The handshake is the one of Tello.connect(): every step is retransmitted with
+        exponential backoff until it is acknowledged.
+
+        :param streamon (bool): Turn the video stream on once connected.
+        :param timeout (int|float): Seconds the whole handshake may take.
+        :raises TelloConnectionError: If a step is not acknowledged before the deadline.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + timeout
+        try:
+            transport, self._command = await loop.create_datagram_endpoint(
+                lambda: _CommandProtocol(self), local_addr=(self.local_ip, self.local_port))
+            self._transports.append(transport)
+
+            if self.local_state_port is not None:
+                transport, _ = await loop.create_datagram_endpoint(
+                    lambda: _StateProtocol(self), local_addr=(self.local_ip, self.local_state_port))
+                self._transports.append(transport)
+
+            if self.local_video_port is not None:
+                # imported here, so commands work without the extension
+                import libh264decoder
+
+                # access units are split before decoding, the parser need not wait for the next one
+                self.decoder = libh264decoder.H264Decoder(complete_frames=True)
+                self._access_units = asyncio.Queue(maxsize=4)
+                self._skipping = False
+                self._decode_task = loop.create_task(self._decode_loop())
+                transport, protocol = await loop.create_datagram_endpoint(
+                    lambda: _VideoProtocol(self), local_addr=("0.0.0.0", self.local_video_port))
+                self._assembler = protocol.assembler
+                self._transports.append(transport)
+
+            for command, require_ok in HANDSHAKE:
+                response = await self._handshake(command, deadline, require_ok)
+                if command == 'sdk?':
+                    self.sdk = parse_sdk_version(response)
+                    print("[INFO] Tello SDK version: {}".format(self.sdk))
+        except BaseException as exc:
+            if isinstance(exc, TelloConnectionError):
+                print("[INFO] {}".format(exc))
+            # close the endpoints opened so far, there is nothing to land
+            self._command = None
+            await self.disconnect()
+            raise
+
+        if streamon and self.local_video_port is not None:
+            await self.send_command('streamon')
+
+    async def _handshake(self, command, deadline, require_ok=True, backoff=0.1, max_backoff=1.0):
+        """
+        Send a handshake command until it is answered or the deadline passes.
+
+        Same retries as Tello._handshake(): the first reply to any copy completes
+        the step and the replies to the other copies are dropped.
+
+        :param command (str): Command to send.
+        :param deadline (float): time.monotonic() value after which to give up.
+        :param require_ok (bool): Only accept 'ok' as the answer.
+        :param backoff (float): Seconds to wait for the first answer, doubled after every retry.
+        :param max_backoff (float): Longest wait for a single attempt.
+        :return (str): Response from Tello.
+        :raises TelloConnectionError: If no acceptable answer arrives in time.
+        """
+        response = 'timeout'
+        while True:
+            waiter = await self._transmit(command)
+            print('sent: {}'.format(command))
+            copies = 1
+            while not await waiter.wait(max(0.0, min(backoff, deadline - time.monotonic()))):
+                if time.monotonic() >= deadline:
+                    self._replies.expire(waiter, max_backoff)
+                    self._replies.expect_late(command, copies - 1, max_backoff)
+                    raise TelloConnectionError(command, response)
+                self._send_only(command)
+                print('resent: {}'.format(command))
+                copies += 1
+                backoff = min(backoff * 2, max_backoff)
+
+            # one copy was answered, drop the replies to the others
+            self._replies.expect_late(command, copies - 1, max_backoff)
+            if waiter.response is None:
+                raise TelloConnectionError(command, response)
+
+            response = waiter.response.decode('latin-1').strip()
+            if not require_ok or response == 'ok':
+                return response
+
+            # refused, e.g. 'error' while the Tello is busy -- ask again
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TelloConnectionError(command, response)
+            await asyncio.sleep(min(backoff, remaining))
+            backoff = min(backoff * 2, max_backoff)
+
+    async def disconnect(self):
+        """Land, then close every endpoint and stop decoding."""
+        if self._command is not None:
+            await self.land()
+
+        if self._decode_task is not None:
+            self._decode_task.cancel()
+            self._decode_task = None
+
+        for transport in self._transports:
+            transport.close()
+        self._transports = []
+        self._command = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.disconnect()
+
+    def read(self):
+        """Return the last frame from camera."""
+        return self.frame
+
+    async def frames(self, maxsize=1):
+        """
+        Iterate over decoded frames as they arrive.
+
+        When the consumer is slower than the stream the oldest queued frames are
+        dropped, so a slow consumer always sees recent frames.
+
+        :param maxsize (int): Number of frames buffered for this consumer.
+        """
+        queue = asyncio.Queue(maxsize=maxsize)
+        self._frame_queues.append(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self._frame_queues.remove(queue)
+
+    async def states(self, maxsize=16):
+        """
+        Iterate over parsed state broadcasts as they arrive, as STATE_DTYPE records
+        like Tello.get_state() returns.
+
+        :param maxsize (int): Number of states buffered for this consumer.
+        """
+        queue = asyncio.Queue(maxsize=maxsize)
+        self._state_queues.append(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self._state_queues.remove(queue)
+
+    @staticmethod
+    def _offer(queue, item):
+        """Put item into queue, dropping the oldest entry if it is full."""
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(item)
+
+    def _publish_state(self, data):
+        try:
+            state = self._state_parser.parse(data, time.time()).copy()
+        except (ValueError, UnicodeDecodeError):
+            self.malformed += 1
+            return
+        self.state = state
+        for queue in self._state_queues:
+            self._offer(queue, state)
+
+    def _queue_access_unit(self, access_unit, keyframe):
+        if self._skipping:
+            if not keyframe:
+                self._assembler.recycle(access_unit)
+                return
+            self._skipping = False
+        if self._access_units.full():
+            # decoding fell behind, queued frames are only useful up to the next keyframe
+            while not self._access_units.empty():
+                self._assembler.recycle(self._access_units.get_nowait())
+            if not keyframe:
+                self._assembler.recycle(access_unit)
+                self._skipping = True
+                return
+        self._access_units.put_nowait(access_unit)
+
+    async def _decode_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            access_unit = await self._access_units.get()
+            frames = await loop.run_in_executor(None, decode_frames, self.decoder, access_unit)
+            self._assembler.recycle(access_unit)
+            for frame in frames:
+                self.frame = frame
+                for queue in self._frame_queues:
+                    self._offer(queue, frame)
+
+    async def send_command(self, command):
+        """
+        Send a command to the Tello and wait for a response.
+
+        Replies are matched like Tello.send_command() does, see ReplyMatcher.
+
+        :param command: Command to send.
+        :return (str): Response from Tello.
+
+        """
+
+        print((">> send cmd: {}".format(command)))
+        waiter = await self._transmit(command)
+        if not await waiter.wait(self.command_timeout):
+            self._replies.expire(waiter, self.command_timeout)
+
+        if waiter.response is None:
+            print('Response to command \"{}\" timed out.'.format(command))
+            return 'timeout'
+
+        print('Response to command \"{}\": {}'.format(command, waiter.response))
+        return waiter.response.decode('latin-1')
+
+    async def _transmit(self, command, poll=0.01):
+        """
+        Register a waiter for the command and send it to the Tello.
+
+        Like Tello._transmit() the command is held while a reply is still owed to a
+        command that timed out, polling every poll seconds so the loop stays free.
+
+        :param command (str): Command to send.
+        :param poll (float): Seconds between checks of the owed replies.
+        :return (_FutureWaiter): Waiter that receives the reply.
+        """
+        while True:
+            owed_until = self._replies.owed_until()
+            if owed_until is None:
+                break
+            await asyncio.sleep(min(poll, max(0.0, owed_until - time.monotonic())))
+        waiter = _FutureWaiter(command, asyncio.get_running_loop())
+        # nothing is owed and nothing awaited since the check, so this never blocks
+        self._replies.register(waiter, hold=False)
+        self._send_only(command)
+        return waiter
+
+    def _send_only(self, command):
+        """Send a command the Tello does not answer, without waiting for anything."""
+        self._command.transport.sendto(command.encode('utf-8'), self.tello_address)
+
+    async def takeoff(self, delay=0):
+        """
+        Initiates take-off.
+
+        Returns:
+            str: Response from Tello, 'OK' or 'FALSE'.
+
+        """
+
+        resp = await self.send_command('takeoff')
+        await asyncio.sleep(delay)
+        return resp
+
+    async def set_speed(self, speed):
+        """
+        Sets speed.
+
+        The method expects speeds from
+        1 to 100 centimeters/second.
+
+        Args:
+            speed (int): Speed.
+
+        Returns:
+            str: Response from Tello, 'OK' or 'FALSE'.
+
+        """
+        return await self.send_command('speed %s' % speed)
+
+    async def rotate_cw(self, degrees, delay=0):
+        """
+        Rotates clockwise.
+
+        Args:
+            degrees (int): Degrees to rotate, 1 to 360.
+
+        Returns:
+            str: Response from Tello, 'OK' or 'FALSE'.
+
+        """
+
+        resp = await self.send_command('cw %s' % degrees)
+        await asyncio.sleep(delay)
+        return resp
+
+    async def rotate_ccw(self, degrees, delay=0):
+        """
+        Rotates counter-clockwise.
+
+        Args:
+            degrees (int): Degrees to rotate, 1 to 360.
+
+        Returns:
+            str: Response from Tello, 'OK' or 'FALSE'.
+
+        """
+
+        resp = await self.send_command('ccw %s' % degrees)
+        await asyncio.sleep(delay)
+        return resp
+
+    async def flip(self, direction, delay=0):
+        """
+        Flips.
+
+        Args:
+            direction (str): Direction to flip, 'l', 'r', 'f', 'b'.
+
+        Returns:
+            str: Response from Tello, 'OK' or 'FALSE'.
+
+        """
+
+        resp = await self.send_command('flip %s' % direction)
+        await asyncio.sleep(delay)
+        return resp
+
+    def get_response(self):
+        """
+        Returns response of tello.
+
+        Returns:
+            int: response of tello.
+
+        """
+        return self.response
+
+    async def get_sdk_version(self):
+        """Returns Tello SDK version.
+
+        Returns:
+            float: Version of SDK.
+
+        """
+        return parse_sdk_version(await self.send_command('sdk?'))
+
+    async def get_height(self):
+        """Returns height(dm) of tello.
+
+        Returns:
+            int: Height(dm) of tello.
+
+        """
+        height = await self.send_command('height?')
+        height = ''.join(filter(str.isdigit, str(height)))
+        try:
+            height = int(height)
+            self.last_height = height
+        except:
+            height = self.last_height
+        return height
+
+    async def get_battery(self):
+        """Returns percent battery life remaining.
+
+        Returns:
+            int: Percent battery life remaining.
+
+        """
+
+        battery = await self.send_command('battery?')
+
+        try:
+            battery = int(battery)
+        except:
+            pass
+
+        return battery
+
+    async def get_flight_time(self):
+        """Returns the number of seconds elapsed during flight.
+
+        Returns:
+            int: Seconds elapsed during flight.
+
+        """
+
+        flight_time = await self.send_command('time?')
+
+        try:
+            flight_time = int(flight_time)
+        except:
+            pass
+
+        return flight_time
+
+    async def get_speed(self):
+        """Returns the current speed.
+
+        Returns:
+            int: Current speed in KPH.
+
+        """
+
+        speed = await self.send_command('speed?')
+
+        try:
+            speed = float(speed)
+            speed = round((speed / 27.7778), 1)
+        except:
+            pass
+
+        return speed
+
+    async def land(self, delay=0):
+        """Initiates landing.
+
+        Returns:
+            str: Response from Tello, 'OK' or 'FALSE'.
+
+        """
+
+        resp = await self.send_command('land')
+        await asyncio.sleep(delay)
+        return resp
+
+    async def move(self, direction, distance, delay=0):
+        """Moves in a direction for a distance.
+
+        The Tello API expects distances from 20 to 500 centimeters.
+
+        Args:
+            direction (str): Direction to move, 'forward', 'back', 'right' or 'left'.
+            distance (int|float): Distance to move.
+
+        Returns:
+            str: Response from Tello, 'OK' or 'FALSE'.
+
+        """
+
+        resp = await self.send_command('%s %s' % (direction, distance))
+        await asyncio.sleep(delay)
+        return resp
+
+    async def move_rc(self, lr, fb, ud, yaw):
+        """Move drone according to 4 input channels
+
+        The Tello does not answer rc commands, so like Tello.move_rc() the command
+        is sent without waiting for anything.
+
+        Args:
+            lr (int): left/right (-100 - 100)
+            fb (int): forward/backward (100 - -100)
+            ud (int): up/down (100 - -100)
+            yaw (int): rotation (-100 - 100)
+
+        """
+
+        self._send_only('rc %d %d %d %d' % (lr, fb, ud, yaw))
+
+    async def move_backward(self, distance, delay=0):
+        """Moves backward for a distance. See AsyncTello.move()."""
+        return await self.move('back', distance, delay)
+
+    async def move_down(self, distance, delay=0):
+        """Moves down for a distance. See AsyncTello.move()."""
+        return await self.move('down', distance, delay)
+
+    async def move_forward(self, distance, delay=0):
+        """Moves forward for a distance. See AsyncTello.move()."""
+        return await self.move('forward', distance, delay)
+
+    async def move_left(self, distance, delay=0):
+        """Moves left for a distance. See AsyncTello.move()."""
+        return await self.move('left', distance, delay)
+
+    async def move_right(self, distance, delay=0):
+        """Moves right for a distance. See AsyncTello.move()."""
+        return await self.move('right', distance, delay)
+
+    async def move_up(self, distance, delay=0):
+        """Moves up for a distance. See AsyncTello.move()."""
+        return await self.move('up', distance, delay)
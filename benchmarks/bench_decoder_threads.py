@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""Decoding frames per second and per-frame latency for each decoder thread setting.
+
+    python3 benchmarks/bench_decoder_threads.py capture1.h264 [capture2.h264 ...]
+
+Each raw H.264 clip, e.g. 720p recorded from a Tello, is split into access units
+and fed to a fresh decoder one access unit at a time, as VideoStream does. Latency
+is the time from feeding an access unit to its frame coming out of the decoder,
+so it includes the frames frame threading holds back. Frames still held when the
+clip ends are reported as pending.
+"""
+
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import libh264decoder
+
+from benchmarks.run import _ms, _percentile
+from simulator import split_access_units
+from video import decode_frames
+
+# (thread_count, thread_type), 0 threads is one per core
+SETTINGS = [(1, 'slice'), (2, 'slice'), (4, 'slice'), (0, 'slice'),
+            (2, 'frame'), (4, 'frame'), (0, 'frame')]
+
+
+def measure(units, thread_count, thread_type):
+    decoder = libh264decoder.H264Decoder(complete_frames=True, thread_count=thread_count,
+                                         thread_type=thread_type)
+    fed = []  # time every access unit was fed whose frame has not come out yet
+    latencies = []
+    t0 = time.perf_counter()
+    for unit in units:
+        fed.append(time.perf_counter())
+        frames = decode_frames(decoder, unit)
+        now = time.perf_counter()
+        for _ in frames:
+            latencies.append(now - fed.pop(0))
+    elapsed = time.perf_counter() - t0
+    return len(latencies) / elapsed, latencies, len(fed)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit(__doc__)
+    libh264decoder.disable_logging()
+    for path in sys.argv[1:]:
+        with open(path, 'rb') as f:
+            units = split_access_units(f.read())
+        print('%s: %d access units' % (path, len(units)))
+        print('%8s %6s %9s %11s %11s %8s' % ('threads', 'type', 'fps', 'median_ms', 'p95_ms', 'pending'))
+        for thread_count, thread_type in SETTINGS:
+            fps, latencies, pending = measure(units, thread_count, thread_type)
+            if not latencies:
+                print('%8s %6s  no frame decoded' % (thread_count or 'auto', thread_type))
+                continue
+            print('%8s %6s %9.1f %11.3f %11.3f %8d'
+                  % (thread_count or 'auto', thread_type, fps, _ms(statistics.median(latencies)),
+                     _ms(_percentile(latencies, .95)), pending))
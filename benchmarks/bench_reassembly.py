@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Packets per second of video reassembly: recvfrom and bytes concatenation, as the
+receive thread used to do, against video.PacketAssembler (recv_into a reused buffer,
+scanning packets that start a NAL unit for start codes).
+
+Each access unit of a Tello shaped stream is sent over loopback before it is
+received, so no datagram is lost and only receiving and assembling is timed. The
+best of ROUNDS passes over the stream is reported, as a single pass is easily
+disturbed by the sender sharing the machine.
+"""
+
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.run import synthetic_stream
+from simulator import VIDEO_PACKET_SIZE, split_access_units
+from video import PacketAssembler
+
+ROUNDS = 10
+
+
+def concatenate(sock, packets_per_unit):
+    packet_data = b''
+    for _ in range(packets_per_unit):
+        res_string, ip = sock.recvfrom(2048)
+        packet_data += res_string
+    return len(packet_data)
+
+
+def make_assembler():
+    assembler = PacketAssembler(end_packet_size=VIDEO_PACKET_SIZE)
+
+    def recv_into(sock, packets_per_unit):
+        for _ in range(packets_per_unit):
+            access_unit = assembler.receive(sock)
+        return len(access_unit)
+    return recv_into
+
+
+def measure(name, receive, units):
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    receiver.bind(('127.0.0.1', 0))
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    address = receiver.getsockname()
+
+    best = None
+    for _ in range(ROUNDS):
+        packets = 0
+        elapsed = 0.0
+        for unit in units:
+            chunks = [unit[i:i + VIDEO_PACKET_SIZE] for i in range(0, len(unit), VIDEO_PACKET_SIZE)]
+            for chunk in chunks:
+                sender.sendto(chunk, address)
+            t0 = time.perf_counter()
+            assert receive(receiver, len(chunks)) == len(unit)
+            elapsed += time.perf_counter() - t0
+            packets += len(chunks)
+        best = elapsed if best is None else min(best, elapsed)
+    receiver.close()
+    sender.close()
+
+    rate = packets / best
+    print('%-12s %12.0f packets/s' % (name, rate))
+    return rate
+
+
+if __name__ == '__main__':
+    units = split_access_units(synthetic_stream())
+    # an access unit that ends on a full packet would merge with the next one
+    units = [unit for unit in units if len(unit) % VIDEO_PACKET_SIZE]
+    baseline = measure('concatenate', concatenate, units)
+    rate = measure('recv_into', make_assembler(), units)
+    print('%-12s %11.1fx' % ('', rate / baseline))
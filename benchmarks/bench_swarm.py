@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""Broadcast round trip and thread count of TelloSwarm against local UDP stand-ins.
+
+All stand-ins are served by a single thread, each answers 'ok' to every command
+and sends a state string every 100 ms from its command socket, like a Tello.
+"""
+
+import os
+import selectors
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from simulator import SAMPLE_STATE
+from swarm import TelloSwarm
+
+ROUNDS = 200
+
+
+class StandIns:
+    """N fake drones on loopback, served by one thread."""
+
+    def __init__(self, n, state_port):
+        self.selector = selectors.DefaultSelector()
+        self.sockets = []
+        for _ in range(n):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(('127.0.0.1', 0))
+            sock.setblocking(False)
+            self.selector.register(sock, selectors.EVENT_READ)
+            self.sockets.append(sock)
+        self.state_address = ('127.0.0.1', state_port)
+        self.running = True
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def ports(self):
+        return [sock.getsockname()[1] for sock in self.sockets]
+
+    def serve(self):
+        next_state = time.monotonic()
+        while self.running:
+            for key, _ in self.selector.select(timeout=0.01):
+                try:
+                    data, address = key.fileobj.recvfrom(2048)
+                except BlockingIOError:
+                    continue
+                key.fileobj.sendto(b'ok', address)
+            if time.monotonic() >= next_state:
+                next_state += 0.1
+                for sock in self.sockets:
+                    sock.sendto(SAMPLE_STATE, self.state_address)
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        for sock in self.sockets:
+            sock.close()
+
+
+def run(n):
+    with TelloSwarm('127.0.0.1', command_port=0, state_port=0, command_timeout=1.0) as swarm:
+        state_port = swarm._sockets['state'].getsockname()[1]
+        stand_ins = StandIns(n, state_port)
+        for port in stand_ins.ports():
+            swarm.add('127.0.0.1', port)
+
+        not_ready = swarm.wait_all_ready(timeout=5.0)
+        assert not not_ready, not_ready
+
+        rtts = []
+        timeouts = 0
+        for _ in range(ROUNDS):
+            t0 = time.perf_counter()
+            replies = swarm.broadcast('battery?')
+            rtts.append(time.perf_counter() - t0)
+            timeouts += sum(r == 'timeout' for r in replies.values())
+
+        threads = threading.active_count()
+        with_state = sum(drone.state is not None for drone in swarm)
+        stand_ins.close()
+
+    rtts.sort()
+    print('%3d drones  broadcast median %6.2f ms  p95 %6.2f ms  timeouts %d  '
+          'threads %d  drones with state %d'
+          % (n, rtts[len(rtts) // 2] * 1e3, rtts[int(len(rtts) * .95)] * 1e3, timeouts,
+             threads, with_state))
+
+
+if __name__ == '__main__':
+    for n in (1, 10, 50):
+        run(n)
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""Rows per second of the telemetry parsers: DataLogger.parse (regex + dict),
+telemetry.StateParser (one record at a time) and telemetry.parse_log (bulk)."""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from logger import DataLogger
+from simulator import SAMPLE_STATE
+from telemetry import StateParser, parse_log
+
+ROWS = 100000
+
+
+def regex_dict():
+    for _ in range(ROWS):
+        DataLogger.parse(SAMPLE_STATE)
+    return ROWS
+
+
+def state_parser():
+    parser = StateParser()
+    for _ in range(ROWS):
+        parser.parse(SAMPLE_STATE, 0.0)
+    return ROWS
+
+
+def bulk():
+    return len(parse_log(SAMPLE_STATE * ROWS))
+
+
+def measure(fun):
+    t0 = time.perf_counter()
+    rows = fun()
+    t1 = time.perf_counter()
+    rate = rows / (t1 - t0)
+    print('%-14s %12.0f rows/s' % (fun.__name__, rate))
+    return rate
+
+
+if __name__ == '__main__':
+    baseline = measure(regex_dict)
+    for fun in (state_parser, bulk):
+        rate = measure(fun)
+        print('%-14s %11.1fx' % ('', rate / baseline))
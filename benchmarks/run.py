@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+"""Benchmarks of the command, telemetry and video hot paths.
+
+Every benchmark runs against the local simulator or synthetic data, so no drone
+is needed. The results are written as JSON to compare commits:
+
+    python3 benchmarks/run.py --video capture.h264 --output before.json
+    python3 benchmarks/run.py --video capture.h264 --output after.json --compare before.json
+
+Metrics ending in _ms are better when lower, metrics ending in _per_s or _fps are
+better when higher; --compare flags those that got worse by more than --threshold.
+A benchmark that catches the code misbehaving, e.g. a reply credited to the wrong
+command, is reported as failed and makes the run exit with an error.
+Benchmarks that need what is missing here (libh264decoder, a clip, a display) are
+reported as skipped.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from simulator import (SAMPLE_STATE, TelloSimulator, VIDEO_PACKET_SIZE, read_video_tag,
+                       split_access_units)
+from telemetry import StateParser, parse_log, parse_state
+
+
+class Skipped(Exception):
+    """Raised by a benchmark that cannot run in this environment."""
+
+
+class Failed(Exception):
+    """Raised by a benchmark whose run showed the code misbehaving."""
+
+
+def _percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+def _ms(seconds):
+    return round(seconds * 1e3, 3)
+
+
+def _free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _import(name):
+    try:
+        return __import__(name)
+    except ImportError as exc:
+        raise Skipped(str(exc))
+
+
+def _clip(args):
+    if args.video is None:
+        raise Skipped('no clip, pass --video')
+    return args.video
+
+
+def synthetic_stream(frames=300, gop=30, idr_size=45000, p_size=6000):
+    """
+    Return an Annex B byte stream shaped like the Tello's: one IDR access unit per gop
+    frames, P access units in between. The payload is not decodable.
+    """
+    def nal(nal_type, size):
+        return b'\x00\x00\x00\x01' + bytes([0x60 | nal_type]) + b'\x5a' * size
+
+    data = b''
+    for n in range(frames):
+        if n % gop == 0:
+            data += nal(7, 10) + nal(8, 4) + nal(5, idr_size)
+        else:
+            data += nal(1, p_size)
+    return data
+
+
+def command_rtt(args):
+    """Round trip of query commands through Tello.send_command and the scheduler."""
+    tello = _import('tello')
+
+    with TelloSimulator(command_port=0, latency=args.latency) as sim, \
+            open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        drone = tello.Tello('127.0.0.1', 0, command_timeout=1.0, tello_ip='127.0.0.1',
+                            tello_port=sim.command_port, command_rate=1e6,
+                            command_burst=args.rounds, state_port=None)
+        drone.connect(timeout=5.0)
+        rtts = []
+        timeouts = 0
+        t0 = time.perf_counter()
+        for _ in range(args.rounds):
+            t1 = time.perf_counter()
+            timeouts += drone.send_command('battery?') == 'timeout'
+            rtts.append(time.perf_counter() - t1)
+        elapsed = time.perf_counter() - t0
+        drone.disconnect()
+
+    return {'rtt_median_ms': _ms(statistics.median(rtts)), 'rtt_p95_ms': _ms(_percentile(rtts, .95)),
+            'rtt_max_ms': _ms(max(rtts)), 'jitter_ms': _ms(statistics.pstdev(rtts)),
+            'commands_per_s': round(args.rounds / elapsed, 1), 'timeouts': timeouts}
+
+
+def command_loss(args):
+    """Replies of query commands while the simulator drops commands, each must answer its own query."""
+    tello = _import('tello')
+
+    expected = {'battery?': '100', 'speed?': '10.0'}
+    # replies take 0.2 to 0.25 s, close to the default command_timeout like on a busy link
+    with TelloSimulator(command_port=0, latency=0.2, jitter=0.05, loss=args.loss, seed=1) as sim, \
+            open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        drone = tello.Tello('127.0.0.1', 0, tello_ip='127.0.0.1', tello_port=sim.command_port,
+                            command_rate=1e6, state_port=None)
+        drone.connect(timeout=10.0)
+        answered = timeouts = 0
+        wrong = []
+        t0 = time.perf_counter()
+        for n in range(args.loss_rounds):
+            command = 'speed?' if n % 2 else 'battery?'
+            response = drone.send_command(command).strip()
+            if response == 'timeout':
+                timeouts += 1
+            elif response == expected[command]:
+                answered += 1
+            else:
+                wrong.append('{} -> {}'.format(command, response))
+        elapsed = time.perf_counter() - t0
+        drone.disconnect()
+
+    if wrong:
+        raise Failed('replies credited to the wrong command: {}'.format(', '.join(wrong)))
+    if not answered:
+        raise Failed('no command was answered')
+    return {'answered': answered, 'timeouts': timeouts, 'lost': sim.lost,
+            'commands_per_s': round(args.loss_rounds / elapsed, 1)}
+
+
+def telemetry_parse(args):
+    """Rows per second of the state parsers."""
+    rows = args.rows
+    results = {}
+
+    t0 = time.perf_counter()
+    for _ in range(rows):
+        parse_state(SAMPLE_STATE, 0.0)
+    results['parse_state_rows_per_s'] = round(rows / (time.perf_counter() - t0))
+
+    parser = StateParser()
+    t0 = time.perf_counter()
+    for _ in range(rows):
+        parser.parse(SAMPLE_STATE, 0.0)
+    results['state_parser_rows_per_s'] = round(rows / (time.perf_counter() - t0))
+
+    capture = SAMPLE_STATE * rows
+    t0 = time.perf_counter()
+    parse_log(capture)
+    results['parse_log_rows_per_s'] = round(rows / (time.perf_counter() - t0))
+    return results
+
+
+def reassembly(args):
+    """Packets per second through video.PacketAssembler on a receive thread, nothing decoded."""
+    video = _import('video')
+    data = synthetic_stream() if args.video is None else open(args.video, 'rb').read()
+    packets = [unit[start:start + VIDEO_PACKET_SIZE]
+               for unit in split_access_units(data)
+               for start in range(0, len(unit), VIDEO_PACKET_SIZE)]
+
+    delivered = []  # (time, packets) per access unit reassembled
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # as VideoStream sets it up
+    receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+    receiver.bind(('127.0.0.1', 0))
+    receiver.settimeout(0.2)
+    running = True
+
+    def receive():
+        assembler = video.PacketAssembler(end_packet_size=VIDEO_PACKET_SIZE)
+        while running:
+            try:
+                access_unit = assembler.receive(receiver)
+            except socket.timeout:
+                continue
+            if access_unit is not None:
+                delivered.append((time.perf_counter(), -(-len(access_unit) // VIDEO_PACKET_SIZE)))
+
+    thread = threading.Thread(target=receive)
+    thread.daemon = True
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        thread.start()
+        address = receiver.getsockname()
+        sent = 0
+        while sent < args.packets:
+            for packet in packets:
+                sender.sendto(packet, address)
+            sent += len(packets)
+        # let the receiver drain its socket buffer
+        while True:
+            seen = len(delivered)
+            time.sleep(0.2)
+            if len(delivered) == seen:
+                break
+    finally:
+        running = False
+        thread.join()
+        receiver.close()
+        sender.close()
+
+    if len(delivered) < 2:
+        raise Skipped('no access unit was reassembled')
+    received = sum(n for _, n in delivered[1:])
+    elapsed = delivered[-1][0] - delivered[0][0]
+    return {'packets_per_s': round(received / elapsed), 'packets_sent': sent,
+            'packets_received': received + delivered[0][1]}
+
+
+def decode(args):
+    """Frames per second of decoding and converting a clip, one access unit at a time."""
+    video = _import('video')
+    libh264decoder = _import('libh264decoder')
+
+    with open(_clip(args), 'rb') as f:
+        units = split_access_units(f.read())
+    decoder = libh264decoder.H264Decoder()
+    frames = 0
+    t0 = time.perf_counter()
+    for unit in units:
+        frames += len(video.decode_frames(decoder, unit))
+    elapsed = time.perf_counter() - t0
+    if not frames:
+        raise Skipped('the clip did not decode')
+    return {'decode_fps': round(frames / elapsed, 1), 'frames': frames,
+            'access_units': len(units)}
+
+
+def frame_latency(args):
+    """Time from the simulator sending an access unit to its frame reaching Tello.wait_frame()."""
+    tello = _import('tello')
+    # tello imports without it, the video stream needs it once subscribed
+    _import('libh264decoder')
+
+    video_port = _free_port()
+    latencies = []
+    seqs = {}  # receive timestamp of an access unit, which its frame carries, to its seq
+    with TelloSimulator(command_port=0, video_port=video_port, video_path=_clip(args),
+                        tag_video=True) as sim, \
+            open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        drone = tello.Tello('127.0.0.1', 0, command_timeout=1.0, tello_ip='127.0.0.1',
+                            tello_port=sim.command_port, state_port=None,
+                            low_latency_video=args.low_latency)
+        drone.video.local_port = video_port
+        drone.connect(timeout=5.0)
+
+        def tag(access_unit, keyframe, timestamp):
+            seqs[timestamp] = read_video_tag(access_unit)
+
+        drone.video.subscribe_access_units(tag)
+        drone.subscribe_video()
+        seq = 0
+        deadline = time.monotonic() + args.seconds
+        while time.monotonic() < deadline:
+            result = drone.wait_frame(seq, timeout=0.5)
+            if result is None:
+                continue
+            frame, seq, timestamp = result
+            now = time.monotonic()
+            sent_at = sim.video_sent_at.get(seqs.pop(timestamp, None))
+            if sent_at is not None:
+                latencies.append(now - sent_at)
+        skipped = drone.video.skipped
+        drone.unsubscribe_video()
+        drone.video.unsubscribe_access_units(tag)
+        drone.disconnect()
+
+    if not latencies:
+        raise Skipped('no frame was decoded')
+    return {'latency_median_ms': _ms(statistics.median(latencies)),
+            'latency_p95_ms': _ms(_percentile(latencies, .95)),
+            'display_fps': round(len(latencies) / args.seconds, 1),
+            'skipped_for_latency': skipped}
+
+
+def gui(args):
+    """Frames per second ManualControlUI's live view can draw, polling its mailbox on the Tk loop."""
+    import numpy as np
+    import tkinter
+    try:
+        from manual_control_ui import VideoDisplay
+        from video import FrameMailbox
+        root = tkinter.Tk()
+    except (ImportError, tkinter.TclError) as exc:
+        raise Skipped(str(exc))
+
+    mailbox = FrameMailbox()
+    display = VideoDisplay(root, root, mailbox, size=(args.display_width, args.display_height))
+    frame = np.tile(np.arange(960, dtype=np.uint8), (720, 1))[:, :, None].repeat(3, axis=2)
+    frames = [np.ascontiguousarray(np.roll(frame, n, axis=1)) for n in range(8)]
+    renders = []
+    try:
+        t0 = time.perf_counter()
+        for n in range(args.frames):
+            mailbox.put(frames[n % len(frames)], time.time())
+            t1 = time.perf_counter()
+            display.poll()
+            root.update()
+            renders.append(time.perf_counter() - t1)
+        elapsed = time.perf_counter() - t0
+    finally:
+        root.destroy()
+    return {'gui_fps': round(args.frames / elapsed, 1),
+            'render_median_ms': _ms(statistics.median(renders)),
+            'render_p95_ms': _ms(_percentile(renders, .95))}
+
+
+BENCHMARKS = [command_rtt, command_loss, telemetry_parse, reassembly, decode, frame_latency, gui]
+
+
+def compare(results, baseline, threshold):
+    """
+    Print the change of every metric against a baseline run.
+
+    :return (list): Names of the metrics that regressed by more than threshold.
+    """
+    regressions = []
+    for name, metrics in results['benchmarks'].items():
+        before = baseline.get('benchmarks', {}).get(name, {})
+        for metric, value in metrics.items():
+            old = before.get(metric)
+            if not isinstance(value, (int, float)) or not isinstance(old, (int, float)) or not old:
+                continue
+            change = (value - old) / old
+            if metric.endswith('_ms'):
+                worse = change > threshold
+            elif metric.endswith(('_per_s', '_fps')):
+                worse = change < -threshold
+            else:
+                worse = False
+            if worse:
+                regressions.append('{}.{}'.format(name, metric))
+            print('%-16s %-26s %12s -> %-12s %+7.1f%%%s'
+                  % (name, metric, old, value, change * 100, '  REGRESSION' if worse else ''))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Tello hot paths.')
+    parser.add_argument('--video', help='raw H.264 clip for the video benchmarks')
+    parser.add_argument('--only', nargs='+', choices=[b.__name__ for b in BENCHMARKS],
+                        help='benchmarks to run, all by default')
+    parser.add_argument('--output', help='file to write the JSON results to')
+    parser.add_argument('--compare', help='JSON results of an earlier run')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative change counted as a regression')
+    parser.add_argument('--rounds', type=int, default=500, help='commands for command_rtt')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated reply latency')
+    parser.add_argument('--loss', type=float, default=0.2, help='share dropped for command_loss')
+    parser.add_argument('--loss-rounds', type=int, default=40, help='commands for command_loss')
+    parser.add_argument('--rows', type=int, default=100000, help='states for telemetry_parse')
+    parser.add_argument('--packets', type=int, default=200000, help='packets for reassembly')
+    parser.add_argument('--seconds', type=float, default=5.0, help='duration of frame_latency')
+    parser.add_argument('--low-latency', action='store_true',
+                        help='run frame_latency with low latency video')
+    parser.add_argument('--frames', type=int, default=300, help='frames for gui')
+    parser.add_argument('--display-width', type=int, default=960, help='live view width for gui')
+    parser.add_argument('--display-height', type=int, default=720, help='live view height for gui')
+    args = parser.parse_args()
+
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    results = {'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'python': platform.python_version(), 'platform': platform.platform(),
+               'benchmarks': {}, 'skipped': {}, 'failed': {}}
+
+    for benchmark in BENCHMARKS:
+        name = benchmark.__name__
+        if args.only and name not in args.only:
+            continue
+        try:
+            metrics = benchmark(args)
+        except Skipped as exc:
+            results['skipped'][name] = str(exc)
+            print('%-16s skipped: %s' % (name, exc))
+            continue
+        except Failed as exc:
+            results['failed'][name] = str(exc)
+            print('%-16s FAILED: %s' % (name, exc))
+            continue
+        results['benchmarks'][name] = metrics
+        print('%-16s %s' % (name, ', '.join('%s %s' % item for item in metrics.items())))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+    if regressions or results['failed']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,18 @@ extern "C" {
 #define PIX_FMT_RGB24 AV_PIX_FMT_RGB24
 #endif
 
+#ifndef PIX_FMT_BGR24
+#define PIX_FMT_BGR24 AV_PIX_FMT_BGR24
+#endif
+
+#ifndef PIX_FMT_GRAY8
+#define PIX_FMT_GRAY8 AV_PIX_FMT_GRAY8
+#endif
+
+#ifndef PIX_FMT_YUV420P
+#define PIX_FMT_YUV420P AV_PIX_FMT_YUV420P
+#endif
+
 #ifndef CODEC_CAP_TRUNCATED
 #define CODEC_CAP_TRUNCATED AV_CODEC_CAP_TRUNCATED
 #endif
@@ -16,8 +28,14 @@ extern "C" {
 #define CODEC_FLAG_TRUNCATED AV_CODEC_FLAG_TRUNCATED
 #endif
 
+#ifndef CODEC_FLAG_LOW_DELAY
+#define CODEC_FLAG_LOW_DELAY AV_CODEC_FLAG_LOW_DELAY
+#endif
+
 
 #include "h264decoder.hpp"
+#include <algorithm>
+#include <tuple>
 #include <utility>
 
 typedef unsigned char ubyte;
@@ -29,8 +47,11 @@ typedef unsigned char ubyte;
 #endif
 
 
-H264Decoder::H264Decoder()
+H264Decoder::H264Decoder(bool complete_frames, int thread_count, ThreadType thread_type, bool low_delay)
 {
+  if (thread_count < 0)
+    throw std::invalid_argument("thread count must not be negative");
+
   avcodec_register_all();
 
   codec = avcodec_find_decoder(AV_CODEC_ID_H264);
@@ -41,9 +62,16 @@ H264Decoder::H264Decoder()
   if (!context)
     throw H264InitFailure("cannot allocate context");
 
-  if(codec->capabilities & CODEC_CAP_TRUNCATED) {
+  context->thread_count = thread_count;
+  context->thread_type = thread_type == ThreadType::FRAME ? FF_THREAD_FRAME : FF_THREAD_SLICE;
+
+  // libav falls back to a single thread for truncated input. The parser hands the
+  // decoder whole frames anyway, so the flag is only kept without frame threading.
+  if(codec->capabilities & CODEC_CAP_TRUNCATED && thread_type != ThreadType::FRAME) {
     context->flags |= CODEC_FLAG_TRUNCATED;
   }  
+  if (low_delay)
+    context->flags |= CODEC_FLAG_LOW_DELAY;
 
   int err = avcodec_open2(context, codec, nullptr);
   if (err < 0)
@@ -52,6 +80,8 @@ H264Decoder::H264Decoder()
   parser = av_parser_init(AV_CODEC_ID_H264);
   if (!parser)
     throw H264InitFailure("cannot init parser");
+  if (complete_frames)
+    parser->flags |= PARSER_FLAG_COMPLETE_FRAMES;
   
   frame = av_frame_alloc();
   if (!frame)
@@ -103,8 +133,39 @@ const AVFrame& H264Decoder::decode_frame()
 }
 
 
-ConverterRGB24::ConverterRGB24()
+namespace {
+
+AVPixelFormat pixel_format(OutputFormat format)
+{
+  switch (format)
+  {
+    case OutputFormat::BGR24:   return PIX_FMT_BGR24;
+    case OutputFormat::GRAY8:   return PIX_FMT_GRAY8;
+    case OutputFormat::YUV420P: return PIX_FMT_YUV420P;
+    default:                    return PIX_FMT_RGB24;
+  }
+}
+
+int sws_flags(Scaler scaler)
+{
+  switch (scaler)
+  {
+    case Scaler::FAST_BILINEAR: return SWS_FAST_BILINEAR;
+    case Scaler::BICUBIC:       return SWS_BICUBIC;
+    case Scaler::AREA:          return SWS_AREA;
+    case Scaler::POINT:         return SWS_POINT;
+    default:                    return SWS_BILINEAR;
+  }
+}
+
+}
+
+
+ConverterRGB24::ConverterRGB24(OutputFormat format_, int width_, int height_, Scaler scaler_)
+  : format(format_), width(width_), height(height_), scaler(scaler_)
 {
+  if (width < 0 || height < 0)
+    throw std::invalid_argument("output size must not be negative");
   framergb = av_frame_alloc();
   if (!framergb)
     throw H264DecodeFailure("cannot allocate frame");
@@ -118,26 +179,40 @@ ConverterRGB24::~ConverterRGB24()
 }
 
 
+std::pair<int, int> ConverterRGB24::output_size(int w, int h) const
+{
+  if (width == 0 && height == 0)
+    return std::make_pair(w, h);
+  if (width == 0)
+    return std::make_pair(std::max(1, w * height / h), height);
+  if (height == 0)
+    return std::make_pair(width, std::max(1, h * width / w));
+  return std::make_pair(width, height);
+}
+
+
 const AVFrame& ConverterRGB24::convert(const AVFrame &frame, ubyte* out_rgb)
 {
   int w = frame.width;
   int h = frame.height;
   int pix_fmt = frame.format;
+  int out_w, out_h; std::tie(out_w, out_h) = output_size(w, h);
   
+  // Converting and scaling is one pass, the context is only rebuilt when sizes change.
   context = sws_getCachedContext(context, 
                                  w, h, (AVPixelFormat)pix_fmt, 
-                                 w, h, PIX_FMT_RGB24, SWS_BILINEAR, 
+                                 out_w, out_h, pixel_format(format), sws_flags(scaler), 
                                  nullptr, nullptr, nullptr);
   if (!context)
     throw H264DecodeFailure("cannot allocate context");
   
-  // Setup framergb with out_rgb as external buffer. Also say that we want RGB24 output.
-  avpicture_fill((AVPicture*)framergb, out_rgb, PIX_FMT_RGB24, w, h);
+  // Setup framergb with out_rgb as external buffer in the output format.
+  avpicture_fill((AVPicture*)framergb, out_rgb, pixel_format(format), out_w, out_h);
   // Do the conversion.
   sws_scale(context, frame.data, frame.linesize, 0, h,
             framergb->data, framergb->linesize);
-  framergb->width = w;
-  framergb->height = h;
+  framergb->width = out_w;
+  framergb->height = out_h;
   return *framergb;
 }
 
@@ -151,7 +226,8 @@ fill the buffer we should also use it to determine the required size.
 */
 int ConverterRGB24::predict_size(int w, int h)
 {
-  return avpicture_fill((AVPicture*)framergb, nullptr, PIX_FMT_RGB24, w, h);  
+  int out_w, out_h; std::tie(out_w, out_h) = output_size(w, h);
+  return avpicture_fill((AVPicture*)framergb, nullptr, pixel_format(format), out_w, out_h);  
 }
 
 
@@ -20,6 +20,7 @@ mechanisms of boost::python.
 #include <cstdlib>
 #include <stdexcept>
 #include <cstddef>
+#include <utility>
 
 struct AVCodecContext;
 struct AVFrame;
@@ -48,6 +49,12 @@ public:
 };
 
 
+/* How libav spreads decoding over threads. SLICE decodes the slices of one frame in
+parallel, which only helps streams that cut frames into several slices, and adds no
+latency. FRAME decodes consecutive frames in parallel, which scales with the number
+of threads on any stream, but every frame is returned thread_count - 1 frames late. */
+enum class ThreadType { SLICE, FRAME };
+
 class H264Decoder
 {
   /* Persistent things here, using RAII for cleanup. */
@@ -62,7 +69,14 @@ parse- and decode frame. In release 11 it is put on the stack, too.
   */
   AVPacket              *pkt;
 public:
-  H264Decoder();
+  /* With complete_frames, every buffer passed to parse is taken to hold whole
+access units, which are then available for decoding at once instead of only
+when the start of the next access unit has been parsed. */
+  /* thread_count is the number of decoding threads, 0 for one per core.
+With low_delay, libav outputs every frame as soon as it is decoded rather than
+holding frames back for reordering; this also turns frame threading off. */
+  H264Decoder(bool complete_frames = false, int thread_count = 1,
+              ThreadType thread_type = ThreadType::SLICE, bool low_delay = false);
   ~H264Decoder();
   /* First, parse a continuous data stream, dividing it into 
 packets. When there is enough data to form a new frame, decode 
@@ -75,22 +89,39 @@ bytes at frame boundaries.
   const AVFrame& decode_frame();
 };
 
+/* Pixel formats the converter can output. YUV420P is planar, Y followed by the
+quarter size U and V planes, the others are packed. */
+enum class OutputFormat { RGB24, BGR24, GRAY8, YUV420P };
+
+/* Scaling algorithms, see the SWS_* flags of libswscale. */
+enum class Scaler { FAST_BILINEAR, BILINEAR, BICUBIC, AREA, POINT };
+
 // TODO: Rename to OutputStage or so?!
 class ConverterRGB24
 {
   SwsContext *context;
   AVFrame *framergb;
+  OutputFormat format;
+  int width, height;
+  Scaler scaler;
   
 public:
-  ConverterRGB24();
+  /*  Converts to format and scales to width x height with scaler, all in one
+sws_scale pass. A width or height of 0 is derived from the other one keeping the
+aspect ratio of the decoded frame, both 0 keep its size. */
+  ConverterRGB24(OutputFormat format = OutputFormat::RGB24, int width = 0, int height = 0,
+                 Scaler scaler = Scaler::BILINEAR);
   ~ConverterRGB24();
    
-  /*  Returns, given a width and height, 
+  /*  Returns, given the width and height of the decoded frame, those of
+      the converted one. */
+  std::pair<int, int> output_size(int w, int h) const;
+  /*  Returns, given the width and height of the decoded frame, 
       how many bytes the frame buffer is going to need. */
   int predict_size(int w, int h);
-  /*  Given a decoded frame, convert it to RGB format and fill 
+  /*  Given a decoded frame, convert it to the output format and fill 
 out_rgb with the result. Returns a AVFrame structure holding 
-additional information about the RGB frame, such as the number of
+additional information about the converted frame, such as the number of
 bytes in a row and so on. */
   const AVFrame& convert(const AVFrame &frame, unsigned char* out_rgb);
 };
@@ -1,4 +1,4 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 
 import os
 import sys
@@ -7,19 +7,20 @@ import time
 
 import libh264decoder
 
-thefile = 'testclip.h264'
+thefile = sys.argv[1] if len(sys.argv) > 1 else 'testclip.h264'
 
 if 1:
-  def conv((frame, w, h, ls)):
-    frame = np.fromstring(frame, dtype = np.ubyte, count = len(frame), sep = '') # this conversion drops fps from 200 to 150
-    frame = frame.reshape((h, ls/3, 3))
+  def conv(framedata):
+    (frame, w, h, ls) = framedata
+    frame = np.frombuffer(frame, dtype = np.ubyte, count = len(frame)) # this conversion drops fps from 200 to 150
+    frame = frame.reshape((h, ls//3, 3))
     frame = frame[:,:w,:]
 else:
   def conv(frame):
     pass
 
 def run_decode():
-  with open(thefile,'r') as f:
+  with open(thefile,'rb') as f:
     num_frames = 0
     decoder = libh264decoder.H264Decoder()
     # Original way is 60 fps on laptop, this way is 100 fps
@@ -34,7 +35,7 @@ def run_decode():
     return num_frames
 
 def run_decode_frame():
-  with open(thefile,'r') as f:
+  with open(thefile,'rb') as f:
     num_frames = 0
     decoder = libh264decoder.H264Decoder()
     # On laptop this way is 80 fps.
@@ -54,7 +55,7 @@ def measure(fun):
   t0 = time.time()
   num_frames = fun()
   t1 = time.time()
-  print '%s fps = %f' % (fun.__name__, num_frames/(t1-t0))
+  print('%s fps = %f' % (fun.__name__, num_frames/(t1-t0)))
 
 run_decode()
 measure(run_decode)
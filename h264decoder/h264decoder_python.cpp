@@ -2,6 +2,9 @@
 #include <cstdlib>
 #include <stdexcept>
 #include <cassert>
+#include <memory>
+#include <string>
+#include <vector>
 
 // Boost python might need a patch. See https://github.com/boostorg/python/issues/193
 
@@ -65,93 +68,274 @@ private:
   PyThreadState *state;
 };
 
-/* Fetch the pointer from string type (Python  2) or bytes type (Python 3) */
-void extract_data_ptr_from_buffer(py::object o, const ubyte* &data_in, ssize_t &len);
+/* View on the memory of any object supporting the buffer protocol, e.g. bytes,
+ * bytearray, memoryview or numpy arrays. The memory is not copied. The exporter is
+ * kept from resizing or freeing it for as long as the view lives. Pass
+ * PyBUF_WRITABLE in flags to write into it. */
+class PyBufferView
+{
+public:
+  explicit PyBufferView(const py::object &o, int flags = PyBUF_SIMPLE)
+  {
+    if (PyObject_GetBuffer(o.ptr(), &view, flags) != 0)
+      py::throw_error_already_set();
+  }
+
+  ~PyBufferView()
+  {
+    PyBuffer_Release(&view);
+  }
+
+  const ubyte* data() const { return (const ubyte*)view.buf; }
+  ubyte* writable_data() { return (ubyte*)view.buf; }
+  ssize_t size() const { return view.len; }
+
+  PyBufferView(const PyBufferView &) = delete;
+  PyBufferView operator=(const PyBufferView &) = delete;
+private:
+  Py_buffer view;
+};
+
+OutputFormat output_format(const std::string &name)
+{
+  if (name == "rgb24")   return OutputFormat::RGB24;
+  if (name == "bgr24")   return OutputFormat::BGR24;
+  if (name == "gray8")   return OutputFormat::GRAY8;
+  if (name == "yuv420p") return OutputFormat::YUV420P;
+  throw std::invalid_argument("unknown output format: " + name);
+}
+
+Scaler scaler(const std::string &name)
+{
+  if (name == "fast_bilinear") return Scaler::FAST_BILINEAR;
+  if (name == "bilinear")      return Scaler::BILINEAR;
+  if (name == "bicubic")       return Scaler::BICUBIC;
+  if (name == "area")          return Scaler::AREA;
+  if (name == "point")         return Scaler::POINT;
+  throw std::invalid_argument("unknown scaler: " + name);
+}
+
+ThreadType thread_type(const std::string &name)
+{
+  if (name == "slice") return ThreadType::SLICE;
+  if (name == "frame") return ThreadType::FRAME;
+  throw std::invalid_argument("unknown thread type: " + name);
+}
 }
 
 
 /* The class wrapped in python via boost::python */
 class PyH264Decoder
 {
+  /* One conversion of every decoded frame, with the allocator of its frame buffers. */
+  struct Output
+  {
+    ConverterRGB24 converter;
+    /* None, or a callable (width, height, size) -> writable buffer of at least size bytes. */
+    py::object allocator;
+
+    Output(const std::string &format, int width, int height, const std::string &scaler_name,
+           const py::object &allocator_)
+      : converter(output_format(format), width, height, scaler(scaler_name)), allocator(allocator_)
+    {
+    }
+  };
+
   H264Decoder decoder;
-  ConverterRGB24 converter;
+  /* Never empty. decode and decode_frame return frames of the first output. */
+  std::vector<std::unique_ptr<Output>> outputs;
 
   /* Extract frames from input stream. Stops at frame boundaries and returns the number of consumed bytes
    * in num_consumed.
    * 
    * If a frame is completed, is_frame_available is set to true, and the returned python tuple contains
-   * formation about the frame as well as the frame buffer memory. 
+   * one tuple per output with formation about the frame as well as the frame buffer memory. 
    * 
    * Else, i.e. all data in the buffer is consumed, is_frame_available is set to false. The returned tuple
-   * contains dummy data.
+   * is empty. It is empty as well without convert, then the frame is only decoded.
    */ 
-  py::tuple decode_frame_impl(const ubyte *data, ssize_t num, ssize_t &num_consumed, bool &is_frame_available);
+  py::tuple decode_frame_impl(const ubyte *data, ssize_t num, ssize_t &num_consumed, bool &is_frame_available,
+                              bool convert = true);
+  /* Convert a decoded frame for output. Called and returns with the GIL held. */
+  py::tuple convert_frame(Output &output, const AVFrame &frame, GILScopedReverseLock &gilguard);
+  /* Process all the input data, see decode, decode_outputs and skip_frames. */
+  py::list decode_impl(const py::object &py_data_in, bool all_outputs, bool convert = true);
   
 public:
+  /* See H264Decoder::H264Decoder and ConverterRGB24::ConverterRGB24. format is one of
+   * rgb24, bgr24, gray8 or yuv420p, scaler one of fast_bilinear, bilinear, bicubic,
+   * area or point, thread_type_name slice or frame. */
+  explicit PyH264Decoder(bool complete_frames = false, const std::string &format = "rgb24",
+                         int width = 0, int height = 0, const std::string &scaler_name = "bilinear",
+                         int thread_count = 1, const std::string &thread_type_name = "slice",
+                         bool low_delay = false)
+    : decoder(complete_frames, thread_count, thread_type(thread_type_name), low_delay)
+  {
+    outputs.emplace_back(new Output(format, width, height, scaler_name, py::object()));
+  }
+
+  /* Convert decoded frames of the first output into buffers returned by allocator instead
+   * of into a new bytes object per frame. The allocator is called with the GIL held for
+   * every frame as allocator(width, height, size) and must return a C contiguous, writable
+   * object of at least size bytes, e.g. a numpy array. That object is returned in place of
+   * the bytes. Pass None to go back to bytes. */
+  void set_frame_allocator(const py::object &allocator_)
+  {
+    outputs.front()->allocator = allocator_;
+  }
+
+  /* Replace the outputs by the given sequence of (format, width, height, scaler, allocator)
+   * tuples, see the constructor and set_frame_allocator. Each decoded frame is converted
+   * once per output. Must not be called while another thread is decoding. */
+  void set_outputs(const py::object &specs);
+
   /* Decoding style analogous to c/c++ way. Stop at frame boundaries. 
    * Return tuple containing frame data as above as nested tuple, and an integer telling how many bytes were consumed.  */
   py::tuple decode_frame(const py::object &py_data_in);
   /* Process all the input data and return a list of all contained frames. */
   py::list  decode(const py::object &py_data_in);
+  /* As decode, but return a tuple of frames, one per output, for each decoded frame. */
+  py::list  decode_outputs(const py::object &py_data_in);
+  /* Process all the input data, keeping the decoder state up to date, but convert none of
+   * the frames. Returns the number of decoded frames. For frames no one is going to look
+   * at, e.g. all but the newest of a backlog. */
+  int skip_frames(const py::object &py_data_in);
 };
 
 
-py::tuple PyH264Decoder::decode_frame_impl(const ubyte *data_in, ssize_t len, ssize_t &num_consumed, bool &is_frame_available)
+void PyH264Decoder::set_outputs(const py::object &specs)
 {
-  GILScopedReverseLock gilguard;
-  num_consumed = decoder.parse((ubyte*)data_in, len);
-  
-  if (is_frame_available = decoder.is_frame_available())
+  std::vector<std::unique_ptr<Output>> new_outputs;
+  for (py::ssize_t i = 0; i < py::len(specs); ++i)
   {
-    const auto &frame = decoder.decode_frame();
-    int w, h; std::tie(w,h) = width_height(frame);
-    Py_ssize_t out_size = converter.predict_size(w,h);
+    py::object spec = specs[i];
+    new_outputs.emplace_back(new Output(py::extract<std::string>(spec[0]),
+                                        py::extract<int>(spec[1]),
+                                        py::extract<int>(spec[2]),
+                                        py::extract<std::string>(spec[3]),
+                                        spec[4]));
+  }
+  if (new_outputs.empty())
+    throw std::invalid_argument("at least one output is needed");
+  outputs.swap(new_outputs);
+}
 
-    gilguard.lock();
 
+py::tuple PyH264Decoder::convert_frame(Output &output, const AVFrame &frame, GILScopedReverseLock &gilguard)
+{
+  int w, h; std::tie(w,h) = width_height(frame);
+  Py_ssize_t out_size = output.converter.predict_size(w,h);
+  std::tie(w,h) = output.converter.output_size(w,h);
+
+  py::object py_out;
+  ubyte* out_buffer;
+  // Keeps the allocator's buffer exported while the converter writes into it.
+  std::unique_ptr<PyBufferView> out_view;
+  if (output.allocator.is_none())
+  {
   // Allocate storage for the output frame.
 #if IS_PYTHON3
-  py::object py_out_str(py::handle<>(PyBytes_FromStringAndSize(nullptr, out_size)));
-  char* out_buffer = PyBytes_AsString(py_out_str.ptr());
+    py_out = py::object(py::handle<>(PyBytes_FromStringAndSize(nullptr, out_size)));
+    out_buffer = (ubyte*)PyBytes_AsString(py_out.ptr());
 #else
     //   Construction of py::handle causes ... TODO: WHAT? No increase of ref count ?!
-    py::object py_out_str(py::handle<>(PyString_FromStringAndSize(NULL, out_size)));
-    char* out_buffer = PyString_AsString(py_out_str.ptr());
+    py_out = py::object(py::handle<>(PyString_FromStringAndSize(NULL, out_size)));
+    out_buffer = (ubyte*)PyString_AsString(py_out.ptr());
 #endif
+  }
+  else
+  {
+    py_out = output.allocator(w, h, out_size);
+    out_view.reset(new PyBufferView(py_out, PyBUF_WRITABLE | PyBUF_C_CONTIGUOUS));
+    if (out_view->size() < out_size)
+      throw std::invalid_argument("frame buffer returned by the allocator is too small");
+    out_buffer = out_view->writable_data();
+  }
 
-    gilguard.unlock();
-    const auto &rgbframe = converter.convert(frame, (ubyte*)out_buffer);
-    
+  gilguard.unlock();
+  int linesize;
+  try
+  {
+    linesize = row_size(output.converter.convert(frame, out_buffer));
+  }
+  catch (...)
+  {
+    // Python objects above must be released with the GIL held.
     gilguard.lock();
-    return py::make_tuple(py_out_str, w, h, row_size(rgbframe));
+    throw;
+  }
+
+  gilguard.lock();
+  return py::make_tuple(py_out, w, h, linesize);
+}
+
+
+py::tuple PyH264Decoder::decode_frame_impl(const ubyte *data_in, ssize_t len, ssize_t &num_consumed, bool &is_frame_available,
+                                           bool convert)
+{
+  GILScopedReverseLock gilguard;
+  num_consumed = decoder.parse((ubyte*)data_in, len);
+  
+  if (is_frame_available = decoder.is_frame_available())
+  {
+    const auto &frame = decoder.decode_frame();
+
+    gilguard.lock();
+    py::list frames;
+    if (convert)
+    {
+      for (auto &output : outputs)
+        frames.append(convert_frame(*output, frame, gilguard));
+    }
+    return py::tuple(frames);
   }
   else
   {
     gilguard.lock();
-    return py::make_tuple(py::object(), 0, 0, 0);
+    return py::tuple();
   }
 }
 
 
 py::tuple PyH264Decoder::decode_frame(const py::object &py_data_in)
 {
-  ssize_t len;
-  const ubyte* data_in;
-  extract_data_ptr_from_buffer(py_data_in, data_in, len);
+  PyBufferView buffer(py_data_in);
+  ssize_t len = buffer.size();
+  const ubyte* data_in = buffer.data();
 
   ssize_t num_consumed = 0;
   bool is_frame_available = false;
-  auto frame = decode_frame_impl(data_in, len, num_consumed, is_frame_available);
+  auto frames = decode_frame_impl(data_in, len, num_consumed, is_frame_available);
   
-  return py::make_tuple(frame, num_consumed);
+  if (is_frame_available)
+    return py::make_tuple(frames[0], num_consumed);
+  return py::make_tuple(py::make_tuple(py::object(), 0, 0, 0), num_consumed);
 }
 
 
 py::list PyH264Decoder::decode(const py::object &py_data_in)
 {
-  ssize_t len;
-  const ubyte* data_in;
-  extract_data_ptr_from_buffer(py_data_in, data_in, len);
+  return decode_impl(py_data_in, false);
+}
+
+
+py::list PyH264Decoder::decode_outputs(const py::object &py_data_in)
+{
+  return decode_impl(py_data_in, true);
+}
+
+
+int PyH264Decoder::skip_frames(const py::object &py_data_in)
+{
+  return py::len(decode_impl(py_data_in, true, false));
+}
+
+
+py::list PyH264Decoder::decode_impl(const py::object &py_data_in, bool all_outputs, bool convert)
+{
+  PyBufferView buffer(py_data_in);
+  ssize_t len = buffer.size();
+  const ubyte* data_in = buffer.data();
   
   py::list out;
   
@@ -164,10 +348,13 @@ py::list PyH264Decoder::decode(const py::object &py_data_in)
       
       try
       {
-        auto frame = decode_frame_impl(data_in, len, num_consumed, is_frame_available);
+        auto frames = decode_frame_impl(data_in, len, num_consumed, is_frame_available, convert);
         if (is_frame_available)
         {
-          out.append(frame);
+          if (all_outputs)
+            out.append(frames);
+          else
+            out.append(frames[0]);
         }
       }
       catch (const H264DecodeFailure &e)
@@ -192,27 +379,18 @@ py::list PyH264Decoder::decode(const py::object &py_data_in)
 BOOST_PYTHON_MODULE(libh264decoder)
 {
   PyEval_InitThreads(); // need for release of the GIL (http://stackoverflow.com/questions/8009613/boost-python-not-supporting-parallelism)
-  py::class_<PyH264Decoder>("H264Decoder")
+  py::class_<PyH264Decoder, boost::noncopyable>("H264Decoder",
+                            py::init<bool, std::string, int, int, std::string, int, std::string, bool>(
+                              (py::arg("complete_frames")=false, py::arg("format")="rgb24",
+                               py::arg("width")=0, py::arg("height")=0, py::arg("scaler")="bilinear",
+                               py::arg("thread_count")=1, py::arg("thread_type")="slice",
+                               py::arg("low_delay")=false)))
                             .def("decode_frame", &PyH264Decoder::decode_frame)
-                            .def("decode", &PyH264Decoder::decode);
+                            .def("decode", &PyH264Decoder::decode)
+                            .def("decode_outputs", &PyH264Decoder::decode_outputs)
+                            .def("skip_frames", &PyH264Decoder::skip_frames)
+                            .def("set_frame_allocator", &PyH264Decoder::set_frame_allocator)
+                            .def("set_outputs", &PyH264Decoder::set_outputs);
   py::def("disable_logging", disable_logging);
 }
 
-
-namespace {
-  void extract_data_ptr_from_buffer(py::object o, const ubyte* &data_in, ssize_t &len)
-  {
-#if IS_PYTHON3
-    auto raw_ptr = o.ptr();
-    if (!PyBytes_Check(raw_ptr))
-      throw std::invalid_argument("Input must be a byte array");
-    len = PyBytes_Size(raw_ptr);
-    data_in = (const ubyte*)(PyBytes_AsString(raw_ptr));
-#else
-    if (!PyString_Check(o.ptr()))
-      throw std::invalid_argument("Input must be a string");
-    len = PyString_Size(o.ptr());
-    data_in = (const ubyte*)(PyString_AsString(o.ptr()));
-#endif
-  }
-}
@@ -1,4 +1,4 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 
 import os
 import sys
@@ -6,14 +6,14 @@ import numpy as np
 import threading
 import libh264decoder
 
-thefile = 'testclip.h264'
+thefile = sys.argv[1] if len(sys.argv) > 1 else 'testclip.h264'
 
 class DecoderThread(threading.Thread):
   def __init__(self):
     threading.Thread.__init__(self)
     self.counter = 0
   def run(self):
-    with open(thefile,'r') as f:
+    with open(thefile,'rb') as f:
       num_frames = 0
       decoder = libh264decoder.H264Decoder()
       # Original way is 60 fps on laptop, this way is 100 fps
@@ -23,7 +23,7 @@ class DecoderThread(threading.Thread):
           break
         framelist = decoder.decode(data_in)
         for frame in framelist:
-          print 'thread %s decoded frame %i' % (self.ident, self.counter)
+          print('thread %s decoded frame %i' % (self.ident, self.counter))
           self.counter += 1
       return num_frames
 
@@ -32,4 +32,4 @@ b = DecoderThread()
 a.start()
 b.start()
 a.join()
-b.join()
\ No newline at end of file
+b.join()
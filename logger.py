@@ -1,9 +1,17 @@
+import collections
 import csv
 import datetime
+import os
+import queue
 import re
+import subprocess
+import threading
+import time
 
 import cv2
 
+from telemetry_log import ColumnarLogWriter
+
 class DataLogger:
 
     pattern = re.compile(r'(-?\d+(?:\.\d+)?)')
@@ -12,17 +20,103 @@ class DataLogger:
             'time': 'NA', 'agx': 'NA', 'agy': 'NA', 'agz': 'NA'}
     fieldnames = ['timestamp', 'mid', 'x', 'y', 'z', 'mpry', 'pitch', 'roll', 'yaw', 'vgx', 'vgy', 'vgz', 'templ', 'temph', 'tof', 'h', 'bat', 'baro', 'time', 'agx', 'agy', 'agz']
     
-    def __init__(self, drone, log_path):
+    def __init__(self, drone, log_path, columnar=False, queue_size=1024, batch_size=64,
+                 chunk_rows=1024):
+        """
+        Logs one row per state broadcast received from the drone.
+
+        States arrive as the STATE_DTYPE records parsed by the drone's telemetry
+        receiver, so a columnar log stores them as they are and a CSV log formats
+        their values.
+
+        Rows are queued by the telemetry receive thread and written in batches by a
+        writer thread started with start(). When the queue is full rows are dropped
+        and counted instead of blocking the receiver. Every batch is flushed to the
+        OS; a columnar log still only writes a chunk every chunk_rows rows and on
+        close(), so the rows of an unfinished chunk are lost if the process dies.
+
+        :param drone (Tello): Drone whose telemetry is logged.
+        :param log_path (str): Prefix of the log file, the timestamp and extension are appended.
+        :param columnar (bool): Write a columnar binary log (see telemetry_log) instead of CSV.
+        :param queue_size (int): Rows that may wait for the writer thread.
+        :param batch_size (int): Most rows written per batch.
+        :param chunk_rows (int): Rows per chunk of a columnar log.
+        """
         self.tello = drone
+        self.columnar = columnar
+        self.batch_size = batch_size
+        self.written = 0  # rows written to the file
+        self.dropped = 0  # rows dropped because the queue was full
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.writer_thread = None
         ts = datetime.datetime.now()
-        self.path_to_file = log_path + "{}.csv".format(ts.strftime("%Y-%m-%d_%H-%M-%S"))
-        self.log_file = open(self.path_to_file, 'w', newline='')
-        self.writer = csv.DictWriter(self.log_file, fieldnames=DataLogger.fieldnames)
-        self.writer.writeheader()
+        if columnar:
+            self.path_to_file = log_path + "{}.tlog".format(ts.strftime("%Y-%m-%d_%H-%M-%S"))
+            self.log_file = ColumnarLogWriter(self.path_to_file, chunk_rows=chunk_rows)
+        else:
+            self.path_to_file = log_path + "{}.csv".format(ts.strftime("%Y-%m-%d_%H-%M-%S"))
+            self.log_file = open(self.path_to_file, 'w', newline='')
+            self.writer = csv.writer(self.log_file)
+            self.writer.writerow(DataLogger.fieldnames)
+
+    def start(self):
+        """Subscribe to the drone's telemetry and start the writer thread."""
+        if self.writer_thread is not None:
+            return
+        if self.tello.telemetry is None:
+            print("[INFO] drone has no telemetry receiver, nothing to log")
+            return
+        self.writer_thread = threading.Thread(target=self._writer_loop)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+        self.tello.telemetry.subscribe(self._on_state)
 
     def close(self):
+        if self.writer_thread is not None:
+            self.tello.telemetry.unsubscribe(self._on_state)
+            # wake up the writer, it drains the queue before exiting
+            self.queue.put(None)
+            self.writer_thread.join()
+            self.writer_thread = None
         self.log_file.close()
+
+    def _on_state(self, state):
+        # runs on the telemetry receive thread, must never block
+        try:
+            self.queue.put_nowait(state)
+        except queue.Full:
+            self.dropped += 1
+
+    def _writer_loop(self):
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                batch.pop()
+                running = False
+            self._write_rows(batch)
+
+    def _write_rows(self, states):
+        if self.columnar:
+            for state in states:
+                self.log_file.append(state)
+        else:
+            self.writer.writerows(DataLogger.csv_row(state) for state in states)
+        # only hands complete chunks to the OS, see ColumnarLogWriter.flush()
+        self.log_file.flush()
+        self.written += len(states)
     
+    @staticmethod
+    def csv_row(state):
+        """Format a STATE_DTYPE record as a CSV row, mpry as 'm,p,y'."""
+        return [','.join(str(v) for v in state[name]) if name == 'mpry' else str(state[name])
+                for name in DataLogger.fieldnames]
+
     @staticmethod
     def now():
         return datetime.datetime.now().timestamp()
@@ -38,36 +132,343 @@ class DataLogger:
                 'templ': int(parsed[13]), 'temph': int(parsed[14]), 'tof': int(parsed[15]), 'h': int(parsed[16]), 'bat': int(parsed[17]), 'baro': float(parsed[18]), \
                 'time': int(parsed[19]), 'agx': float(parsed[20]), 'agy': float(parsed[21]), 'agz': float(parsed[22])}
         except:
-            DataLogger.default_data_slice['timestamp'] = DataLogger.now()
-            data_slice = DataLogger.default_data_slice
+            data_slice = dict(DataLogger.default_data_slice, timestamp=DataLogger.now())
         return data_slice
     
-    def is_data_string(self, response):
-        if response == 'ok':
-            return False
-        else:
-            return True
-
-    def log_data(self):
-        response = self.tello.get_response()
-        if self.is_data_string(response):
-            data_row = DataLogger.parse(response)
-            self.writer.writerow(data_row)
-
     def log_command(self, command):
         pass
 
 class Recorder:
 
-    def __init__(self, log_path):
+    def __init__(self, log_path, fps=30.0, queue_size=32):
+        """
+        Records decoded frames, re-encoded to XVID, on a writer thread.
+
+        write() only queues the frame, so the display never waits for the encoder. A
+        frame whose sequence number was written already is skipped, and when the
+        queue is full the frame is dropped and counted. The AVI has a constant frame
+        rate, so every frame is put in the slot its capture time falls in: missing
+        slots repeat the previous frame and a second frame for a slot is skipped,
+        which keeps playback in step with real time. The video takes the size of the
+        first frame.
+
+        :param log_path (str): Prefix of the recording, the timestamp and extension are appended.
+        :param fps (float): Frame rate of the AVI.
+        :param queue_size (int): Frames that may wait for the writer thread.
+        """
         ts = datetime.datetime.now()
         self.path_to_file = log_path + "{}.avi".format(ts.strftime("%Y-%m-%d_%H-%M-%S"))
-        fourcc = cv2.VideoWriter_fourcc(*'XVID')
-        self.video = cv2.VideoWriter(self.path_to_file, fourcc, 32.0, (960,720))
+        self.fps = fps
+        self.video = None  # opened with the size of the first frame
+        self.written = 0  # frames encoded, repeats included
+        self.repeated = 0  # frames encoded again to fill a slot without a new frame
+        self.duplicates = 0  # frames skipped because their seq or slot was written already
+        self.dropped = 0  # frames dropped because the queue was full
+        self.queue = queue.Queue(maxsize=queue_size)
+        self._last_seq = 0  # seq of the last frame queued
+        self._start_time = None  # capture time of the first frame, slot 0
+        self._slot = -1  # slot of the last frame written
+        self._bgrframe = None  # reused for every frame
+        self.writer_thread = threading.Thread(target=self._writer_loop)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+
+    @property
+    def depth(self):
+        """Number of frames waiting for the writer thread."""
+        return self.queue.qsize()
+
+    def write(self, frame, timestamp=None, seq=None):
+        """
+        Queue a frame for recording, never blocks.
+
+        :param frame (numpy.ndarray): RGB frame.
+        :param timestamp (float|None): time.time() the frame was captured, now if None.
+        :param seq (int|None): Sequence number of the frame, see Tello.wait_frame().
+        """
+        if seq is not None:
+            if seq <= self._last_seq:
+                self.duplicates += 1
+                return
+            self._last_seq = seq
+        try:
+            self.queue.put_nowait((frame, time.time() if timestamp is None else timestamp))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        if self.writer_thread is not None:
+            # wake up the writer, it drains the queue before exiting
+            self.queue.put(None)
+            self.writer_thread.join()
+            self.writer_thread = None
+        if self.video is not None:
+            self.video.release()
+
+    def _writer_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            self._write_frame(*item)
+
+    def _write_frame(self, frame, timestamp):
+        if self._start_time is None:
+            self._start_time = timestamp
+        slot = int(round((timestamp - self._start_time) * self.fps))
+        if slot <= self._slot:
+            self.duplicates += 1
+            return
+
+        if self.video is None:
+            fourcc = cv2.VideoWriter_fourcc(*'XVID')
+            self.video = cv2.VideoWriter(self.path_to_file, fourcc, self.fps,
+                                         (frame.shape[1], frame.shape[0]))
+        elif self._slot + 1 < slot:
+            # no frame was captured for these slots, show the previous one longer
+            for _ in range(slot - self._slot - 1):
+                self.video.write(self._bgrframe)
+            self.repeated += slot - self._slot - 1
+            self.written += slot - self._slot - 1
+
+        # decoded frames are contiguous, so OpenCV converts in place into the reused
+        # buffer instead of copying the frame in and allocating the result
+        if self._bgrframe is None or self._bgrframe.shape != frame.shape:
+            self._bgrframe = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+        else:
+            cv2.cvtColor(frame, cv2.COLOR_RGB2BGR, dst=self._bgrframe)
+        self.video.write(self._bgrframe)
+        self._slot = slot
+        self.written += 1
+
+
+H264_INDEX_FIELDS = ('offset', 'size', 'timestamp', 'keyframe')
+
+
+class H264Recorder:
+
+    def __init__(self, drone, log_path, queue_size=256):
+        """
+        Records the video stream as the drone sent it, without decoding or re-encoding.
 
-    def write(self, frame):
-        bgrframe = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-        self.video.write(bgrframe)
+        Access units are written to a raw H.264 file, which ffmpeg and most players
+        read, in the drone's original quality. A sidecar CSV index next to it holds
+        one row per access unit: byte offset, size, time.time() of reception and
+        whether it is a keyframe. Recording starts at the first keyframe, so the file
+        decodes from its start. Access units are queued by the video receive thread
+        and written by a writer thread; when the queue is full they are dropped and
+        counted, and writing resumes at the next keyframe.
+
+        :param drone (Tello): Drone whose video is recorded.
+        :param log_path (str): Prefix of the recording, the timestamp and extension are appended.
+        :param queue_size (int): Access units that may wait for the writer thread.
+        """
+        self.tello = drone
+        self.written = 0  # access units written to the file
+        self.dropped = 0  # access units dropped because the queue was full or after a drop
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.writer_thread = None
+        self._keyframe_seen = False  # the recording or a resync after a drop has begun
+        self._resyncing = False  # waiting for a keyframe after a drop
+        ts = datetime.datetime.now()
+        self.path_to_file = log_path + "{}.h264".format(ts.strftime("%Y-%m-%d_%H-%M-%S"))
+        self.index_path = self.path_to_file + ".csv"
+        self.video_file = open(self.path_to_file, 'wb')
+        self.index_file = open(self.index_path, 'w', newline='')
+        self.index = csv.writer(self.index_file)
+        self.index.writerow(H264_INDEX_FIELDS)
+        self.offset = 0  # bytes written to the file
+
+    def start(self):
+        """Subscribe to the drone's access units, starting its video, and the writer thread."""
+        if self.writer_thread is not None:
+            return
+        self.writer_thread = threading.Thread(target=self._writer_loop)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+        self.tello.video.subscribe_access_units(self._on_access_unit)
+
+    def close(self):
+        if self.writer_thread is not None:
+            self.tello.video.unsubscribe_access_units(self._on_access_unit)
+            # wake up the writer, it drains the queue before exiting
+            self.queue.put(None)
+            self.writer_thread.join()
+            self.writer_thread = None
+        self.video_file.close()
+        self.index_file.close()
+
+    def _on_access_unit(self, access_unit, keyframe, timestamp):
+        # runs on the video receive thread, must never block
+        if not self._keyframe_seen:
+            if not keyframe:
+                if self._resyncing:
+                    self.dropped += 1
+                return
+            self._keyframe_seen = True
+        try:
+            # the stream reuses the buffer once the access unit is decoded
+            self.queue.put_nowait((bytes(access_unit), keyframe, timestamp))
+        except queue.Full:
+            # the frames up to the next keyframe reference the one dropped
+            self.dropped += 1
+            self._keyframe_seen = False
+            self._resyncing = True
+
+    def _writer_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            access_unit, keyframe, timestamp = item
+            self.offset = _write_access_unit(self.video_file, self.index, self.offset,
+                                             access_unit, keyframe, timestamp)
+            self.written += 1
+        self.video_file.flush()
+        self.index_file.flush()
+
+
+class ReplayBuffer:
+
+    def __init__(self, drone, seconds=30.0, max_bytes=64 * 1024 * 1024):
+        """
+        Keeps the last seconds of the video stream in memory, as received, for an
+        instant replay of what happened before something went wrong.
+
+        Access units are kept in groups starting at a keyframe, and only whole groups
+        are discarded, so the buffer always begins with a keyframe and a replay
+        decodes from its first frame. Compressed, 30 seconds of Tello video take a
+        few MB. dump_replay() writes a replay on a thread of its own, the stream is
+        not held up.
+
+        :param drone (Tello): Drone whose video is buffered.
+        :param seconds (float): Video kept, at least that much once it has been received.
+        :param max_bytes (int): Most bytes kept, older groups are discarded first.
+        """
+        self.tello = drone
+        self.seconds = seconds
+        self.max_bytes = max_bytes
+        self.size = 0  # bytes buffered
+        self._gops = collections.deque()  # lists of (access unit, keyframe, timestamp), each from a keyframe
+        self._lock = threading.Lock()
+        self._running = False
+
+    @property
+    def duration(self):
+        """Seconds of video buffered."""
+        with self._lock:
+            if not self._gops:
+                return 0.0
+            return self._gops[-1][-1][2] - self._gops[0][0][2]
+
+    def start(self):
+        """Subscribe to the drone's access units, starting its video."""
+        if self._running:
+            return
+        self._running = True
+        self.tello.video.subscribe_access_units(self._on_access_unit)
 
     def close(self):
-        self.video.release()
\ No newline at end of file
+        if self._running:
+            self.tello.video.unsubscribe_access_units(self._on_access_unit)
+            self._running = False
+        with self._lock:
+            self._gops.clear()
+            self.size = 0
+
+    def dump_replay(self, seconds, path):
+        """
+        Write the last seconds of video to path, with an index like H264Recorder's.
+
+        The replay starts at the last keyframe at least seconds old, so it may be a
+        little longer. Writing runs on a new thread, which is returned.
+
+        :param seconds (float): Seconds of video to write.
+        :param path (str): Path of the raw H.264 file, the index goes to path + '.csv'.
+        :return (threading.Thread): Thread writing the replay, join it to wait.
+        """
+        with self._lock:
+            # the receive thread keeps appending to the newest group
+            gops = [list(gop) for gop in self._gops]
+        if gops:
+            cutoff = gops[-1][-1][2] - seconds
+            while len(gops) > 1 and gops[1][0][2] <= cutoff:
+                gops.pop(0)
+
+        thread = threading.Thread(target=self._write_replay, args=(gops, path))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _on_access_unit(self, access_unit, keyframe, timestamp):
+        # runs on the video receive thread, must never block for long
+        with self._lock:
+            if keyframe:
+                self._gops.append([])
+            elif not self._gops:
+                return
+            self._gops[-1].append((bytes(access_unit), keyframe, timestamp))
+            self.size += len(access_unit)
+
+            # drop the oldest group once the rest still covers seconds
+            cutoff = timestamp - self.seconds
+            while len(self._gops) > 1 and (self._gops[1][0][2] <= cutoff or
+                                           self.size > self.max_bytes):
+                self.size -= sum(len(unit[0]) for unit in self._gops.popleft())
+
+    @staticmethod
+    def _write_replay(gops, path):
+        with open(path, 'wb') as video_file, open(path + '.csv', 'w', newline='') as index_file:
+            index = csv.writer(index_file)
+            index.writerow(H264_INDEX_FIELDS)
+            offset = 0
+            for gop in gops:
+                for access_unit, keyframe, timestamp in gop:
+                    offset = _write_access_unit(video_file, index, offset,
+                                                access_unit, keyframe, timestamp)
+        print("[INFO] saved replay {}".format(path))
+
+
+def _write_access_unit(video_file, index, offset, access_unit, keyframe, timestamp):
+    """Append an access unit and its index row, return the offset after it."""
+    video_file.write(access_unit)
+    index.writerow((offset, len(access_unit), '%.6f' % timestamp, int(keyframe)))
+    return offset + len(access_unit)
+
+
+def read_h264_index(index_path):
+    """
+    Read the sidecar index of an H264Recorder recording.
+
+    :param index_path (str): Path of the .h264.csv file.
+    :return (list): (offset, size, timestamp, keyframe) tuples, one per access unit.
+    """
+    with open(index_path, newline='') as f:
+        rows = csv.reader(f)
+        next(rows)
+        return [(int(offset), int(size), float(timestamp), keyframe == '1')
+                for offset, size, timestamp, keyframe in rows]
+
+
+def remux_to_mp4(h264_path, mp4_path=None, index_path=None, ffmpeg='ffmpeg'):
+    """
+    Copy an H264Recorder recording into an MP4 container without re-encoding.
+
+    The raw stream carries no timestamps, so the frame rate of the MP4 is the mean
+    rate of the access units in the index, which keeps the duration true to the
+    flight. Needs the ffmpeg executable.
+
+    :param h264_path (str): Path of the .h264 recording.
+    :param mp4_path (str|None): Path of the MP4 to write, the recording's with .mp4 if None.
+    :param index_path (str|None): Path of the index, the recording's with .csv if None.
+    :param ffmpeg (str): ffmpeg executable.
+    :return (str): Path of the MP4.
+    """
+    if mp4_path is None:
+        mp4_path = os.path.splitext(h264_path)[0] + '.mp4'
+    index = read_h264_index(index_path or h264_path + '.csv')
+    duration = index[-1][2] - index[0][2] if len(index) > 1 else 0
+    fps = (len(index) - 1) / duration if duration > 0 else 30.0
+    subprocess.check_call([ffmpeg, '-y', '-loglevel', 'error', '-framerate', '%.3f' % fps,
+                           '-i', h264_path, '-c', 'copy', mp4_path])
+    return mp4_path
@@ -1,30 +1,140 @@
 from tkinter import *
+import collections
 import threading
 import datetime
 import cv2
 import os
 import time
-import platform
 from pathlib import Path
 from PIL import Image
 from PIL import ImageTk
 
-from logger import DataLogger, Recorder
+from logger import DataLogger, H264Recorder, Recorder, ReplayBuffer
+from video import OutputSpec
+
+
+class VideoDisplay:
+    """Shows the newest frame of a FrameMailbox in a Tk label.
+
+    Tk is not thread-safe, so no video thread touches it: the Tk main loop polls
+    the mailbox with after(), at most fps times a second, and only draws a frame it
+    has not drawn yet. A single PhotoImage is created for the first frame and
+    updated in place with paste() afterwards. Frames are best delivered at the
+    display size, e.g. scaled by the decoder through an OutputSpec; others are
+    resized here.
+    """
+
+    def __init__(self, root, parent, mailbox, size=(640, 480), fps=30.0):
+        """
+        :param root (Tk): Tk root whose main loop polls the mailbox.
+        :param parent (Widget): Widget the video label is packed into.
+        :param mailbox (FrameMailbox): Mailbox of the frames to show.
+        :param size (tuple): (width, height) of the video on screen.
+        :param fps (float): Most frames drawn per second.
+        """
+        self.root = root
+        self.parent = parent
+        self.mailbox = mailbox
+        self.size = tuple(size)
+        self.fps = fps
+        self.frozen = False  # keep showing the current frame
+        self.frame = None  # frame shown last
+        self.label = None
+        self.photo = None
+        self._seq = 0  # seq of the frame shown last
+        self._afterId = None
+        self._renderTimes = collections.deque(maxlen=30)
+        self._shownTimes = collections.deque(maxlen=30)
+
+    def start(self):
+        """Start polling the mailbox on the Tk main loop."""
+        if self._afterId is None:
+            self._tick()
+
+    def stop(self):
+        if self._afterId is not None:
+            self.root.after_cancel(self._afterId)
+            self._afterId = None
+
+    def _tick(self):
+        t0 = time.perf_counter()
+        self.poll()
+        # cap the frame rate, the time spent drawing counts towards the interval
+        delay = 1.0 / self.fps - (time.perf_counter() - t0)
+        self._afterId = self.root.after(max(1, int(delay * 1000)), self._tick)
+
+    def poll(self):
+        """
+        Draw the newest frame of the mailbox unless it was drawn already.
+
+        :return (bool): Whether a frame was drawn.
+        """
+        frame, seq, timestamp = self.mailbox.get()
+        if frame is None or seq == self._seq or self.frozen:
+            return False
+        self._seq = seq
+        self.showFrame(frame)
+        return True
+
+    def showFrame(self, frame):
+        """
+        Draw a frame, must run on the Tk main loop.
+
+        :param frame (numpy.ndarray): RGB frame.
+        """
+        t0 = time.perf_counter()
+        image = Image.fromarray(frame)
+        if image.size != self.size:
+            image = image.resize(self.size, Image.BILINEAR)
+        if self.photo is None:
+            self.photo = ImageTk.PhotoImage(image)
+            self.label = Label(self.parent, image=self.photo)
+            self.label.pack(side="left", padx=10, pady=10)
+        else:
+            self.photo.paste(image)
+        self.frame = frame
+        now = time.perf_counter()
+        self._renderTimes.append(now - t0)
+        self._shownTimes.append(now)
+
+    def stats(self):
+        """Return the mean render time in ms and the frames drawn per second, over the last 30 frames."""
+        shown = self._shownTimes
+        fps = 0.0
+        if len(shown) > 1 and shown[-1] > shown[0]:
+            fps = (len(shown) - 1) / (shown[-1] - shown[0])
+        render = 0.0
+        if self._renderTimes:
+            render = sum(self._renderTimes) / len(self._renderTimes) * 1000
+        return {'display_fps': fps, 'render_ms': render}
+
 
 class ManualControlUI:
     """Wrapper class to enable the GUI."""
 
-    def __init__(self, tello, root, outputpath):
+    def __init__(self, tello, root, outputpath, recording='h264', displaySize=(640, 480),
+                 displayFps=30.0, replaySeconds=30.0):
         self.root = root
         self.tello = tello
         self.outputPath = outputpath # the path that save pictures created by clicking the takeSnapshot button 
         self.log = DataLogger(tello, self.outputPath)
-        self.rec = Recorder(self.outputPath)
-        self.frame = None  # frame read from h264decoder and used for pose recognition 
+        # 'h264' records the stream as received, 'frames' re-encodes the displayed frames
+        self.recording = recording
+        self.rec = None
+        if recording == 'h264':
+            self.rec = H264Recorder(tello, self.outputPath)
+        elif recording == 'frames':
+            self.rec = Recorder(self.outputPath)
+        # the decoder scales the live view to the display size in the same pass
+        self.displayOutput = OutputSpec('rgb24', size=displaySize)
+        self.displaySize = displaySize
+        self.displayFps = displayFps
+        self.display = None
+        # the last replaySeconds of video, kept while the panel is open
+        self.replaySeconds = replaySeconds
+        self.replay = ReplayBuffer(tello, replaySeconds)
         self.video_thread = None
-        self.control_thread = None
         self.stopEvent = threading.Event()
-        self.imagelabel = None
 
         # if the flag is TRUE,the auto-takeoff thread will stop waiting for the response from tello
         self.quit_waiting_flag = False
@@ -40,66 +150,28 @@ class ManualControlUI:
         self.flip_opened = False
 
 
-    def _updateGUIImage(self,image):
-        """
-        Main operation to initialize the object of image, and update the GUI panel 
-        """  
-        image = ImageTk.PhotoImage(image)
-        if self.imagelabel is None:
-            self.imagelabel = Label(self.panel, image=image)
-            self.imagelabel.image = image
-            self.imagelabel.pack(side="left", padx=10, pady=10)
-        else:
-            self.imagelabel.configure(image=image)
-            self.imagelabel.image = image
-
     def _videoLoop(self):
         """
-        The mainloop thread of Tkinter 
-        Raises:
-            RuntimeError: To get around a RunTime error that Tkinter throws due to threading.
+        Hands every full size frame to the recorder once, when recording frames.
         """
+        self.tello.subscribe_video()
         try:
-            # start the thread that get GUI image and draw skeleton 
-            time.sleep(0.5)
-            while not self.stopEvent.is_set():                
-                system = platform.system()
-
-                # read the frame for GUI show
-                self.frame = self.tello.read()
-                if self.frame is None or self.frame.size == 0:
-                    continue 
-            
-                # transfer the format from frame to image     
-                self.log.log_data()    
-                image = Image.fromarray(self.frame)
-                self.rec.write(self.frame)
-                # we found compatibility problem between Tkinter,PIL and Macos,and it will 
-                # sometimes result the very long preriod of the "ImageTk.PhotoImage" function,
-                # so for Macos,we start a new thread to execute the _updateGUIImage function.
-                if system == "Windows" or system == "Linux": 
-                    self._updateGUIImage(image)
-                else:
-                    thread_tmp = threading.Thread(target=self._updateGUIImage,args=(image,))
-                    thread_tmp.start()
-                    time.sleep(0.03)                                           
-        except RuntimeError as e:
-            print("[INFO] caught a RuntimeError")
-            
-    def _controlLoop(self):
-        self.tello.send_command("command")
-        skipCommandCounter = 0
-        while not self.stopEvent.is_set():
-            time.sleep(0.05)
-            if self.stateLR == 0 and self.stateFB == 0 and self.stateUD == 0 and self.stateYAW == 0:
-                # Avoid sending 0,0,0,0 alot of times when not active
-                if skipCommandCounter > 1:
+            seq = 0
+            while not self.stopEvent.is_set():
+                result = self.tello.wait_frame(seq, timeout=0.5)
+                if result is None:
                     continue
-                self.tello.move_rc(0, 0, 0, 0)
-                skipCommandCounter += 1
-            else:
-                self.tello.move_rc(self.stateLR, self.stateFB, self.stateUD, self.stateYAW)
-                skipCommandCounter = 0
+                frame, seq, timestamp = result
+                # queued for the recorder thread, the same seq is recorded once
+                self.rec.write(frame, timestamp, seq)
+        finally:
+            self.tello.unsubscribe_video()
+            
+    def _updateRC(self):
+        """
+        Hand the current control state to the rc stream, which sends it on its next tick
+        """
+        self.tello.move_rc(self.stateLR, self.stateFB, self.stateUD, self.stateYAW)
 
     def _setQuitWaitingFlag(self):  
         """
@@ -114,6 +186,16 @@ class ManualControlUI:
         # Open drone connection
         self.tello.timeout = 0.3
         self.tello.connect()
+        # the live view is what consumes the video, it starts the stream; flying by
+        # it, the newest picture matters more than every picture
+        self.wasLowLatency = self.tello.video.low_latency
+        self.tello.video.low_latency = True
+        self.tello.subscribe_video(self.displayOutput)
+        if self.recording == 'h264':
+            self.rec.start()
+        self.replay.start()
+        # log every state broadcast, independently of the video
+        self.log.start()
 
         self.panel = Toplevel(self.root)
         self.panel.wm_title("Command Panel")
@@ -142,6 +224,11 @@ class ManualControlUI:
                           justify="left")
         text1.pack(side="top")
 
+        btn_replay = Button(
+            self.panel, text="Save Replay", relief="raised", command=self.saveReplay)
+        btn_replay.pack(side="bottom", fill="both",
+                              expand="yes", padx=10, pady=5)
+
         btn_landing = Button(
             self.panel, text="Land", relief="raised", command=self.telloLanding)
         btn_landing.pack(side="bottom", fill="both",
@@ -197,14 +284,17 @@ class ManualControlUI:
         self.speed_bar.set(self.stateSpeed)
         self.speed_bar.pack(side="right")
         
-        # start a thread that constantly pools the video sensor for
-        # the most recently read frame
-        self.video_thread = threading.Thread(target=self._videoLoop, args=())
-        self.video_thread.start()
+        # the Tk main loop polls for the newest frame of the live view
+        self.display = VideoDisplay(self.root, self.panel,
+                                    self.tello.video.get_mailbox(self.displayOutput),
+                                    self.displaySize, self.displayFps)
+        self.display.start()
+        if self.recording == 'frames':
+            self.video_thread = threading.Thread(target=self._videoLoop, args=())
+            self.video_thread.start()
 
-        # Start a thread, that sends controller commands to drone based on state.
-        self.control_thread = threading.Thread(target=self._controlLoop, args=())
-        self.control_thread.start()
+        # Stream the control state to the drone at a fixed rate.
+        self.tello.start_rc_stream(rate=20)
 
 
 
@@ -264,11 +354,52 @@ class ManualControlUI:
 
         p = os.path.sep.join((self.outputPath, filename))
 
+        if self.display.frozen:
+            frame = self.display.frame
+        else:
+            # the newest full size frame, if anyone decodes them, e.g. when recording frames
+            frame = self.tello.video.mailbox.frame
+        if frame is not None:
+            self._saveSnapshot(frame, p, filename)
+        else:
+            # the live view is scaled down, wait for a full size frame off the Tk main loop
+            thread = threading.Thread(target=self._fetchSnapshot, args=(p, filename))
+            thread.daemon = True
+            thread.start()
+
+    def _fetchSnapshot(self, p, filename):
+        """
+        Wait for the next full size frame and hand it to the Tk main loop to be saved
+        """
+        self.tello.subscribe_video()
+        try:
+            result = self.tello.wait_frame(self.tello.video.mailbox.seq, timeout=1.0)
+        finally:
+            self.tello.unsubscribe_video()
+        frame = None if result is None else result[0]
+        self.root.after(0, self._saveSnapshot, frame, p, filename)
+
+    def _saveSnapshot(self, frame, p, filename):
+        """
+        save a frame as a jpg file into p
+        """
+        if frame is None:
+            print("[INFO] no frame to save")
+            return
+
         # save the file
-        cv2.imwrite(p, cv2.cvtColor(self.frame, cv2.COLOR_RGB2BGR))
+        cv2.imwrite(p, cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
         print(("[INFO] saved {}".format(filename)))
 
 
+    def saveReplay(self):
+        """
+        save the last seconds of video as a h264 file into outputpath, in the background
+        """
+        ts = datetime.datetime.now()
+        filename = "replay_{}.h264".format(ts.strftime("%Y-%m-%d_%H-%M-%S"))
+        self.replay.dump_replay(self.replaySeconds, os.path.sep.join((self.outputPath, filename)))
+
     def pauseVideo(self):
         """
         Toggle the freeze/unfreze of video
@@ -276,9 +407,11 @@ class ManualControlUI:
         if self.btn_pause.config('relief')[-1] == 'sunken':
             self.btn_pause.config(relief="raised")
             self.tello.video_freeze(False)
+            self.display.frozen = False
         else:
             self.btn_pause.config(relief="sunken")
             self.tello.video_freeze(True)
+            self.display.frozen = True
 
     def telloTakeOff(self):
         return self.tello.takeoff()
@@ -310,51 +443,67 @@ class ManualControlUI:
 
     def on_keypress_w(self, event):
         self.stateUD = 50
+        self._updateRC()
 
     def on_keyrelease_w(self, event):
         self.stateUD = 0
+        self._updateRC()
 
     def on_keypress_s(self, event):
         self.stateUD = -50
+        self._updateRC()
     
     def on_keyrelease_s(self, event):
         self.stateUD = 0
+        self._updateRC()
 
     def on_keypress_a(self, event):
         self.stateYAW = -50
+        self._updateRC()
     
     def on_keyrelease_a(self, event):
         self.stateYAW = 0
+        self._updateRC()
 
     def on_keypress_d(self, event):
         self.stateYAW = 50
+        self._updateRC()
     
     def on_keyrelease_d(self, event):
         self.stateYAW = 0
+        self._updateRC()
 
     def on_keypress_up(self, event):
         self.stateFB = 50
+        self._updateRC()
     
     def on_keyrelease_up(self, event):
         self.stateFB = 0
+        self._updateRC()
 
     def on_keypress_down(self, event):
         self.stateFB = -50
+        self._updateRC()
 
     def on_keyrelease_down(self, event):
         self.stateFB = 0
+        self._updateRC()
 
     def on_keypress_left(self, event):
         self.stateLR = -50
+        self._updateRC()
 
     def on_keyrelease_left(self, event):
         self.stateLR = 0
+        self._updateRC()
 
     def on_keypress_right(self, event):
         self.stateLR = 50
+        self._updateRC()
 
     def on_keyrelease_right(self, event):
         self.stateLR = 0
+        self._updateRC()
 
     def on_keypress_f(self, event):
         print('taking off')
@@ -364,11 +513,18 @@ class ManualControlUI:
         self.telloLanding()
 
     def onClose(self):
+        self.display.stop()
+        self.stopEvent.set()
+        if self.video_thread is not None:
+            self.video_thread.join()
+        self.tello.unsubscribe_video(self.displayOutput)
+        self.tello.video.low_latency = self.wasLowLatency
         self.tello.disconnect()
         print("[INFO] closing manual control UI...")
-        self.stopEvent.set()
         self.log.close()
-        self.rec.close()
+        if self.rec is not None:
+            self.rec.close()
+        self.replay.close()
         self.panel.destroy()
         
 
@@ -0,0 +1,91 @@
+import collections
+import math
+import threading
+import time
+
+
+class RCStreamer:
+    """Sends the latest rc setpoint to the Tello at a fixed rate.
+
+    The rc command gets no reply from SDK 1.3 firmware on, so the setpoint is sent
+    fire-and-forget. Callers only swap the setpoint, which is picked up by the next
+    tick, so stick input reaches the drone within one period. The timing of the
+    last sends is kept to report the achieved rate and jitter.
+    """
+
+    def __init__(self, send, rate=20.0, window=100):
+        """
+        :param send (callable): Function taking the rc command string and sending it.
+        :param rate (float): Setpoints sent per second.
+        :param window (int): Number of recent sends used for the statistics.
+        """
+        self.send = send
+        self.period = 1.0 / rate
+        self.setpoint = (0, 0, 0, 0)
+        self.sent = 0
+
+        self._send_times = collections.deque(maxlen=window)
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        """Start the sender thread."""
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._send_times.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the sender thread."""
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def update(self, lr, fb, ud, yaw):
+        """Replace the setpoint sent on the next tick."""
+        self.setpoint = (int(lr), int(fb), int(ud), int(yaw))
+
+    def stats(self):
+        """
+        Return statistics of the recent sends.
+
+        Returns:
+            dict: 'sent' total setpoints sent, 'rate' achieved sends per second,
+                'jitter' standard deviation of the send interval in seconds.
+        """
+        times = list(self._send_times)
+        intervals = [b - a for a, b in zip(times, times[1:])]
+        if not intervals:
+            return {'sent': self.sent, 'rate': 0.0, 'jitter': 0.0}
+
+        mean = sum(intervals) / len(intervals)
+        variance = sum((i - mean) ** 2 for i in intervals) / len(intervals)
+        return {'sent': self.sent, 'rate': 1.0 / mean if mean > 0 else 0.0,
+                'jitter': math.sqrt(variance)}
+
+    def _run(self):
+        next_tick = time.monotonic()
+        while not self._stop_event.is_set():
+            try:
+                self.send('rc %d %d %d %d' % self.setpoint)
+            except OSError as exc:
+                print(("Caught exception socket.error : %s" % exc))
+            now = time.monotonic()
+            self._send_times.append(now)
+            self.sent += 1
+
+            next_tick += self.period
+            if next_tick < now:
+                # fell behind, e.g. the host was suspended -- don't burst to catch up
+                next_tick = now
+            self._stop_event.wait(next_tick - now)
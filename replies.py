@@ -0,0 +1,209 @@
+import collections
+import threading
+import time
+
+
+# Connection handshake of Tello and AsyncTello, (command, only 'ok' completes it).
+# Mission pads only exist on the EDU, other models may refuse 'moff', and a
+# previous session may have left the video stream on.
+HANDSHAKE = (('command', True), ('moff', False), ('sdk?', False), ('streamoff', False))
+
+
+class TelloConnectionError(Exception):
+    """Raised when the Tello does not complete the connection handshake in time."""
+
+    def __init__(self, step, response):
+        """
+        :param step (str): Handshake command that failed.
+        :param response (str): Last response to it, 'timeout' if there was none.
+        """
+        Exception.__init__(self, 'Tello handshake failed at "{}": {}'.format(step, response))
+        self.step = step
+        self.response = response
+
+
+def parse_sdk_version(sdk):
+    """Turn the answer to 'sdk?', e.g. '20', into a float such as 2.0, or return it unchanged."""
+    try:
+        return float(sdk[:1] + '.' + sdk[1:])
+    except ValueError:
+        return sdk
+
+
+class CommandWaiter:
+    """A command that has been sent to the Tello and is waiting for its reply."""
+
+    def __init__(self, command):
+        self.command = command
+        self.response = None
+        self.sent_at = None
+        self._event = threading.Event()
+
+    def set_response(self, response):
+        """Deliver the reply and wake up whoever is waiting on it."""
+        self.response = response
+        self._event.set()
+
+    def cancel(self):
+        """Wake up the waiting thread without a reply."""
+        self._event.set()
+
+    def wait(self, timeout=None):
+        """
+        Block until the reply arrives or the timeout expires.
+
+        :param timeout (float|None): Seconds to wait, None waits forever.
+        :return (bool): True if the waiter was resolved before the timeout.
+        """
+        return self._event.wait(timeout)
+
+    @property
+    def done(self):
+        return self._event.is_set()
+
+
+def is_state_packet(data):
+    """Return True if the datagram is a state broadcast (key:value;...) rather than a reply."""
+    return b';' in data and b':' in data
+
+
+class LateReply:
+    """Place of a timed out command in the reply order, until its reply arrives or its window closes."""
+
+    def __init__(self, command, until):
+        self.command = command
+        self.until = until  # time.monotonic() after which the reply is taken as lost
+
+
+class ReplyMatcher:
+    """Matches the replies of one Tello to the commands waiting for them.
+
+    The Tello answers commands in the order they were sent, so replies are matched
+    first in, first out. A command that times out keeps its place in that order for
+    a window in which its reply is still expected: a reply arriving then is dropped
+    instead of being credited to the next command. Commands registered with hold
+    are only sent once every such reply has arrived or its window has closed, so a
+    lost reply can never shift the replies of the commands after it.
+    """
+
+    def __init__(self):
+        self._pending = collections.deque()  # waiters and LateReply, in the order sent
+        self._waiting = 0  # waiters in _pending
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return self._waiting
+
+    def _owed_until(self, now):
+        """Return when the last window of a reply owed to a timed out command closes, None if none is owed."""
+        until = None
+        for entry in self._pending:
+            if isinstance(entry, LateReply) and entry.until > now:
+                until = entry.until if until is None else max(until, entry.until)
+        return until
+
+    def owed_until(self):
+        """
+        Return when the replies owed to timed out commands stop being expected.
+
+        :return (float|None): time.monotonic() value, None if no reply is owed.
+        """
+        with self._cond:
+            return self._owed_until(time.monotonic())
+
+    def register(self, waiter, hold=True, timeout=None):
+        """
+        Queue a waiter, must be called before its command is sent so that a fast
+        reply can never arrive ahead of it.
+
+        :param waiter (CommandWaiter|ScheduledCommand): Waiter for the command.
+        :param hold (bool): First wait until no reply is owed to a timed out command.
+        :param timeout (float|None): Longest hold in seconds, None holds until the
+            last owed window closes.
+        """
+        with self._cond:
+            if hold:
+                deadline = None if timeout is None else time.monotonic() + timeout
+                while True:
+                    now = time.monotonic()
+                    until = self._owed_until(now)
+                    if until is None:
+                        break
+                    if deadline is not None:
+                        if now >= deadline:
+                            break
+                        until = min(until, deadline)
+                    self._cond.wait(until - now)
+            self._pending.append(waiter)
+            self._waiting += 1
+            waiter.sent_at = time.monotonic()
+
+    def dispatch(self, data):
+        """
+        Hand a reply to the oldest command still owed one.
+
+        :param data (bytes): Datagram received from the Tello.
+        :return (CommandWaiter|None): The waiter that got the reply, None if it was dropped.
+        """
+        with self._cond:
+            now = time.monotonic()
+            while self._pending and isinstance(self._pending[0], LateReply):
+                late = self._pending.popleft()
+                self._cond.notify_all()
+                if late.until > now:
+                    print('Dropped late response to "{}": {}'.format(late.command, data))
+                    return None
+                # its window closed, the reply was lost
+
+            if not self._pending:
+                print('Dropped unsolicited response: {}'.format(data))
+                return None
+
+            waiter = self._pending.popleft()
+            self._waiting -= 1
+
+        waiter.set_response(data)
+        return waiter
+
+    def expire(self, waiter, window):
+        """
+        Give up on a waiter whose reply did not arrive in time.
+
+        The reply may still show up later, so the command keeps its place for another
+        window seconds and its reply is dropped if it arrives.
+
+        :param waiter (CommandWaiter): Waiter that timed out.
+        :param window (float): Seconds a late reply is still expected.
+        """
+        with self._cond:
+            try:
+                index = self._pending.index(waiter)
+            except ValueError:
+                # the reply arrived while we were giving up on it
+                return
+            self._pending[index] = LateReply(waiter.command, time.monotonic() + window)
+            self._waiting -= 1
+        waiter.cancel()
+
+    def expect_late(self, command, count, window):
+        """
+        Expect extra replies, e.g. to retransmitted copies of a command that was answered.
+
+        :param command (str): Command the replies belong to.
+        :param count (int): Number of extra replies.
+        :param window (float): Seconds they are expected for.
+        """
+        with self._cond:
+            until = time.monotonic() + window
+            for _ in range(count):
+                self._pending.append(LateReply(command, until))
+
+    def cancel_all(self):
+        """Release every waiter without a reply and forget the replies owed."""
+        with self._cond:
+            waiters = [entry for entry in self._pending if not isinstance(entry, LateReply)]
+            self._pending.clear()
+            self._waiting = 0
+            self._cond.notify_all()
+        for waiter in waiters:
+            waiter.cancel()
@@ -7,6 +7,9 @@ class TelloScript():
     def main(self, tello):
         tello.command_timeout = 5.0
 
+        # Start the video stream, the first frames arrive a moment later
+        tello.subscribe_video()
+
         # Set speed to 50 cm/s
         tello.set_speed(50)
 
@@ -29,6 +32,9 @@ class TelloScript():
         # Fly forward for 2m again
         tello.move_forward(200)
 
+        # Stop the video stream
+        tello.unsubscribe_video()
+
         # Land
         tello.land()
 
@@ -7,6 +7,9 @@ class TelloScript():
     def main(self, tello):
         tello.command_timeout = 5.0
 
+        # Start the video stream, the first frames arrive a moment later
+        tello.subscribe_video()
+
         # Set speed to 50 cm/s
         tello.set_speed(50)
 
@@ -22,6 +25,9 @@ class TelloScript():
             now = time.time()
             if now - start > 20:
                 break
+        # Stop the video stream
+        tello.unsubscribe_video()
+
         # Land
         tello.land()
 
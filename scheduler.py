@@ -0,0 +1,282 @@
+import heapq
+import itertools
+import threading
+import time
+
+from replies import CommandWaiter
+
+# Priority classes, lower value is sent first.
+EMERGENCY = 0  # emergency, land, stop -- bypass rate limit and in-flight command
+MODE = 1  # takeoff, speed, moves, flips, stream control ...
+CONTROL = 2  # rc setpoints, only the newest queued one is kept
+QUERY = 3  # read commands ending with '?'
+
+_EMERGENCY_COMMANDS = ('emergency', 'land', 'stop')
+
+
+def classify(command):
+    """
+    Return the priority class of an SDK command.
+
+    :param command (str): Command as sent to the Tello.
+    :return (int): One of EMERGENCY, MODE, CONTROL, QUERY.
+    """
+    name = command.split(' ', 1)[0]
+    if name in _EMERGENCY_COMMANDS:
+        return EMERGENCY
+    if name == 'rc':
+        return CONTROL
+    if name.endswith('?'):
+        return QUERY
+    return MODE
+
+
+class ScheduledCommand(CommandWaiter):
+    """A command queued in the scheduler, waited on by the caller until its reply arrives."""
+
+    def __init__(self, command, priority, seq, expect_response=True, scheduler=None):
+        CommandWaiter.__init__(self, command)
+        self.priority = priority
+        self.seq = seq
+        self.expect_response = expect_response
+        self.scheduler = scheduler  # woken when the command is resolved
+
+    def set_response(self, response):
+        CommandWaiter.set_response(self, response)
+        if self.scheduler is not None:
+            self.scheduler._wake()
+
+    def cancel(self):
+        CommandWaiter.cancel(self)
+        if self.scheduler is not None:
+            self.scheduler._wake()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class TokenBucket:
+    """Token bucket rate limiter, refilled continuously at rate tokens per second."""
+
+    def __init__(self, rate, burst):
+        """
+        :param rate (float): Tokens added per second.
+        :param burst (int): Maximum number of tokens, i.e. the largest burst allowed.
+        """
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, now):
+        """Take one token if available, return True on success."""
+        self._refill(now)
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+
+    def delay(self, now):
+        """Seconds until the next token is available."""
+        self._refill(now)
+        if self.tokens >= 1.0:
+            return 0.0
+        return (1.0 - self.tokens) / self.rate
+
+
+class CommandScheduler:
+    """Single thread in front of the Tello command socket.
+
+    Commands from every thread are queued by priority class and sent one at a time:
+    the next command only leaves once the previous one was answered or timed out,
+    and a token bucket limits how fast commands are sent. Emergency commands skip
+    both the rate limit and the in-flight command, so land and emergency reach the
+    drone within one scheduler tick. Queued rc setpoints are coalesced: a newer
+    setpoint replaces one that has not been sent yet. Commands that get no reply,
+    like rc from SDK 1.3 on, are sent as soon as they are next in priority order.
+
+    A command that timed out may still be answered, so after a timeout the next
+    command expecting a reply is held until that reply arrived or its window
+    closed, see ReplyMatcher. Emergency commands are not held: they reach the drone
+    at once, at the cost of their reply being taken for the owed one if that was
+    lost. The thread sleeps while there is nothing to do.
+    """
+
+    def __init__(self, tello, rate=10.0, burst=5, tick=0.01):
+        """
+        :param tello (Tello): Drone whose command socket is driven by this scheduler.
+        :param rate (float): Commands per second allowed on average.
+        :param burst (int): Commands that may be sent back to back.
+        :param tick (float): Longest time in seconds the scheduler sleeps between checks
+            while a reply is owed to a timed out command.
+        """
+        self.tello = tello
+        self.bucket = TokenBucket(rate, burst)
+        self.tick = tick
+
+        self._queue = []  # heap of ScheduledCommand
+        self._rc = None  # pending rc setpoint, kept out of the heap so it can be replaced
+        self._outstanding = []  # sent commands still waiting for a reply
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+
+        self.sent = 0
+        self.coalesced = 0
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self):
+        """Start the scheduler thread."""
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the scheduler thread and release every command still queued."""
+        with self._cond:
+            self._running = False
+            pending = self._queue + self._outstanding
+            if self._rc is not None:
+                pending.append(self._rc)
+            self._queue = []
+            self._rc = None
+            self._outstanding = []
+            self._cond.notify_all()
+
+        for ticket in pending:
+            ticket.cancel()
+
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def submit(self, command, priority=None, expect_response=True):
+        """
+        Queue a command for sending.
+
+        :param command (str): Command to send.
+        :param priority (int|None): Priority class, derived from the command if None.
+        :param expect_response (bool): False for commands the Tello does not answer,
+            their handle is resolved as soon as the datagram is sent.
+        :return (ScheduledCommand): Handle to wait on for the reply.
+        """
+        if priority is None:
+            priority = classify(command)
+
+        with self._cond:
+            if not self._running:
+                ticket = ScheduledCommand(command, priority, next(self._seq), expect_response)
+                ticket.cancel()
+                return ticket
+
+            if priority == CONTROL:
+                if self._rc is not None:
+                    # newer setpoint replaces the queued one, both callers get its reply
+                    self._rc.command = command
+                    self._rc.expect_response = expect_response
+                    self.coalesced += 1
+                    return self._rc
+                ticket = self._rc = ScheduledCommand(command, priority, next(self._seq),
+                                                     expect_response, self)
+            else:
+                ticket = ScheduledCommand(command, priority, next(self._seq), expect_response,
+                                          self)
+                heapq.heappush(self._queue, ticket)
+
+            self._cond.notify()
+        return ticket
+
+    def pending(self):
+        """Number of commands queued but not yet sent."""
+        with self._cond:
+            return len(self._queue) + (self._rc is not None)
+
+    def _peek(self):
+        """Return the next command to send without removing it, or None."""
+        head = self._queue[0] if self._queue else None
+        if self._rc is not None and (head is None or self._rc < head):
+            return self._rc
+        return head
+
+    def _pop(self, ticket):
+        if ticket is self._rc:
+            self._rc = None
+        else:
+            heapq.heappop(self._queue)
+
+    def _wake(self):
+        """Let the scheduler thread check again, e.g. because a command was answered."""
+        with self._cond:
+            self._cond.notify()
+
+    def _next_ready(self, now):
+        """
+        Pick the command that may be sent now.
+
+        :return (tuple): (ScheduledCommand|None, float|None) the command and, if there
+            is none, how long to sleep before checking again, None until woken.
+        """
+        timeout = self.tello.command_timeout
+        outstanding = []
+        for sent in self._outstanding:
+            if not sent.done and sent.sent_at is not None and now - sent.sent_at >= timeout:
+                self.tello._expire(sent)
+            if not sent.done:
+                outstanding.append(sent)
+        self._outstanding = outstanding
+        # sleep until the oldest outstanding command times out, or until woken by its reply
+        expiry = None
+        if outstanding:
+            oldest = min(now if sent.sent_at is None else sent.sent_at for sent in outstanding)
+            expiry = max(0.0, oldest + timeout - now)
+
+        ticket = self._peek()
+        if ticket is None:
+            return None, expiry
+
+        if ticket.priority != EMERGENCY and ticket.expect_response:
+            if outstanding:
+                return None, expiry
+            owed_until = self.tello._replies.owed_until()
+            if owed_until is not None:
+                return None, min(self.tick, max(0.0, owed_until - now))
+            if not self.bucket.try_take(now):
+                return None, self.bucket.delay(now)
+
+        self._pop(ticket)
+        return ticket, 0.0
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._running:
+                    break
+                ticket, sleep = self._next_ready(time.monotonic())
+                if ticket is None:
+                    self._cond.wait(sleep)
+                    continue
+                if ticket.expect_response:
+                    self._outstanding.append(ticket)
+
+            try:
+                if ticket.expect_response:
+                    # held above already, emergency commands are not held at all
+                    self.tello._transmit(ticket.command, ticket, hold=False)
+                else:
+                    self.tello._send_only(ticket.command)
+                    ticket.cancel()
+                self.sent += 1
+            except OSError as exc:
+                print(("Caught exception socket.error : %s" % exc))
+                ticket.cancel()
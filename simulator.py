@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+"""Local Tello simulator speaking the SDK over UDP.
+
+Point a Tello at it with tello_ip='127.0.0.1' to exercise the command, state and
+video paths without a drone:
+
+    python simulator.py --latency 0.02 --loss 0.05 --video capture.h264
+
+or, from a test or benchmark:
+
+    sim = TelloSimulator(latency=0.02, video_path='capture.h264')
+    sim.start()
+    drone = Tello('127.0.0.1', 9000, tello_ip='127.0.0.1', tello_port=sim.command_port)
+"""
+
+import argparse
+import heapq
+import itertools
+import random
+import socket
+import threading
+import time
+
+STATE_FORMAT = ('mid:-1;x:-100;y:-100;z:-100;mpry:-1,-1,-1;pitch:{pitch};roll:{roll};yaw:{yaw};'
+                'vgx:0;vgy:0;vgz:0;templ:60;temph:63;tof:{tof};h:{h};bat:{bat};baro:{baro:.2f};'
+                'time:{time};agx:0.00;agy:0.00;agz:-1000.00;\r\n')
+# One state broadcast as the simulator sends it, e.g. for benchmarks of the parsers.
+SAMPLE_STATE = STATE_FORMAT.format(pitch=-3, roll=1, yaw=45, tof=10, h=0, bat=87, baro=12.34,
+                                   time=0).encode('ascii')
+
+# Packet size the Tello splits every access unit into, the last one is shorter.
+VIDEO_PACKET_SIZE = 1460
+
+_QUERIES = {
+    'sdk?': lambda sim: '20',
+    'sn?': lambda sim: '0TQDG000000000',
+    'wifi?': lambda sim: '90',
+    'battery?': lambda sim: str(sim.state['bat']),
+    'height?': lambda sim: '{}dm'.format(sim.state['h'] // 10),
+    'time?': lambda sim: '{}s'.format(sim.state['time']),
+    'speed?': lambda sim: '{:.1f}'.format(sim.speed),
+}
+
+_MOVES = ('up', 'down', 'left', 'right', 'forward', 'back', 'cw', 'ccw', 'flip', 'go', 'curve')
+
+# UUID of the SEI user data carrying the sequence number of a tagged access unit,
+# followed by the number as ten ASCII digits, which never need emulation prevention.
+VIDEO_TAG_UUID = b'TelloSimulatorAU'
+# Access units whose send time is kept for video_sent_at.
+_SENT_HISTORY = 1024
+
+
+def tag_access_unit(access_unit, seq):
+    """
+    Prefix an access unit with an SEI NAL unit (user data unregistered) carrying seq.
+
+    Decoders ignore it, while a receiver can read seq back with read_video_tag().
+
+    :param access_unit (bytes): Access unit starting with a start code.
+    :param seq (int): Sequence number, below 10 ** 10.
+    :return (bytes): The tagged access unit.
+    """
+    payload = VIDEO_TAG_UUID + b'%010d' % seq
+    return b'\x00\x00\x00\x01\x06\x05' + bytes([len(payload)]) + payload + b'\x80' + access_unit
+
+
+def read_video_tag(access_unit):
+    """
+    Return the sequence number tag_access_unit() put into an access unit, None if untagged.
+
+    :param access_unit (bytes|memoryview): Access unit as received.
+    """
+    data = bytes(access_unit[:64])
+    start = data.find(VIDEO_TAG_UUID)
+    if start < 0:
+        return None
+    start += len(VIDEO_TAG_UUID)
+    return int(data[start:start + 10])
+
+
+def split_access_units(data):
+    """
+    Split an Annex B H.264 stream into access units.
+
+    Parameter sets and SEI are kept with the slice that follows them. Every slice
+    ends an access unit, which matches the single slice frames the Tello sends.
+
+    :param data (bytes): Raw H.264 elementary stream.
+    :return (list): Access units as bytes, each starting with a start code.
+    """
+    starts = []
+    i = data.find(b'\x00\x00\x01')
+    while i >= 0:
+        # include the leading zero of a four byte start code
+        starts.append(i - 1 if i > 0 and data[i - 1] == 0 else i)
+        i = data.find(b'\x00\x00\x01', i + 3)
+
+    units = []
+    unit_start = starts[0] if starts else 0
+    for n, start in enumerate(starts):
+        header = data.find(b'\x00\x00\x01', start) + 3
+        nal_type = data[header] & 0x1f if header < len(data) else 0
+        if nal_type in (1, 5):
+            end = starts[n + 1] if n + 1 < len(starts) else len(data)
+            units.append(data[unit_start:end])
+            unit_start = end
+    return units
+
+
+class TelloSimulator:
+    """Simulated Tello answering SDK commands on loopback.
+
+    Commands are answered from the command socket after a configurable latency,
+    a share of them is lost or answered with 'error'. Once in SDK mode the state
+    string is broadcast from the command socket, like the Tello does, and after
+    streamon an H.264 file is streamed in 1460 byte packets, looping at the end.
+    """
+
+    def __init__(self, ip='127.0.0.1', command_port=8889, state_port=8890, video_port=11111,
+                 latency=0.0, jitter=0.0, loss=0.0, error_rate=0.0, state_rate=10.0,
+                 video_path=None, video_fps=30.0, video_speed=1.0, tag_video=False, seed=None):
+        """
+        :param ip (str): Local IP address to bind.
+        :param command_port (int): Port commands are received on, 0 for any free port.
+        :param state_port (int): Port of the client the state is broadcast to.
+        :param video_port (int): Port of the client the video is streamed to.
+        :param latency (float): Seconds before a command is answered.
+        :param jitter (float): Extra random delay of up to this many seconds per reply.
+        :param loss (float): Share of commands and replies dropped, 0 to 1.
+        :param error_rate (float): Share of commands answered with 'error', 0 to 1.
+        :param state_rate (float): State broadcasts per second.
+        :param video_path (str|None): Raw H.264 file to stream, no video if None.
+        :param video_fps (float): Frame rate of the file.
+        :param video_speed (float): Playback speed, e.g. 4.0 streams four times as fast.
+        :param tag_video (bool): Put the sequence number of every access unit in the
+            stream, see tag_access_unit(), and keep its send time in video_sent_at.
+        :param seed (int|None): Seed of the random loss, error and jitter.
+        """
+        self.ip = ip
+        self.state_port = state_port
+        self.video_port = video_port
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.error_rate = error_rate
+        self.state_rate = state_rate
+        self.video_fps = video_fps
+        self.video_speed = video_speed
+        self.tag_video = tag_video
+        self.access_units = []
+        if video_path is not None:
+            with open(video_path, 'rb') as f:
+                self.access_units = split_access_units(f.read())
+
+        self.state = {'pitch': 0, 'roll': 0, 'yaw': 0, 'tof': 10, 'h': 0, 'bat': 100,
+                      'baro': 0.0, 'time': 0}
+        self.speed = 10.0
+        self.client = None  # address that entered SDK mode
+        self.streaming = False
+
+        self.received = 0
+        self.answered = 0
+        self.lost = 0
+        self.errors = 0
+        self.states_sent = 0
+        self.video_packets = 0
+        self.video_seq = 0  # access units sent
+        self.video_sent_at = {}  # seq to time.monotonic() a tagged access unit was sent
+
+        self._random = random.Random(seed)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind((ip, command_port))
+        self.command_port = self._socket.getsockname()[1]
+        self._video_socket = None
+        self._replies = []  # heap of (due, seq, reply, address)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._running = False
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self):
+        """Start answering commands, broadcasting state and streaming video."""
+        if self._running:
+            return
+        self._running = True
+        self._socket.settimeout(0.5)
+        self._video_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for target in (self._command_thread, self._reply_thread, self._state_thread,
+                       self._video_thread):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """Stop every thread and close the sockets."""
+        if not self._running:
+            return
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._socket.close()
+        self._video_socket.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def stats(self):
+        """Return the counters as a dict."""
+        return {'received': self.received, 'answered': self.answered, 'lost': self.lost,
+                'errors': self.errors, 'states_sent': self.states_sent,
+                'video_packets': self.video_packets}
+
+    def handle(self, command, address):
+        """
+        Apply a command to the simulated drone.
+
+        :param command (str): Command as received.
+        :param address (tuple): Address it came from.
+        :return (str|None): Reply, None for commands the Tello does not answer.
+        """
+        name, _, args = command.partition(' ')
+        if name == 'command':
+            self.client = address
+            return 'ok'
+        if name == 'rc':
+            return None
+        if self._random.random() < self.error_rate:
+            self.errors += 1
+            return 'error'
+        if name in _QUERIES:
+            return _QUERIES[name](self)
+        if name == 'streamon':
+            self.streaming = True
+        elif name == 'streamoff':
+            self.streaming = False
+        elif name == 'takeoff':
+            self.state['h'] = 80
+        elif name in ('land', 'emergency'):
+            self.state['h'] = 0
+        elif name == 'speed':
+            try:
+                speed = float(args)
+            except ValueError:
+                return 'error'
+            if not 10 <= speed <= 100:
+                return 'error'
+            self.speed = speed
+        elif name in _MOVES:
+            self._move(name, args)
+        elif name not in ('moff', 'mon', 'stop'):
+            return 'unknown command: {}'.format(name)
+        return 'ok'
+
+    def _move(self, name, args):
+        try:
+            value = int(args.split()[0])
+        except (IndexError, ValueError):
+            return
+        if name == 'up':
+            self.state['h'] += value
+        elif name == 'down':
+            self.state['h'] = max(0, self.state['h'] - value)
+        elif name == 'cw':
+            self.state['yaw'] = (self.state['yaw'] + value + 180) % 360 - 180
+        elif name == 'ccw':
+            self.state['yaw'] = (self.state['yaw'] - value + 180) % 360 - 180
+
+    def _command_thread(self):
+        while self._running:
+            try:
+                data, address = self._socket.recvfrom(2048)
+            except socket.timeout:
+                continue
+            except socket.error as exc:
+                if self._running:
+                    print(("Caught exception socket.error : %s" % exc))
+                continue
+
+            self.received += 1
+            if self._random.random() < self.loss:
+                self.lost += 1
+                continue
+            reply = self.handle(data.decode('utf-8', 'replace').strip(), address)
+            if reply is None:
+                continue
+            due = time.monotonic() + self.latency + self._random.random() * self.jitter
+            with self._cond:
+                heapq.heappush(self._replies, (due, next(self._seq), reply, address))
+                self._cond.notify()
+
+    def _reply_thread(self):
+        while True:
+            with self._cond:
+                if not self._running:
+                    return
+                now = time.monotonic()
+                if not self._replies or self._replies[0][0] > now:
+                    self._cond.wait(self._replies[0][0] - now if self._replies else None)
+                    continue
+                _, _, reply, address = heapq.heappop(self._replies)
+            try:
+                self._socket.sendto(reply.encode('utf-8'), address)
+                self.answered += 1
+            except OSError as exc:
+                print(("Caught exception socket.error : %s" % exc))
+
+    def _state_thread(self):
+        period = 1.0 / self.state_rate
+        started = time.monotonic()
+        next_tick = started
+        while self._running:
+            if self.client is not None:
+                self.state['time'] = int(time.monotonic() - started) if self.state['h'] else 0
+                data = STATE_FORMAT.format(**self.state).encode('ascii')
+                try:
+                    self._socket.sendto(data, (self.client[0], self.state_port))
+                    self.states_sent += 1
+                except OSError as exc:
+                    print(("Caught exception socket.error : %s" % exc))
+            next_tick = max(next_tick + period, time.monotonic())
+            time.sleep(max(0.0, next_tick - time.monotonic()))
+
+    def _video_thread(self):
+        period = 1.0 / (self.video_fps * self.video_speed)
+        frames = itertools.cycle(self.access_units) if self.access_units else None
+        next_tick = time.monotonic()
+        while self._running:
+            if frames is None or not self.streaming or self.client is None:
+                time.sleep(0.05)
+                next_tick = time.monotonic()
+                continue
+
+            access_unit = next(frames)
+            seq = self.video_seq = self.video_seq + 1
+            if self.tag_video:
+                access_unit = tag_access_unit(access_unit, seq)
+                self.video_sent_at[seq] = time.monotonic()
+                self.video_sent_at.pop(seq - _SENT_HISTORY, None)
+            address = (self.client[0], self.video_port)
+            try:
+                for start in range(0, len(access_unit), VIDEO_PACKET_SIZE):
+                    self._video_socket.sendto(access_unit[start:start + VIDEO_PACKET_SIZE], address)
+                    self.video_packets += 1
+            except OSError as exc:
+                print(("Caught exception socket.error : %s" % exc))
+            next_tick = max(next_tick + period, time.monotonic())
+            time.sleep(max(0.0, next_tick - time.monotonic()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate a Tello on the local machine.')
+    parser.add_argument('--ip', default='127.0.0.1', help='address to bind')
+    parser.add_argument('--command-port', type=int, default=8889)
+    parser.add_argument('--state-port', type=int, default=8890, help='client port for state')
+    parser.add_argument('--video-port', type=int, default=11111, help='client port for video')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before a reply')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random extra reply delay')
+    parser.add_argument('--loss', type=float, default=0.0, help='share of commands dropped')
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share answered 'error'")
+    parser.add_argument('--state-rate', type=float, default=10.0, help='states per second')
+    parser.add_argument('--video', help='raw H.264 file to stream after streamon')
+    parser.add_argument('--fps', type=float, default=30.0, help='frame rate of the file')
+    parser.add_argument('--speed', type=float, default=1.0, help='playback speed factor')
+    parser.add_argument('--seed', type=int, help='seed of loss, errors and jitter')
+    args = parser.parse_args()
+
+    sim = TelloSimulator(args.ip, args.command_port, args.state_port, args.video_port,
+                         latency=args.latency, jitter=args.jitter, loss=args.loss,
+                         error_rate=args.error_rate, state_rate=args.state_rate,
+                         video_path=args.video, video_fps=args.fps, video_speed=args.speed,
+                         seed=args.seed)
+    sim.start()
+    print("[INFO] simulating a Tello on {}:{}, {} access units of video".format(
+        args.ip, sim.command_port, len(sim.access_units)))
+    try:
+        while True:
+            time.sleep(5)
+            print("[INFO] {}".format(sim.stats()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sim.stop()
+
+
+if __name__ == '__main__':
+    main()
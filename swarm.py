@@ -0,0 +1,371 @@
+import collections
+import selectors
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from replies import CommandWaiter, ReplyMatcher, is_state_packet
+from telemetry import StateParser
+from video import PacketAssembler, decode_frames
+
+
+class SwarmDrone:
+    """Handle of one drone in a TelloSwarm.
+
+    Commands are sent on the swarm's shared command socket. Replies, state and
+    video are routed to the handle by the swarm's selector thread.
+    """
+
+    def __init__(self, swarm, name, address):
+        self.swarm = swarm
+        self.name = name
+        self.address = address  # (ip, port) the drone receives commands on
+        self.response = None  # last reply received
+        self.state = None  # STATE_DTYPE record of the last state broadcast
+        self.malformed = 0  # state packets that were not a state string
+        self.frame = None  # latest decoded frame, when the swarm decodes video
+        self.dropped = 0  # access units dropped because decoding fell behind
+
+        self._replies = ReplyMatcher()
+        self._state_parser = StateParser(1)  # every state is published as a copy of its record
+        self._assembler = PacketAssembler(end_packet_size=1460)
+        self._access_units = collections.deque()  # taken from the assembler, not copied
+        self._queue_size = 64  # access units waiting for the decoder before dropping
+        self._skipping = False  # dropping until the next keyframe
+        self._decoder = None
+        self._decoding = False
+        self._decode_lock = threading.Lock()
+
+    def __repr__(self):
+        return 'SwarmDrone({!r}, {}:{})'.format(self.name, *self.address)
+
+    def send(self, command):
+        """
+        Send a command without waiting for the reply.
+
+        :param command (str): Command to send.
+        :return (CommandWaiter): Waiter that receives the reply.
+        """
+        waiter = CommandWaiter(command)
+        self._replies.register(waiter)
+        self.swarm._send(command, self.address)
+        return waiter
+
+    def send_command(self, command, timeout=None):
+        """
+        Send a command and wait for the reply.
+
+        :param command (str): Command to send.
+        :param timeout (float|None): Seconds to wait, the swarm's command_timeout if None.
+        :return (str): Response from the drone, 'timeout' if none arrived.
+        """
+        return self.result(self.send(command), timeout)
+
+    def result(self, waiter, timeout=None):
+        """
+        Wait for the reply of a command sent with send().
+
+        :param waiter (CommandWaiter): Waiter returned by send().
+        :param timeout (float|None): Seconds to wait, the swarm's command_timeout if None.
+        :return (str): Response from the drone, 'timeout' if none arrived.
+        """
+        timeout = self.swarm.command_timeout if timeout is None else timeout
+        if not waiter.wait(timeout):
+            # callers pass what is left of a shared deadline, often nothing by now, the
+            # reply may still come as late as for any other command
+            self._replies.expire(waiter, self.swarm.command_timeout)
+        if waiter.response is None:
+            return 'timeout'
+        return waiter.response.decode('latin-1')
+
+    @property
+    def idle(self):
+        """True if no command of this drone is waiting for a reply."""
+        return len(self._replies) == 0
+
+    def _on_reply(self, data):
+        self.response = data
+        self._replies.dispatch(data)
+
+    def _on_state(self, data):
+        try:
+            self.state = self._state_parser.parse(data, time.time()).copy()
+        except (ValueError, UnicodeDecodeError):
+            self.malformed += 1
+
+    def _on_video(self, data):
+        access_unit = self._assembler.feed(data)
+        while access_unit is not None:
+            if self._queue_access_unit(self._assembler.take(), self._assembler.keyframe):
+                self.swarm._schedule_decode(self)
+            access_unit = self._assembler.feed(None) if self._assembler.pending else None
+
+    def _queue_access_unit(self, access_unit, keyframe):
+        """Queue an access unit for decoding, return whether it was queued."""
+        with self._decode_lock:
+            if self._skipping:
+                if not keyframe:
+                    self.dropped += 1
+                    self._assembler.recycle(access_unit)
+                    return False
+                self._skipping = False
+            if len(self._access_units) >= self._queue_size:
+                # decoding fell behind, queued frames are only useful up to the next keyframe
+                self.dropped += len(self._access_units)
+                while self._access_units:
+                    self._assembler.recycle(self._access_units.popleft())
+                if not keyframe:
+                    self.dropped += 1
+                    self._assembler.recycle(access_unit)
+                    self._skipping = True
+                    return False
+            self._access_units.append(access_unit)
+            return True
+
+    def _decode_pending(self):
+        """Decode every queued access unit, runs on a swarm decode worker."""
+        while True:
+            with self._decode_lock:
+                if not self._access_units:
+                    self._decoding = False
+                    return
+                access_unit = self._access_units.popleft()
+            for frame in self.swarm._decode(self, access_unit):
+                self.frame = frame
+            self._assembler.recycle(access_unit)
+
+
+class TelloSwarm:
+    """Drives many Tello drones from one selector thread.
+
+    The command, state and video sockets are shared by all drones and multiplexed
+    on a single selectors loop, which routes each datagram to the drone it came
+    from by source address. Callers block on their own command replies, so the
+    number of threads does not grow with the number of drones: one selector
+    thread plus, when video is enabled, a fixed pool of decode workers.
+    """
+
+    def __init__(self, local_ip='', command_port=8889, state_port=8890, video_port=None,
+                 command_timeout=5.0, decode_workers=2):
+        """
+        :param local_ip (str): Local IP address to bind.
+        :param command_port (int): Local port of the shared command socket.
+        :param state_port (int|None): Local port of the state broadcast, None to ignore it.
+        :param video_port (int|None): Local port of the video stream, None to ignore it.
+        :param command_timeout (int|float): Number of seconds to wait for a response to a command.
+        :param decode_workers (int): Threads decoding video, shared by all drones.
+        """
+        self.local_ip = local_ip
+        self.command_timeout = command_timeout
+        self.drones = collections.OrderedDict()  # name -> SwarmDrone
+
+        self._by_address = {}  # (ip, port) -> SwarmDrone
+        self._by_ip = {}  # ip -> SwarmDrone, for state and video sent from other ports
+        self._ports = {'command': command_port, 'state': state_port, 'video': video_port}
+        self._sockets = {}
+        self._selector = None
+        self._thread = None
+        self._running = False
+        self._decoders = None
+        self.decode_workers = decode_workers
+
+    def add(self, tello_ip, tello_port=8889, name=None):
+        """
+        Add a drone to the swarm.
+
+        :param tello_ip (str): IP of the drone.
+        :param tello_port (int): Port the drone receives commands on.
+        :param name (str|None): Name of the handle, 'ip:port' if None.
+        :return (SwarmDrone): Handle of the drone.
+        """
+        address = (socket.gethostbyname(tello_ip), tello_port)
+        name = name if name is not None else '{}:{}'.format(*address)
+        drone = SwarmDrone(self, name, address)
+        self.drones[name] = drone
+        self._by_address[address] = drone
+        # several drones on one IP (e.g. local stand-ins) can only be told apart by port
+        self._by_ip[address[0]] = None if address[0] in self._by_ip else drone
+        return drone
+
+    def __getitem__(self, name):
+        return self.drones[name]
+
+    def __iter__(self):
+        return iter(self.drones.values())
+
+    def __len__(self):
+        return len(self.drones)
+
+    def start(self):
+        """Bind the shared sockets and start the selector thread."""
+        if self._running:
+            return
+        self._selector = selectors.DefaultSelector()
+        handlers = {'command': SwarmDrone._on_reply, 'state': SwarmDrone._on_state,
+                    'video': SwarmDrone._on_video}
+        for kind, port in self._ports.items():
+            if port is None:
+                continue
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind((self.local_ip, port))
+            sock.setblocking(False)
+            self._sockets[kind] = sock
+            self._selector.register(sock, selectors.EVENT_READ, handlers[kind])
+
+        if 'video' in self._sockets:
+            self._decoders = ThreadPoolExecutor(max_workers=self.decode_workers)
+
+        self._running = True
+        self._thread = threading.Thread(target=self._selector_thread)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the selector thread, release pending commands and close the sockets."""
+        if not self._running:
+            return
+        self._running = False
+        self._thread.join()
+        self._thread = None
+        for drone in self:
+            drone._replies.cancel_all()
+        if self._decoders is not None:
+            self._decoders.shutdown(wait=True)
+            self._decoders = None
+        for sock in self._sockets.values():
+            self._selector.unregister(sock)
+            sock.close()
+        self._sockets = {}
+        self._selector.close()
+        self._selector = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def broadcast(self, command, timeout=None):
+        """
+        Send a command to every drone and wait for all replies.
+
+        The command is sent to all drones before any reply is awaited, so the
+        total wait is one round trip rather than one per drone.
+
+        :param command (str): Command to send.
+        :param timeout (float|None): Seconds to wait, the swarm's command_timeout if None.
+        :return (dict): Drone name to response, 'timeout' if none arrived.
+        """
+        waiters = [(drone, drone.send(command)) for drone in self]
+        timeout = self.command_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        return collections.OrderedDict(
+            (drone.name, drone.result(waiter, max(0.0, deadline - time.monotonic())))
+            for drone, waiter in waiters)
+
+    def wait_all_ready(self, command='command', timeout=None, retry=0.5):
+        """
+        Barrier: put every drone into command mode and wait until all of them answered ok.
+
+        Drones that did not answer are asked again every retry seconds until the
+        deadline expires.
+
+        :param command (str): Command every drone has to acknowledge.
+        :param timeout (float|None): Overall seconds to wait, the swarm's command_timeout if None.
+        :param retry (float): Seconds between attempts for drones that did not answer,
+            longer than a round trip, as a reply arriving later is dropped.
+        :return (list): Names of the drones that are not ready, empty if all are.
+        """
+        timeout = self.command_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        pending = list(self)
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            attempt_deadline = time.monotonic() + min(retry, remaining)
+            # a drone still owing the reply of a timed out attempt is asked again once
+            # that reply arrived or stopped being expected, so sending never blocks here
+            waiters = [(drone, drone.send(command)) for drone in pending
+                       if drone._replies.owed_until() is None]
+            ready = [drone for drone, waiter in waiters
+                     if drone.result(waiter, max(0.0, attempt_deadline - time.monotonic())) == 'ok']
+            if not waiters:
+                time.sleep(max(0.0, attempt_deadline - time.monotonic()))
+            pending = [drone for drone in pending if drone not in ready]
+        return [drone.name for drone in pending]
+
+    def sync(self, timeout=None):
+        """
+        Barrier: wait until no drone has a command waiting for its reply.
+
+        :param timeout (float|None): Seconds to wait, None waits forever.
+        :return (bool): True if all drones became idle in time.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not all(drone.idle for drone in self):
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def _send(self, command, address):
+        self._sockets['command'].sendto(command.encode('utf-8'), address)
+
+    def _route(self, address):
+        drone = self._by_address.get(address)
+        if drone is None:
+            drone = self._by_ip.get(address[0])
+        return drone
+
+    def _selector_thread(self):
+        """
+        Wait on all shared sockets and route every datagram to its drone.
+
+        Runs as a thread. A ready socket is drained before waiting again.
+
+        """
+        while self._running:
+            for key, _ in self._selector.select(timeout=0.1):
+                handler = key.data
+                while True:
+                    try:
+                        data, address = key.fileobj.recvfrom(2048)
+                    except (BlockingIOError, InterruptedError):
+                        break
+                    except socket.error as exc:
+                        print(("Caught exception socket.error : %s" % exc))
+                        break
+                    drone = self._route(address)
+                    if drone is None:
+                        continue
+                    if handler is SwarmDrone._on_reply and is_state_packet(data):
+                        # state sent to the command port, e.g. by old firmware
+                        drone._on_state(data)
+                    else:
+                        handler(drone, data)
+
+    def _schedule_decode(self, drone):
+        with drone._decode_lock:
+            if drone._decoding:
+                return
+            drone._decoding = True
+        self._decoders.submit(drone._decode_pending)
+
+    def _decode(self, drone, access_unit):
+        """
+        decode one access unit of a drone
+
+        :param access_unit: raw h264 data of one frame
+
+        :return: a list of decoded frame
+        """
+        if drone._decoder is None:
+            # imported here, so commanding a swarm works without the extension
+            import libh264decoder
+
+            # access units are split before decoding, the parser need not wait for the next one
+            drone._decoder = libh264decoder.H264Decoder(complete_frames=True)
+        return decode_frames(drone._decoder, access_unit)
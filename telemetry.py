@@ -0,0 +1,270 @@
+import socket
+import threading
+import time
+import numpy as np
+
+# One parsed state broadcast. Field order follows the SDK 2.0 state string.
+STATE_DTYPE = np.dtype([
+    ('timestamp', 'f8'),
+    ('mid', 'i2'), ('x', 'i2'), ('y', 'i2'), ('z', 'i2'), ('mpry', 'i2', (3,)),
+    ('pitch', 'i2'), ('roll', 'i2'), ('yaw', 'i2'),
+    ('vgx', 'i2'), ('vgy', 'i2'), ('vgz', 'i2'),
+    ('templ', 'i2'), ('temph', 'i2'), ('tof', 'i4'), ('h', 'i2'), ('bat', 'i2'),
+    ('baro', 'f4'), ('time', 'i4'),
+    ('agx', 'f4'), ('agy', 'f4'), ('agz', 'f4'),
+])
+
+# Number of values in a SDK 2.0 state string (mpry counts three) and in a SDK 1.3
+# one, which has no mission pad fields.
+_VALUES_SDK20 = 23
+_VALUES_SDK13 = 16
+# Mission pad values reported by SDK 2.0 when no pad is detected, used to fill
+# SDK 1.3 states.
+_NO_PAD = ['-1', '-100', '-100', '-100', '-1', '-1', '-1']
+
+# Turn everything but numbers into whitespace: keys, ':', ';', ',' and line ends.
+_NUMBERS_ONLY = bytes(c if chr(c) in '0123456789.-' else ord(' ') for c in range(256))
+
+
+def parse_state(data, timestamp=None):
+    """
+    Parse a state broadcast of the form 'key:value;key:value;...'.
+
+    Integer and float values are converted, anything else (e.g. 'mpry:0,0,0') is
+    kept as a string.
+
+    :param data (bytes): State datagram from the Tello.
+    :param timestamp (float|None): Receive time, now if None.
+    :return (dict): Field name to value, plus 'timestamp'.
+    """
+    state = {'timestamp': time.time() if timestamp is None else timestamp}
+    for field in data.decode('latin-1').strip().split(';'):
+        key, sep, value = field.partition(':')
+        if not sep:
+            continue
+        try:
+            state[key] = float(value) if '.' in value else int(value)
+        except ValueError:
+            state[key] = value
+    return state
+
+
+def _state_values(data):
+    """Return the numeric fields of one state string as a list of 23 strings."""
+    values = data.translate(_NUMBERS_ONLY).decode('ascii').split()
+    if len(values) == _VALUES_SDK13:
+        values = _NO_PAD + values
+    elif len(values) != _VALUES_SDK20:
+        raise ValueError('unexpected state string: {}'.format(data))
+    return values
+
+
+class StateParser:
+    """Parses state broadcasts straight into a preallocated STATE_DTYPE record buffer.
+
+    Unlike parse_state() no dict is built per packet: the string is split once and
+    the values are written into the next slot of `records`, which is reused as a
+    ring once it is full.
+    """
+
+    def __init__(self, capacity=1024):
+        """
+        :param capacity (int): Number of records in the buffer.
+        """
+        self.records = np.zeros(capacity, dtype=STATE_DTYPE)
+        self.count = 0  # number of states parsed so far
+
+    def parse(self, data, timestamp=None):
+        """
+        Parse one state string into the next record of the buffer.
+
+        :param data (bytes): State datagram from the Tello.
+        :param timestamp (float|None): Receive time, now if None.
+        :return (numpy.void): The record, a view that is overwritten once the ring wraps.
+        """
+        v = _state_values(data)
+        index = self.count % len(self.records)
+        self.records[index] = (time.time() if timestamp is None else timestamp,
+                               v[0], v[1], v[2], v[3], v[4:7], *v[7:])
+        self.count += 1
+        return self.records[index]
+
+    def recent(self, n=None):
+        """
+        Return a copy of up to n of the most recent records, oldest first.
+
+        :param n (int|None): Number of records, the whole buffer if None.
+        :return (numpy.ndarray): STATE_DTYPE array.
+        """
+        size = len(self.records)
+        n = min(self.count, size) if n is None else min(n, self.count, size)
+        end = self.count % size
+        if n <= end:
+            return self.records[end - n:end].copy()
+        return np.concatenate((self.records[size - (n - end):], self.records[:end]))
+
+
+def parse_log(data, timestamps=None):
+    """
+    Parse a capture of many state strings in one vectorized pass.
+
+    All states of a capture must come from the same firmware, i.e. have the same
+    fields.
+
+    :param data (bytes|iterable): Newline separated state strings, or an iterable of them.
+    :param timestamps (array_like|None): Receive time of each state, NaN if None.
+    :return (numpy.ndarray): STATE_DTYPE array with one record per state.
+    """
+    if not isinstance(data, (bytes, bytearray)):
+        data = b'\n'.join(data)
+    first = data[:data.find(b'\n')] if b'\n' in data else data
+    per_line = len(first.translate(_NUMBERS_ONLY).split())
+    if per_line not in (_VALUES_SDK20, _VALUES_SDK13):
+        raise ValueError('unexpected state string: {}'.format(first))
+
+    values = np.array(data.translate(_NUMBERS_ONLY).split(), dtype=np.float64)
+    if values.size % per_line:
+        raise ValueError('states in the capture do not have the same fields')
+    values = values.reshape(-1, per_line)
+    if per_line == _VALUES_SDK13:
+        pad = np.array(_NO_PAD, dtype=np.float64)
+        values = np.hstack((np.broadcast_to(pad, (len(values), len(pad))), values))
+
+    records = np.empty(len(values), dtype=STATE_DTYPE)
+    records['timestamp'] = np.nan if timestamps is None else timestamps
+    column = 0
+    for name in STATE_DTYPE.names[1:]:
+        shape = STATE_DTYPE[name].shape
+        width = shape[0] if shape else 1
+        if shape:
+            records[name] = values[:, column:column + width]
+        else:
+            records[name] = values[:, column]
+        column += width
+    return records
+
+
+class TelemetryReceiver:
+    """Receives the Tello state broadcast on its own socket and thread.
+
+    Each packet is parsed once by a StateParser, straight into its ring of STATE_DTYPE
+    records, without building a dict. The newest state is published as `latest`, a
+    copy of its record whose fields read like a mapping's, e.g. latest['bat'].
+    Publishing only rebinds a reference, so any number of threads can read the
+    state without taking a lock.
+    """
+
+    def __init__(self, local_ip='', local_port=8890, history=256):
+        """
+        :param local_ip (str): Local IP address to bind.
+        :param local_port (int): Local port the Tello broadcasts its state to.
+        :param history (int): Number of states kept in the ring.
+        """
+        self.local_ip = local_ip
+        self.local_port = local_port
+        self.latest = None  # STATE_DTYPE record of the newest state, None before the first packet
+        self.seq = 0  # number of states received so far
+        self.malformed = 0  # packets that were not a state string
+        self.subscribers = ()  # callbacks, replaced rather than mutated so the receiver needs no lock
+        self._subscribers_lock = threading.Lock()
+
+        # one spare slot, the one the receive thread writes next
+        self.parser = StateParser(history + 1)
+        self._socket = None
+        self._thread = None
+        self._running = False
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self):
+        """Bind the state socket and start the receive thread."""
+        if self._running:
+            return
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind((self.local_ip, self.local_port))
+        # wake up regularly so stop() does not hang on a silent drone
+        self._socket.settimeout(0.5)
+
+        self._running = True
+        self._thread = threading.Thread(target=self._receive_thread)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the receive thread and close the socket."""
+        if not self._running:
+            return
+        self._running = False
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+        self._socket.close()
+        self._socket = None
+
+    def subscribe(self, callback):
+        """
+        Call callback(state) on the receive thread for every new state.
+
+        Callbacks must return quickly, e.g. by handing the state to a queue.
+
+        :param callback (callable): Function taking the state mapping.
+        """
+        with self._subscribers_lock:
+            self.subscribers = self.subscribers + (callback,)
+
+    def unsubscribe(self, callback):
+        """Stop calling a callback registered with subscribe()."""
+        with self._subscribers_lock:
+            self.subscribers = tuple(c for c in self.subscribers if c != callback)
+
+    def history(self, n=None):
+        """
+        Return up to n of the most recent states, oldest first.
+
+        States overwritten by the receive thread while copying are left out.
+
+        :param n (int|None): Number of states, the whole ring if None.
+        :return (numpy.ndarray): STATE_DTYPE array.
+        """
+        records = self.parser.records
+        size = len(records)
+        end = self.parser.count
+        n = size - 1 if n is None else min(n, size - 1)
+        n = min(n, end)
+        states = records[np.arange(end - n, end) % size]
+        # every state parsed meanwhile may have overwritten the oldest one copied
+        return states[min(n, self.parser.count - end):]
+
+    def _publish(self, data, timestamp):
+        try:
+            state = self.parser.parse(data, timestamp).copy()
+        except (ValueError, UnicodeDecodeError):
+            self.malformed += 1
+            return
+        self.latest = state
+        self.seq += 1
+        for callback in self.subscribers:
+            try:
+                callback(state)
+            except Exception as exc:
+                print("[INFO] telemetry subscriber failed: {}".format(exc))
+
+    def _receive_thread(self):
+        """
+        Listen to state broadcasts from the Tello.
+
+        Runs as a thread, publishes every received state.
+
+        """
+        while self._running:
+            try:
+                data, ip = self._socket.recvfrom(2048)
+            except socket.timeout:
+                continue
+            except socket.error as exc:
+                if self._running:
+                    print(("Caught exception socket.error : %s" % exc))
+                continue
+            self._publish(data, time.time())
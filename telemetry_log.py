@@ -0,0 +1,267 @@
+import csv
+import json
+import struct
+import numpy as np
+
+from telemetry import STATE_DTYPE
+
+MAGIC = b'TELLOCOL'
+VERSION = 1
+CHUNK_MAGIC = b'CHNK'
+_ALIGN = 8
+
+
+def _pad(size):
+    return -size % _ALIGN
+
+
+def na_value(dtype):
+    """Return the value that marks a missing entry in a field of the given dtype."""
+    if dtype.kind == 'f':
+        return np.nan
+    return np.iinfo(dtype).min
+
+
+def is_na(column):
+    """Return a boolean mask of the missing entries of a column."""
+    if column.dtype.kind == 'f':
+        return np.isnan(column)
+    return column == np.iinfo(column.dtype).min
+
+
+def record_from_state(state, dtype=STATE_DTYPE):
+    """
+    Convert a state mapping into a record tuple of the given dtype.
+
+    Accepts both parsed states (see telemetry.parse_state) and DataLogger CSV rows,
+    where every value is a string and missing ones are 'NA'.
+
+    :param state (Mapping): Field name to value.
+    :param dtype (numpy.dtype): Structured dtype of the record.
+    :return (tuple): Values in field order.
+    """
+    record = []
+    for name in dtype.names:
+        field = dtype[name]
+        value = state.get(name, 'NA')
+        if field.shape:
+            base = field.base
+            if value == 'NA':
+                value = [na_value(base)] * field.shape[0]
+            else:
+                value = [base.type(v) for v in str(value).split(',')]
+        elif value == 'NA':
+            value = na_value(field)
+        record.append(value)
+    return tuple(record)
+
+
+class ColumnarLogWriter:
+    """Appends records to a columnar log, buffering them into chunks.
+
+    A log file starts with a header describing the record dtype, followed by chunks
+    of rows. Every chunk stores each field as one contiguous block, so a reader gets
+    a field as a memory mapped view per chunk instead of parsing text:
+
+        header  b'TELLOCOL' | u4 version | u4 length | JSON dtype, padded to 8 bytes
+        chunk   b'CHNK' | u4 rows | one block per field, each padded to 8 bytes
+
+    Missing values, written as 'NA' by the CSV logger, are stored as NaN in float
+    fields and as the smallest representable value in integer fields.
+    """
+
+    def __init__(self, path, dtype=STATE_DTYPE, chunk_rows=1024):
+        """
+        :param path (str): File to create.
+        :param dtype (numpy.dtype): Structured dtype of the records.
+        :param chunk_rows (int): Rows buffered before a chunk is written.
+        """
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.rows = 0  # rows written to the file so far
+
+        self._buffer = np.empty(chunk_rows, dtype=self.dtype)
+        self._buffered = 0
+        self._file = open(path, 'wb')
+        self._write_header()
+
+    def _write_header(self):
+        fields = [[name, self.dtype[name].base.str, list(self.dtype[name].shape)]
+                  for name in self.dtype.names]
+        header = json.dumps({'fields': fields}).encode('utf-8')
+        header += b' ' * _pad(len(MAGIC) + 8 + len(header))
+        self._file.write(MAGIC + struct.pack('<II', VERSION, len(header)) + header)
+
+    def append(self, record):
+        """
+        Append one record.
+
+        :param record (tuple|numpy.void): Values in field order.
+        """
+        self._buffer[self._buffered] = record
+        self._buffered += 1
+        if self._buffered == len(self._buffer):
+            self.flush_chunk()
+
+    def extend(self, records):
+        """
+        Append many records at once.
+
+        :param records (numpy.ndarray): Array of the writer's dtype.
+        """
+        self.flush_chunk()
+        for start in range(0, len(records), len(self._buffer)):
+            self._write_chunk(records[start:start + len(self._buffer)])
+
+    def flush_chunk(self):
+        """Write the buffered records as a chunk, even if it is not full."""
+        if self._buffered:
+            self._write_chunk(self._buffer[:self._buffered])
+            self._buffered = 0
+
+    def flush(self):
+        """
+        Hand the chunks written so far to the OS, like a file's flush().
+
+        Buffered records stay in the buffer until their chunk is full, so flushing
+        often for durability does not split the log into small chunks.
+        """
+        self._file.flush()
+
+    def _write_chunk(self, records):
+        self._file.write(CHUNK_MAGIC + struct.pack('<I', len(records)))
+        for name in self.dtype.names:
+            column = np.ascontiguousarray(records[name]).tobytes()
+            self._file.write(column + b'\0' * _pad(len(column)))
+        self.rows += len(records)
+
+    def close(self):
+        self.flush_chunk()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class ColumnarLogReader:
+    """Memory maps a columnar log and returns its fields as NumPy arrays."""
+
+    def __init__(self, path):
+        """
+        :param path (str): Log file to read.
+        """
+        self.path = path
+        self._map = np.memmap(path, dtype=np.uint8, mode='r')
+
+        if bytes(self._map[:len(MAGIC)]) != MAGIC:
+            raise ValueError('{} is not a columnar telemetry log'.format(path))
+        version, length = struct.unpack_from('<II', self._map, len(MAGIC))
+        if version != VERSION:
+            raise ValueError('unsupported log version {}'.format(version))
+        offset = len(MAGIC) + 8
+        header = json.loads(bytes(self._map[offset:offset + length]).decode('utf-8'))
+        self.dtype = np.dtype([(name, base, tuple(shape)) for name, base, shape in header['fields']])
+
+        # index of (rows, {field: offset}) per chunk
+        self.chunks = []
+        offset += length
+        while offset < len(self._map):
+            if bytes(self._map[offset:offset + 4]) != CHUNK_MAGIC:
+                raise ValueError('corrupt chunk at offset {}'.format(offset))
+            rows, = struct.unpack_from('<I', self._map, offset + 4)
+            offset += 8
+            columns = {}
+            for name in self.dtype.names:
+                columns[name] = offset
+                size = rows * self.dtype[name].itemsize
+                offset += size + _pad(size)
+            self.chunks.append((rows, columns))
+
+    def __len__(self):
+        return sum(rows for rows, _ in self.chunks)
+
+    @property
+    def fields(self):
+        return self.dtype.names
+
+    def column(self, name):
+        """
+        Return all values of a field.
+
+        A log with a single chunk is returned as a read-only view on the mapped
+        file, otherwise the chunks are concatenated.
+
+        :param name (str): Field name.
+        :return (numpy.ndarray): Values, shape (rows,) + field shape.
+        """
+        field = self.dtype[name]
+        width = int(np.prod(field.shape))
+        parts = [np.frombuffer(self._map, dtype=field.base, count=rows * width,
+                               offset=columns[name]).reshape((rows,) + field.shape)
+                 for rows, columns in self.chunks]
+        if not parts:
+            return np.empty((0,) + field.shape, dtype=field.base)
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts)
+
+    def __getitem__(self, name):
+        return self.column(name)
+
+    def records(self):
+        """Return the whole log as one structured array."""
+        out = np.empty(len(self), dtype=self.dtype)
+        for name in self.dtype.names:
+            out[name] = self.column(name)
+        return out
+
+
+def csv_to_columnar(csv_path, log_path, dtype=STATE_DTYPE):
+    """
+    Convert a DataLogger CSV file to a columnar log.
+
+    :param csv_path (str): CSV file written by DataLogger.
+    :param log_path (str): Columnar log to create.
+    :return (int): Number of rows converted.
+    """
+    rows = 0
+    with open(csv_path, newline='') as f, ColumnarLogWriter(log_path, dtype) as writer:
+        for row in csv.DictReader(f):
+            writer.append(record_from_state(row, writer.dtype))
+            rows += 1
+    return rows
+
+
+def columnar_to_csv(log_path, csv_path):
+    """
+    Convert a columnar log to a DataLogger compatible CSV file.
+
+    :param log_path (str): Columnar log to read.
+    :param csv_path (str): CSV file to create.
+    :return (int): Number of rows converted.
+    """
+    reader = ColumnarLogReader(log_path)
+    columns = {}
+    for name in reader.fields:
+        column = reader.column(name)
+        if column.ndim > 1:
+            text = [','.join(row) for row in column.astype(str).tolist()]
+            missing = is_na(column).all(axis=1)
+        else:
+            # astype(str) keeps the shortest repr of float32 values, e.g. 12.34
+            text = column.astype(str).tolist()
+            missing = is_na(column)
+        for i in np.flatnonzero(missing):
+            text[i] = 'NA'
+        columns[name] = text
+
+    with open(csv_path, 'w', newline='') as f:
+        # same columns as the DataLogger CSV, whose field names the dtype mirrors
+        writer = csv.DictWriter(f, fieldnames=reader.fields)
+        writer.writeheader()
+        for i in range(len(reader)):
+            writer.writerow({name: text[i] for name, text in columns.items()})
+    return len(reader)
@@ -1,8 +1,13 @@
 import socket
 import threading
 import time
-import numpy as np
-import libh264decoder
+
+from rc_stream import RCStreamer
+from replies import (HANDSHAKE, CommandWaiter, ReplyMatcher, TelloConnectionError,
+                     is_state_packet, parse_sdk_version)
+from scheduler import CommandScheduler
+from telemetry import TelemetryReceiver
+from video import VideoStream
 
 # TODO: check out of range values and throw exceptions accordingly
 
@@ -10,7 +15,8 @@ class Tello:
     """Wrapper class to interact with the Tello drone."""
 
     def __init__(self, local_ip, local_port, command_timeout=.3, tello_ip='192.168.10.1',
-                 tello_port=8889):
+                 tello_port=8889, command_rate=10.0, command_burst=5, state_port=8890,
+                 decoder_threads=1, decoder_thread_type='slice', low_latency_video=False):
         """
         Binds to the local IP/port and puts the Tello into command mode.
 
@@ -19,90 +25,243 @@ class Tello:
         :param command_timeout (int|float): Number of seconds to wait for a response to a command.
         :param tello_ip (str): Tello IP.
         :param tello_port (int): Tello port.
+        :param command_rate (float): Commands per second the scheduler sends on average.
+        :param command_burst (int): Commands the scheduler may send back to back.
+        :param state_port (int|None): Local port of the state broadcast, None to ignore it.
+        :param decoder_threads (int): Video decoding threads, 0 for one per core.
+        :param decoder_thread_type (str): 'slice' or 'frame', see VideoStream. Frame
+            threading adds decoder_threads - 1 frames of latency to the live view.
+        :param low_latency_video (bool): Show the newest frame rather than every frame
+            when decoding falls behind, see VideoStream.
         """
 
         self.abort_flag = False
-        self.decoder = libh264decoder.H264Decoder()
+        self.connected = False
+        self.socket = None
         self.command_timeout = command_timeout
-        self.response = None  
-        self.frame = None  # numpy array BGR -- current camera output frame
+        self.response = None  # last datagram received on the command socket
+        self._replies = ReplyMatcher()  # commands waiting for a reply
         self.is_freeze = False  # freeze current camera output
         self.last_frame = None
+        self._frozen_frames = {}  # frame of every output when video_freeze() was called
         self.local_ip = local_ip
         self.local_port = local_port
         self.tello_address = (tello_ip, tello_port)
         self.local_video_port = 11111  # port for receiving video stream
+        # started by the first frame consumer
+        self.video = VideoStream(self, self.local_video_port, thread_count=decoder_threads,
+                                 thread_type=decoder_thread_type, low_latency=low_latency_video)
+        self._implicit_video = False  # read() subscribed on behalf of the caller
         self.last_height = 0
         self.sdk = 0.0
+        self.scheduler = CommandScheduler(self, rate=command_rate, burst=command_burst)
+        self.rc_stream = None
+        self.telemetry = None
+        if state_port is not None:
+            self.telemetry = TelemetryReceiver(local_ip, state_port)
         
     def __del__(self):
         self.disconnect()
 
-    def connect(self, streamon=True):
+    def connect(self, streamon=False, timeout=10.0):
+        """
+        Binds the sockets and puts the Tello into command mode.
+
+        The handshake (command, moff, sdk?, streamoff) moves on as soon as each step is
+        acknowledged. Every step is retransmitted with exponential backoff until it is
+        answered, which is safe because all of them are idempotent.
+
+        Video is not received until a consumer calls subscribe_video() or read().
+
+        :param streamon (bool): Subscribe to the video right away, e.g. for a live view.
+        :param timeout (int|float): Seconds the whole handshake may take.
+        :raises TelloConnectionError: If a step is not acknowledged before the deadline.
+        """
         self.connected = True
 
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # socket for sending cmd
-        self.socket_video = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # socket for receiving video stream
         self.socket.bind((self.local_ip, self.local_port))
 
+        # state broadcast has its own socket, the command socket only sees acks
+        if self.telemetry is not None:
+            self.telemetry.start()
+
         # thread for receiving cmd ack
         self.receive_thread = threading.Thread(target=self._receive_thread)
         self.receive_thread.daemon = True
 
         self.receive_thread.start()
 
-        # to receive video -- send cmd: command, streamon
-        self.socket.sendto(b'command', self.tello_address)
-        print ('sent: command')
-       
-        # TODO 
-        time.sleep(5)
-        
-        self.socket.sendto(b'moff', self.tello_address)
-        print('sent: moff')
+        deadline = time.monotonic() + timeout
+        try:
+            for command, require_ok in HANDSHAKE:
+                response = self._handshake(command, deadline, require_ok)
+                if command == 'sdk?':
+                    self.sdk = parse_sdk_version(response)
+                    print("[INFO] Tello SDK version: {}".format(self.sdk))
+        except TelloConnectionError as exc:
+            print("[INFO] {}".format(exc))
+            self._close()
+            raise
+
+        # every command from here on goes through the scheduler thread
+        self.scheduler.start()
 
-        # check sdk version
-        self.sdk = self.get_sdk_version()
-        print("[INFO] Tello SDK version: {}".format(self.sdk))
-        
         if streamon:
-            self.socket.sendto(b'streamon', self.tello_address)
-            print ('sent: streamon')
+            self.subscribe_video()
+
+    def _handshake(self, command, deadline, require_ok=True, backoff=0.1, max_backoff=1.0):
+        """
+        Send a handshake command until it is answered or the deadline passes.
 
-        self.socket_video.bind(("0.0.0.0", self.local_video_port))
+        Retransmissions reuse the same waiter, so the first reply to any copy
+        completes the step. Every copy is answered, so the replies still owed to the
+        other copies are expected for up to max_backoff and the next step is only
+        sent once they arrived or that window closed, see ReplyMatcher.
 
-        # thread for receiving video
-        self.receive_video_thread = threading.Thread(target=self._receive_video_thread)
-        self.receive_video_thread.daemon = True
+        :param command (str): Command to send.
+        :param deadline (float): time.monotonic() value after which to give up.
+        :param require_ok (bool): Only accept 'ok' as the answer.
+        :param backoff (float): Seconds to wait for the first answer, doubled after every retry.
+        :param max_backoff (float): Longest wait for a single attempt.
+        :return (str): Response from Tello.
+        :raises TelloConnectionError: If no acceptable answer arrives in time.
+        """
+        response = 'timeout'
+        while True:
+            waiter = self._transmit(command)
+            print('sent: {}'.format(command))
+            copies = 1
+            while not waiter.wait(max(0.0, min(backoff, deadline - time.monotonic()))):
+                if time.monotonic() >= deadline:
+                    self._replies.expire(waiter, max_backoff)
+                    self._replies.expect_late(command, copies - 1, max_backoff)
+                    raise TelloConnectionError(command, response)
+                self._send_only(command)
+                print('resent: {}'.format(command))
+                copies += 1
+                backoff = min(backoff * 2, max_backoff)
+
+            # one copy was answered, drop the replies to the others
+            self._replies.expect_late(command, copies - 1, max_backoff)
+            if waiter.response is None:
+                raise TelloConnectionError(command, response)
+
+            response = waiter.response.decode('latin-1').strip()
+            if not require_ok or response == 'ok':
+                return response
+
+            # refused, e.g. 'error' while the Tello is busy -- ask again
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TelloConnectionError(command, response)
+            time.sleep(min(backoff, remaining))
+            backoff = min(backoff * 2, max_backoff)
+
+    def _close(self):
+        """Close the sockets and stop every thread without talking to the Tello."""
+        self.scheduler.stop()
+        self.set_abort_flag()
+        self.connected = False
+        self.video.close(streamoff=False)
+        self._implicit_video = False
 
-        self.receive_video_thread.start()
+        if self.socket is not None:
+            self.socket.close()
+        if self.telemetry is not None:
+            self.telemetry.stop()
 
+        self.socket = None
 
     def disconnect(self):
         if self.socket is not None:
+            self.stop_rc_stream()
             self.land()
-            self.set_abort_flag()
-            self.socket.close()
+            self.video.close()
 
-        if self.socket_video is not None:
-            self.socket_video.close()
+        self._close()
 
-        self.connected = False
-        self.socket = None
-        self.socket_video = None
-    
-    def read(self):
-        """Return the last frame from camera."""
+    @property
+    def frame(self):
+        """numpy array RGB -- current camera output frame, None while no one consumes video"""
+        return self.video.frame
+
+    def subscribe_video(self, output=None):
+        """Start consuming frames, the first consumer starts the video stream.
+
+        Every call must be paired with unsubscribe_video(). Frames are then available
+        from read() once the first keyframe has been decoded. A consumer that wants
+        grayscale, BGR for OpenCV or a smaller image asks the decoder for it, rather
+        than converting every RGB frame itself:
+
+            preview = OutputSpec('bgr24', size=(320, 240))
+            tello.subscribe_video(preview)
+            frame = tello.read(preview)
+
+        Args:
+            output (OutputSpec|None): Format, size and scaler of the frames, None for
+                full size RGB.
+
+        """
+        self.video.subscribe(output)
+
+    def unsubscribe_video(self, output=None):
+        """Stop consuming frames, the last consumer stops the video stream.
+
+        Args:
+            output (OutputSpec|None): Output passed to subscribe_video().
+
+        """
+        self.video.unsubscribe(output)
+
+    def read(self, output=None):
+        """Return the last frame from camera.
+
+        Scripts that read without subscribe_video() are subscribed to the output of
+        their first call, until disconnect(); that read returns None as no frame has
+        arrived yet.
+
+        Args:
+            output (OutputSpec|None): Output subscribed to, None for full size RGB.
+
+        """
+        if not self._implicit_video and self.video.consumers == 0 and self.connected:
+            self._implicit_video = True
+            self.video.subscribe(output)
         if self.is_freeze:
-            return self.last_frame
+            return self.last_frame if output is None else self._frozen_frames.get(output)
         else:
-            return self.frame
+            return self.video.get_mailbox(output).frame
+
+    def wait_frame(self, after_seq=0, timeout=None, output=None):
+        """Wait for a frame newer than the last one handled.
+
+        Unlike read(), a consumer passing the seq it got back handles every frame once,
+        at the rate the stream delivers them. Frames only arrive after subscribe_video():
+
+            seq = 0
+            while True:
+                frame, seq, timestamp = tello.wait_frame(seq)
+
+        Args:
+            after_seq (int): Sequence number of the last frame handled, 0 for any frame.
+            timeout (float|None): Seconds to wait, None waits forever.
+            output (OutputSpec|None): Output subscribed to, None for full size RGB.
+
+        Returns:
+            tuple: (frame, seq, timestamp) with the time.time() the frame was received,
+                None on timeout.
+
+        """
+        return self.video.wait_frame(after_seq, timeout, output)
 
     def video_freeze(self, is_freeze=True):
         """Pause video output -- set is_freeze to True"""
         self.is_freeze = is_freeze
         if is_freeze:
             self.last_frame = self.frame
+            self._frozen_frames = dict((output, mailbox.frame)
+                                       for output, mailbox in list(self.video.mailboxes.items()))
 
     def _receive_thread(self):
         """Listen to responses from the Tello.
@@ -113,58 +272,32 @@ class Tello:
         while self.connected:
             try:
                 self.response, ip = self.socket.recvfrom(3000)
+                self._dispatch_response(self.response)
             except socket.error as exc:
                 print(("Caught exception socket.error : %s" % exc))
 
-    def _receive_video_thread(self):
+    def _dispatch_response(self, data):
         """
-        Listens for video streaming (raw h264) from the Tello.
+        Hand a received datagram to the oldest command waiting for a reply.
 
-        Runs as a thread, sets self.frame to the most recent frame Tello captured.
+        The Tello answers commands in the order they were sent, so replies are matched
+        first in, first out. A reply that still belongs to a command which already timed
+        out is dropped instead of being credited to the next command, see ReplyMatcher.
+        State broadcasts are never treated as replies.
 
+        :param data (bytes): Datagram received from the Tello.
         """
-        packet_data =b''
-        while self.connected:
-            try:
-                res_string, ip = self.socket_video.recvfrom(2048)
-                
-                packet_data += res_string
-                # end of frame
-                if len(res_string) != 1460:
-                    for frame in self._h264_decod(packet_data):
-                        self.frame = frame
-                    packet_data = b''
-                        
-            except socket.error as exc:
-                print(("Caught exception socket.error : %s" % exc))
-    
-    
-    def _h264_decod(self, packet_data):
-        """
-        decode raw h264 format data from Tello
-        
-        :param packet_data: raw h264 data array
-       
-        :return: a list of decoded frame
-        """
-        res_frame_list = []
-        frames = self.decoder.decode(packet_data)
-                 
-        for framedata in frames:
-            (frame, w, h, ls) = framedata
-            if frame is not None:
-                # print ('frame size %i bytes, w %i, h %i, linesize %i' % (len(frame), w, h, ls))
-                frame = np.frombuffer(frame, dtype = np.ubyte, count = len(frame))
-                frame = (frame.reshape((h, ls//3, 3)))
-                frame = frame[:, :w, :]
-                res_frame_list.append(frame)
-
-        return res_frame_list
+        if is_state_packet(data):
+            return
+        self._replies.dispatch(data)
 
     def send_command(self, command):
         """
         Send a command to the Tello and wait for a response.
 
+        Commands are handed to the scheduler, which sends them in priority order and
+        times them out. Without a running scheduler the command is sent directly.
+
         :param command: Command to send.
         :return (str): Response from Tello.
 
@@ -172,39 +305,76 @@ class Tello:
 
         print((">> send cmd: {}".format(command)))
         self.abort_flag = False
-        timer = threading.Timer(self.command_timeout, self.set_abort_flag)
-    
-        self.response = None
-        self.socket.sendto(command.encode('utf-8'), self.tello_address)
 
-        timer.start()
-        while self.response is None:
-            if self.abort_flag is True:
-                break
-        timer.cancel()
-        
-        if self.response is None:
+        if self.scheduler.running:
+            waiter = self.scheduler.submit(command)
+            waiter.wait()
+        else:
+            waiter = self._transmit(command)
+            if not waiter.wait(self.command_timeout):
+                self._expire(waiter)
+
+        if waiter.response is None:
             print('Response to command \"{}\" timed out.'.format(command))
             response = 'timeout'
         else:
-            print('Response to command \"{}\": {}'.format(command, self.response))
-            response = self.response.decode('latin-1')
-        
+            print('Response to command \"{}\": {}'.format(command, waiter.response))
+            response = waiter.response.decode('latin-1')
 
-        self.response = None
         return response
-    
+
+    def _transmit(self, command, waiter=None, hold=True):
+        """
+        Register a waiter for the command and send it to the Tello.
+
+        The waiter is queued before the datagram leaves so that a fast reply can never
+        arrive ahead of it. While a reply is still owed to a command that timed out,
+        the command is held back until that reply arrived or its window closed.
+
+        :param command (str): Command to send.
+        :param waiter (CommandWaiter|ScheduledCommand|None): Waiter to use, a new one if None.
+        :param hold (bool): Wait for the replies owed to timed out commands first.
+        :return (CommandWaiter): Waiter that receives the reply.
+        """
+        if waiter is None:
+            waiter = CommandWaiter(command)
+        self._replies.register(waiter, hold)
+        self.socket.sendto(command.encode('utf-8'), self.tello_address)
+        return waiter
+
+    def _send_only(self, command):
+        """Send a command the Tello does not answer, without waiting for anything."""
+        self.socket.sendto(command.encode('utf-8'), self.tello_address)
+
+    def _send_rc(self, command):
+        """Send an rc command fire-and-forget, through the scheduler if it runs."""
+        if self.scheduler.running:
+            self.scheduler.submit(command, expect_response=False)
+        else:
+            self._send_only(command)
+
+    def _expire(self, waiter):
+        """
+        Give up on a waiter whose reply did not arrive in time.
+
+        The reply may still show up later, so it is remembered as owed for another
+        command_timeout seconds and dropped when it arrives. The next command waits
+        until then.
+
+        :param waiter (CommandWaiter): Waiter that timed out.
+        """
+        self._replies.expire(waiter, self.command_timeout)
+
     def set_abort_flag(self):
         """
-        Sets self.abort_flag to True.
+        Sets self.abort_flag to True and releases every command still waiting for a reply.
 
-        Used by the timer in Tello.send_command() to indicate to that a response
-        
-        timeout has occurred.
+        Used by Tello.disconnect() so that no caller stays blocked on a closed socket.
 
         """
 
         self.abort_flag = True
+        self._replies.cancel_all()
 
     def takeoff(self, delay=0):
         """
@@ -292,6 +462,18 @@ class Tello:
         """
         return self.response
 
+    def get_state(self):
+        """Returns the latest state broadcast by the Tello.
+
+        Returns:
+            numpy.void: STATE_DTYPE record, fields are read like state['bat'], None
+                before the first state.
+
+        """
+        if self.telemetry is None:
+            return None
+        return self.telemetry.latest
+
     def get_sdk_version(self):
         """Returns Tello SDK version.
 
@@ -299,13 +481,7 @@ class Tello:
             float: Version of SDK.
 
         """
-        sdk = self.send_command('sdk?')
-        try:
-            sdk = sdk[:0] + '.' + sdk[1:]
-            sdk = float(sdk)
-        except:
-            pass
-        return sdk
+        return parse_sdk_version(self.send_command('sdk?'))
 
     def get_height(self):
         """Returns height(dm) of tello.
@@ -389,6 +565,16 @@ class Tello:
         time.sleep(delay)
         return resp
 
+    def emergency(self):
+        """Stops all motors immediately.
+
+        Returns:
+            str: Response from Tello, 'OK' or 'FALSE'.
+
+        """
+
+        return self.send_command('emergency')
+
     def move(self, direction, distance, delay = 0):
         """Moves in a direction for a distance.
 
@@ -411,23 +597,45 @@ class Tello:
     def move_rc(self, lr, fb, ud, yaw):
         """Move drone according to 4 input channels
 
+        The Tello does not answer rc commands, so nothing is waited for. While the
+        rc stream is running this only replaces its setpoint, otherwise the command
+        is sent once.
+
         Args:
             lr (int): left/right (-100 - 100)
             fb (int): forward/backward (100 - -100)
             ud (int): up/down (100 - -100)
             yaw (int): rotation (-100 - 100)
 
+        """
+
+        if self.rc_stream is not None and self.rc_stream.running:
+            self.rc_stream.update(lr, fb, ud, yaw)
+        else:
+            self._send_rc('rc %d %d %d %d' % (lr, fb, ud, yaw))
+
+    def start_rc_stream(self, rate=20.0):
+        """Start sending the latest rc setpoint at a fixed rate.
+
+        After this, move_rc() only updates the setpoint. See rc_stream.RCStreamer.
+
+        Args:
+            rate (float): Setpoints sent per second.
+
         Returns:
-            str: Response from Tello, 'OK' or 'FALSE'.
+            RCStreamer: The running stream, its stats() report the achieved rate and jitter.
 
         """
 
-        lr = str(lr)
-        fb = str(fb)
-        ud = str(ud)
-        yaw = str(yaw)
+        self.stop_rc_stream()
+        self.rc_stream = RCStreamer(self._send_rc, rate=rate)
+        self.rc_stream.start()
+        return self.rc_stream
 
-        return self.send_command('rc %s %s %s %s' % (lr, fb, ud, yaw))
+    def stop_rc_stream(self):
+        """Stop the rc stream started by start_rc_stream()."""
+        if self.rc_stream is not None:
+            self.rc_stream.stop()
 
 
     def move_backward(self, distance, delay=0):
@@ -0,0 +1,811 @@
+import collections
+import socket
+import threading
+import time
+import weakref
+import numpy as np
+
+
+class OutputSpec(collections.namedtuple('OutputSpec', ['format', 'size', 'scaler'])):
+    """What a frame consumer wants the decoder to convert frames into.
+
+    format is 'rgb24', 'bgr24' (for OpenCV), 'gray8' or 'yuv420p', size a (width,
+    height) tuple or None for the size of the stream, where either may be 0 to keep
+    the aspect ratio, and scaler one of 'fast_bilinear', 'bilinear', 'bicubic', 'area'
+    or 'point'. Conversion and scaling are a single pass in the decoder.
+    """
+    __slots__ = ()
+
+    def __new__(cls, format='rgb24', size=None, scaler='bilinear'):
+        return super().__new__(cls, format, tuple(size) if size else None, scaler)
+
+    def decoder_output(self, allocator=None):
+        """Return the tuple libh264decoder.H264Decoder.set_outputs() expects."""
+        width, height = self.size or (0, 0)
+        return (self.format, width, height, self.scaler, allocator)
+
+
+RGB24 = OutputSpec()
+
+
+def frame_shape(format, w, h):
+    """
+    Shape of the numpy array holding a w x h frame in format.
+
+    :param format (str): Pixel format, see OutputSpec.
+    :return (tuple): (h, w, 3) for packed RGB or BGR, (h, w) for grayscale, and
+        (h * 3 // 2, w) for yuv420p, the I420 layout cv2.COLOR_YUV2RGB_I420 takes,
+        where the U and V planes follow the Y plane.
+    """
+    if format == 'gray8':
+        return (h, w)
+    if format == 'yuv420p':
+        return (h * 3 // 2, w)
+    return (h, w, 3)
+
+
+def frame_array(frame, w, h, ls, format='rgb24'):
+    """
+    Wrap a frame returned by the decoder in a numpy array without copying it.
+
+    :param frame: Frame buffer, bytes or an array of a FramePool.
+    :param w (int): Width in pixels.
+    :param h (int): Height in pixels.
+    :param ls (int): Bytes per row of the first plane.
+    :param format (str): Pixel format, see OutputSpec.
+    :return (numpy.ndarray): Array of frame_shape(), flat for odd sized yuv420p.
+    """
+    shape = frame_shape(format, w, h)
+    if isinstance(frame, np.ndarray) and frame.shape == shape:
+        # converted straight into an array of a FramePool
+        return frame
+    frame = np.frombuffer(frame, dtype=np.ubyte, count=len(frame))
+    if format == 'yuv420p':
+        # planes are packed, chroma planes are rounded up for odd sizes
+        return frame.reshape(shape) if frame.size == w * h * 3 // 2 else frame
+    if format == 'gray8':
+        return frame.reshape((h, ls))[:, :w]
+    return frame.reshape((h, ls//3, 3))[:, :w, :]
+
+
+def decode_frames(decoder, packet_data, format='rgb24'):
+    """
+    decode raw h264 format data from Tello
+
+    :param decoder (libh264decoder.H264Decoder): Decoder holding the stream state.
+    :param packet_data: raw h264 data, bytes or any buffer such as a memoryview
+    :param format (str): Pixel format the decoder outputs, see OutputSpec.
+
+    :return: a list of decoded frame
+    """
+    res_frame_list = []
+    for (frame, w, h, ls) in decoder.decode(packet_data):
+        if frame is not None:
+            res_frame_list.append(frame_array(frame, w, h, ls, format))
+    return res_frame_list
+
+
+class FramePool:
+    """Recycles the buffers the decoder converts frames into.
+
+    Set as the frame allocator of a libh264decoder.H264Decoder, the pool hands the
+    decoder a C contiguous uint8 array of frame_shape() for every frame and the
+    decoder writes the pixels straight into it, so the frame is neither allocated as a
+    bytes object nor copied into numpy.
+
+    Every frame is lent out as a new array over a pooled buffer, and every view of
+    the frame refers back to that array. The pool keeps only a weak reference to it,
+    so a buffer is reused once the frame and every view of it are gone, and consumers
+    may keep any frame as long as they like.
+    """
+
+    def __init__(self, format='rgb24', size=8):
+        """
+        :param format (str): Pixel format the decoder outputs, see OutputSpec.
+        :param size (int): Buffers kept for reuse, frames held by consumers beyond
+            that are allocated and dropped as before.
+        """
+        self.format = format
+        self.size = size
+        self.allocated = 0  # buffers allocated, stays at size once warmed up
+        self._buffers = []  # [bytearray, weak reference to the array lent out over it]
+
+    def __call__(self, w, h, size):
+        """
+        Return a free array for a w x h frame of size bytes, called by the decoder.
+        """
+        shape = frame_shape(self.format, w, h)
+        if size != np.prod(shape):
+            # padded rows or odd chroma planes, frame_array handles them like bytes
+            shape = (size,)
+        for lease in self._buffers:
+            if len(lease[0]) == size and lease[1]() is None:
+                return self._lend(lease, shape)
+
+        lease = [bytearray(size), None]
+        self.allocated += 1
+        if len(self._buffers) < self.size:
+            self._buffers.append(lease)
+        else:
+            # replace a free buffer of a former frame size, if any
+            for i, old in enumerate(self._buffers):
+                if len(old[0]) != size and old[1]() is None:
+                    self._buffers[i] = lease
+                    break
+        return self._lend(lease, shape)
+
+    @staticmethod
+    def _lend(lease, shape):
+        # views of the frame, e.g. reshaped or sliced, keep owner alive as their base
+        owner = np.frombuffer(lease[0], dtype=np.ubyte)
+        lease[1] = weakref.ref(owner)
+        return owner.reshape(shape)
+
+
+_START_CODE = b'\x00\x00\x01'
+# NAL unit types of slices, and of the units that end the access unit before them,
+# see H.264 section 7.4.1.2.3: SEI, sequence and picture parameter set, delimiter.
+_NAL_SLICE = 1
+_NAL_IDR_SLICE = 5
+_NAL_SPS = 7
+_NAL_AU_START = (6, 7, 8, 9)
+
+
+class PacketAssembler:
+    """Splits video datagrams into H.264 access units in one reusable buffer.
+
+    Datagrams are received with recv_into straight behind the previous one, so a
+    frame is never copied while it is assembled. The buffer only grows, doubling
+    when a frame does not fit, and is reused for every following frame.
+
+    Datagrams are scanned for Annex B start codes. An access unit ends where the
+    next one begins: at an SEI, parameter set or delimiter NAL unit, or at a slice
+    starting a new picture (first_mb_in_slice 0), once the current one has a slice.
+    Without end_packet_size every byte is scanned, so this does not depend on how
+    the stream was cut into packets.
+
+    The Tello cuts every frame into packets of 1460 bytes, the last one shorter. If
+    end_packet_size is set, the stream is taken to be cut like that: a short packet
+    completes the access unit right away rather than when the next one starts,
+    which saves a frame interval of latency, and since every access unit starts a
+    new packet, a packet is only scanned up to its first slice, and only if it
+    starts a NAL unit. Scanning is the costly part of receiving, about 1.3 ns a
+    byte, so the slice data is appended without looking at it. A frame whose size is a multiple of the
+    packet size, or whose last packet was lost, is still not merged with the next
+    one, as that one starts its first packet with a start code.
+    """
+
+    def __init__(self, capacity=64 * 1024, packet_size=2048, end_packet_size=None):
+        """
+        :param capacity (int): Initial buffer size in bytes.
+        :param packet_size (int): Largest datagram accepted.
+        :param end_packet_size (int|None): Size of the packets a frame is cut into, a
+            shorter one ends the access unit. None to rely on start codes only.
+        """
+        self.packet_size = packet_size
+        self.end_packet_size = end_packet_size
+        self.size = 0  # bytes buffered, the current access unit and what follows it
+        self._buffer = bytearray(capacity)
+        self._view = memoryview(self._buffer)
+        self._access_unit = None  # view handed out by the last receive()
+        self._scanned = 0  # start codes before this offset were classified
+        self._has_slice = False  # the current access unit contains a slice
+        self._ended = False  # the last datagram was shorter than end_packet_size
+        self._keyframe = False  # the current access unit has an IDR slice or SPS
+        self.keyframe = False  # the access unit handed out last can be decoded on its own
+        self._spare = collections.deque()  # buffers given back with recycle()
+
+    def _grow(self):
+        # a bytearray cannot be resized while a view on it exists
+        self._view.release()
+        self._buffer.extend(bytes(len(self._buffer)))
+        self._view = memoryview(self._buffer)
+
+    def _start_next(self):
+        """Move the bytes after the access unit handed out last to the front."""
+        end = len(self._access_unit)
+        self._access_unit.release()
+        self._access_unit = None
+        # at most a packet, the start of the next access unit
+        tail = bytes(self._view[end:self.size])
+        self._buffer[:len(tail)] = tail
+        self.size = len(tail)
+        self._scanned = 0
+        self._has_slice = False
+        self._keyframe = False
+
+    def take(self):
+        """
+        Take the access unit handed out last out of the assembler.
+
+        Assembling goes on in another buffer, a recycled one if any, so the access
+        unit stays valid without being copied, e.g. while it waits for the decoder.
+
+        :return (memoryview): The access unit, to be given back with recycle() once done.
+        """
+        access_unit = self._access_unit
+        self._access_unit = None
+        capacity = len(self._buffer)
+        buffer = self._spare.pop() if self._spare else None
+        if buffer is None or len(buffer) < capacity:
+            buffer = bytearray(capacity)
+        # at most a packet, the start of the next access unit
+        tail = self._view[len(access_unit):self.size]
+        buffer[:len(tail)] = tail
+        self._buffer = buffer
+        self._view = memoryview(buffer)
+        self.size = len(tail)
+        self._scanned = 0
+        self._has_slice = False
+        self._keyframe = False
+        return access_unit
+
+    def recycle(self, access_unit):
+        """
+        Give the buffer of an access unit from take() back for reuse.
+
+        May be called from any thread. Only the view passed in is released: slices or
+        other views of the access unit still point into the buffer, which the next
+        access units overwrite, so none of them may be used after recycle().
+
+        :param access_unit (memoryview): Access unit returned by take().
+        """
+        buffer = access_unit.obj
+        access_unit.release()
+        self._spare.append(buffer)
+
+    def _find_end(self):
+        """Return the offset where the next access unit starts, None if not yet seen."""
+        buffer = self._buffer
+        position = self._scanned
+        while True:
+            start = buffer.find(_START_CODE, position, self.size)
+            if start < 0:
+                # a start code may be split across datagrams
+                self._scanned = max(position, self.size - 2)
+                return None
+            header = start + 3
+            if header + 1 >= self.size:
+                # classify once the NAL header and first slice byte arrived
+                self._scanned = start
+                return None
+
+            nal_type = buffer[header] & 0x1f
+            is_slice = nal_type in (_NAL_SLICE, _NAL_IDR_SLICE)
+            if is_slice:
+                # first_mb_in_slice is 0, coded as a single 1 bit, on the first slice of a picture
+                begins_unit = self._has_slice and buffer[header + 1] & 0x80
+            else:
+                begins_unit = self._has_slice and nal_type in _NAL_AU_START
+
+            if begins_unit:
+                self._scanned = start
+                # include the leading zero of a four byte start code
+                return start - 1 if start > 0 and buffer[start - 1] == 0 else start
+            self._has_slice = self._has_slice or is_slice
+            self._keyframe = self._keyframe or nal_type in (_NAL_IDR_SLICE, _NAL_SPS)
+            if is_slice and self.end_packet_size is not None:
+                # cut like the Tello, the next access unit starts a packet
+                self._scanned = self.size - 2
+                return None
+            position = header
+
+    def receive(self, sock):
+        """
+        Receive one datagram and append it to the current access unit.
+
+        If the last datagram both began a new access unit and ended it, that access
+        unit is returned without receiving.
+
+        :param sock (socket.socket): Video socket.
+        :return (memoryview|None): The completed access unit if one ended, else None.
+            The view is only valid until the next call.
+        """
+        if self._access_unit is not None:
+            self._start_next()
+        if self._ended:
+            return self._split()
+        size = self.size
+        if len(self._buffer) - size < self.packet_size:
+            self._grow()
+        return self._append(size, sock.recv_into(self._view[size:size + self.packet_size]))
+
+    @property
+    def pending(self):
+        """True if the last datagram completed an access unit not handed out yet."""
+        return self._ended
+
+    def feed(self, data):
+        """
+        Append a datagram received by the caller, e.g. from a socket shared by several
+        streams, like receive() does with the datagrams it receives.
+
+        While pending is true, call feed(None) until it is not, before feeding the
+        next datagram.
+
+        :param data (bytes|None): Datagram, None to only hand out a pending access unit.
+        :return (memoryview|None): The completed access unit if one ended, else None.
+            The view is only valid until the next call.
+        """
+        if self._access_unit is not None:
+            self._start_next()
+        if data is None:
+            return self._split() if self._ended else None
+        size = self.size
+        if len(self._buffer) - size < self.packet_size:
+            self._grow()
+        self._view[size:size + len(data)] = data
+        return self._append(size, len(data))
+
+    def _append(self, size, received):
+        """Account for a datagram of received bytes put at size, see receive()."""
+        self.size = end = size + received
+        if self.end_packet_size is not None:
+            ended = received < self.end_packet_size
+            # nothing left to classify and no start code at, or across, the packet start
+            if self._buffer.find(_START_CODE, self._scanned, min(end, size + 4)) < 0:
+                self._scanned = end - 2
+                if ended and self._has_slice:
+                    return self._hand_out(end)
+                return None
+            self._ended = ended
+        return self._split()
+
+    def _split(self):
+        """Hand out the current access unit if it ended, else return None."""
+        end = self._find_end()
+        if end is None and self._ended and self._has_slice:
+            end = self.size
+        if end is None:
+            self._ended = False
+            return None
+        return self._hand_out(end)
+
+    def _hand_out(self, end):
+        """Hand out the buffer up to end as the completed access unit."""
+        if end == self.size:
+            self._ended = False
+        self._access_unit = self._view[:end]
+        self.keyframe = self._keyframe
+        return self._access_unit
+
+
+class FrameMailbox:
+    """Single slot holding the newest frame with its sequence number and capture time.
+
+    The slot is replaced as a whole, so readers get a consistent (frame, seq,
+    timestamp) without a lock. Consumers that must handle every frame once block in
+    wait() for a sequence number newer than the last one they handled.
+    """
+
+    def __init__(self):
+        self._slot = (None, 0, None)  # (frame, seq, timestamp)
+        self._cond = threading.Condition()
+
+    @property
+    def frame(self):
+        return self._slot[0]
+
+    @property
+    def seq(self):
+        """Sequence number of the newest frame, 0 before the first one."""
+        return self._slot[1]
+
+    def get(self):
+        """Return the newest (frame, seq, timestamp), frame is None before the first one."""
+        return self._slot
+
+    def put(self, frame, timestamp):
+        """
+        Replace the frame and wake up every waiting consumer.
+
+        :param frame (numpy.ndarray): Decoded frame.
+        :param timestamp (float): time.time() its access unit was received.
+        """
+        with self._cond:
+            self._slot = (frame, self._slot[1] + 1, timestamp)
+            self._cond.notify_all()
+
+    def clear(self):
+        """Empty the slot, sequence numbers keep counting."""
+        with self._cond:
+            self._slot = (None, self._slot[1], None)
+
+    def wait(self, after_seq=0, timeout=None):
+        """
+        Wait for a frame newer than after_seq.
+
+        :param after_seq (int): Sequence number of the last frame handled, 0 for any frame.
+        :param timeout (float|None): Seconds to wait, None waits forever.
+        :return (tuple|None): (frame, seq, timestamp) of the newest frame, None on timeout.
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._slot[1] > after_seq and
+                                       self._slot[0] is not None, timeout):
+                return None
+            return self._slot
+
+
+class VideoStream:
+    """Receives and decodes the Tello video stream while anyone consumes frames.
+
+    Consumers call subscribe() before reading frames and unsubscribe() when done.
+    The first subscription creates the decoder, binds the video port, starts the
+    receive thread and sends streamon. When the last consumer unsubscribes the
+    Tello is sent streamoff and the socket, threads and decoder are released, so
+    command-only missions cost no decoding time and no video bandwidth.
+
+    Each consumer names the OutputSpec it wants frames in, RGB24 by default. Every
+    frame is decoded once and converted once per output consumers asked for, into
+    that output's own mailbox; outputs no one consumes cost nothing.
+
+    Receiving and decoding run on separate threads joined by a bounded queue of
+    access units, so the socket is drained while a large keyframe decodes. If the
+    decoder falls behind and the queue fills up, the queued access units are
+    dropped, and so is everything after them up to the next keyframe, since the
+    frames in between reference frames that were never decoded.
+
+    In low latency mode, for flying by the live view, the newest picture matters
+    more than every picture. The decoder outputs frames without delay, the decode
+    thread takes all queued access units at once and only converts the newest
+    frame, and once latency_backlog access units are queued they are dropped up to
+    the next keyframe. The frames left out this way are counted in skipped.
+    """
+
+    def __init__(self, tello, local_port=11111, recv_buffer=1024 * 1024, queue_size=8,
+                 thread_count=1, thread_type='slice', low_latency=False, latency_backlog=4):
+        """
+        :param tello (Tello): Drone whose stream is received.
+        :param local_port (int): Local port the Tello streams video to.
+        :param recv_buffer (int|None): SO_RCVBUF of the video socket in bytes, None
+            for the system default.
+        :param queue_size (int): Access units waiting for the decoder before dropping.
+        :param thread_count (int): Decoding threads, 0 for one per core.
+        :param thread_type (str): 'slice' to decode the slices of a frame in parallel,
+            no added latency, or 'frame' to decode consecutive frames in parallel,
+            which delays every frame by thread_count - 1 frame intervals.
+        :param low_latency (bool): Skip stale frames when the decoder falls behind. May be
+            changed at any time, the decoder flags follow when the stream next starts.
+        :param latency_backlog (int): Access units queued in low latency mode before
+            jumping to the next keyframe.
+        """
+        self.tello = tello
+        self.local_port = local_port
+        self.recv_buffer = recv_buffer
+        self.queue_size = queue_size
+        self.thread_count = thread_count
+        self.thread_type = thread_type
+        self.low_latency = low_latency
+        self.latency_backlog = latency_backlog
+        self.mailbox = FrameMailbox()  # most recent decoded RGB24 frame, empty while stopped
+        self.mailboxes = {RGB24: self.mailbox}  # mailbox of every output ever asked for
+        self.decoder = None
+        self.consumers = 0
+
+        self.received = 0  # access units received
+        self.decoded = 0  # access units decoded
+        self.dropped = 0  # access units dropped because the decoder fell behind
+        self.skipped = 0  # frames skipped for latency in low latency mode
+        self.max_depth = 0  # most access units queued at once
+
+        self._lock = threading.Lock()
+        self._stream_lock = threading.Lock()  # held while sending streamon or streamoff
+        self._streaming = False  # streamon was sent last
+        self._socket = None
+        self._threads = []
+        self._running = False
+        self._queue = collections.deque()  # (access unit, receive time) waiting for the decoder
+        self._assembler = None  # PacketAssembler of the receive thread, access units go back to it
+        self._queue_cond = threading.Condition()
+        self._skipping = False  # dropping until the next keyframe
+        self._outputs = {}  # OutputSpec: number of consumers
+        self._output_list = []  # outputs to decode, replaced as a whole on every change
+        self.access_unit_subscribers = ()  # replaced as a whole, iterated without a lock
+
+    @property
+    def running(self):
+        return self._running
+
+    @property
+    def frame(self):
+        """numpy array RGB -- most recent decoded frame, None while stopped"""
+        return self.mailbox.frame
+
+    def get_mailbox(self, output=None):
+        """
+        Return the mailbox frames in output are put into.
+
+        :param output (OutputSpec|None): Output, None for RGB24.
+        """
+        output = output or RGB24
+        with self._lock:
+            if output not in self.mailboxes:
+                self.mailboxes[output] = FrameMailbox()
+            return self.mailboxes[output]
+
+    def wait_frame(self, after_seq=0, timeout=None, output=None):
+        """See FrameMailbox.wait(), output as in get_mailbox()."""
+        return self.get_mailbox(output).wait(after_seq, timeout)
+
+    def is_subscribed(self, output=None):
+        """Return whether anyone consumes output, None for RGB24."""
+        return (output or RGB24) in self._outputs
+
+    @property
+    def depth(self):
+        """Number of access units waiting for the decoder."""
+        return len(self._queue)
+
+    def stats(self):
+        """Return the pipeline counters as a dict."""
+        return {'received': self.received, 'decoded': self.decoded, 'dropped': self.dropped,
+                'skipped': self.skipped, 'depth': self.depth, 'max_depth': self.max_depth}
+
+    def subscribe(self, output=None):
+        """
+        Register a frame consumer, starting the stream for the first one.
+
+        :param output (OutputSpec|None): Output the consumer reads, None for RGB24.
+        """
+        output = output or RGB24
+        with self._lock:
+            if output not in self.mailboxes:
+                self.mailboxes[output] = FrameMailbox()
+            self._outputs[output] = self._outputs.get(output, 0) + 1
+            self._output_list = list(self._outputs)
+            self.consumers += 1
+            started = self.consumers == 1
+            if started:
+                self._start()
+        if started:
+            self._sync_stream()
+
+    def unsubscribe(self, output=None):
+        """
+        Release a frame consumer, stopping the stream after the last one.
+
+        :param output (OutputSpec|None): Output passed to subscribe().
+        """
+        output = output or RGB24
+        with self._lock:
+            if output not in self._outputs:
+                return
+            self._outputs[output] -= 1
+            if self._outputs[output] == 0:
+                del self._outputs[output]
+                self.mailboxes[output].clear()
+            self._output_list = list(self._outputs)
+            self.consumers -= 1
+            stopped = self.consumers == 0
+            if stopped:
+                self._stop()
+        if stopped:
+            self._sync_stream()
+
+    def subscribe_access_units(self, callback):
+        """
+        Call callback(access_unit, keyframe, timestamp) on the receive thread for every
+        access unit as it was received, before decoding, e.g. to record the stream.
+
+        Counts as a consumer, so it starts the stream, but no frame is decoded for it.
+        Callbacks must return quickly, e.g. by handing the access unit to a queue.
+
+        :param callback (callable): Function taking the access unit, a memoryview
+            that is reused once decoded, so callbacks that keep it must copy it, whether
+            it is a keyframe and its time.time() of reception.
+        """
+        with self._lock:
+            self.access_unit_subscribers = self.access_unit_subscribers + (callback,)
+            self.consumers += 1
+            started = self.consumers == 1
+            if started:
+                self._start()
+        if started:
+            self._sync_stream()
+
+    def unsubscribe_access_units(self, callback):
+        """Stop calling a callback registered with subscribe_access_units()."""
+        with self._lock:
+            if callback not in self.access_unit_subscribers:
+                return
+            self.access_unit_subscribers = tuple(c for c in self.access_unit_subscribers
+                                                 if c != callback)
+            self.consumers -= 1
+            stopped = self.consumers == 0
+            if stopped:
+                self._stop()
+        if stopped:
+            self._sync_stream()
+
+    def close(self, streamoff=True):
+        """
+        Stop the stream regardless of how many consumers are left.
+
+        :param streamoff (bool): Tell the Tello to stop streaming, False if it can no
+            longer be reached.
+        """
+        with self._lock:
+            self.consumers = 0
+            self.access_unit_subscribers = ()
+            self._outputs = {}
+            self._output_list = []
+            self._stop()
+        self._sync_stream(streamoff)
+
+    def _start(self):
+        # imported here, so everything but decoding works without the extension
+        import libh264decoder
+
+        # access units are split before decoding, the parser need not wait for the next one
+        self.decoder = libh264decoder.H264Decoder(complete_frames=True,
+                                                  thread_count=self.thread_count,
+                                                  thread_type=self.thread_type,
+                                                  low_delay=self.low_latency)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.recv_buffer is not None:
+            # room for a burst of packets while the receive thread waits for the GIL
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.recv_buffer)
+        self._socket.bind(("0.0.0.0", self.local_port))
+        # wake up regularly so the thread notices it was stopped
+        self._socket.settimeout(0.5)
+
+        # listen before asking for the stream, so the first keyframe is not missed
+        self._running = True
+        self._skipping = False
+        self._queue.clear()
+        self._assembler = PacketAssembler(end_packet_size=1460)
+        for target in (self._receive_thread, self._decode_thread):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _stop(self):
+        if not self._running:
+            return
+        with self._queue_cond:
+            self._running = False
+            self._queue.clear()
+            self._queue_cond.notify_all()
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join()
+        self._threads = []
+        self._socket.close()
+        self._socket = None
+        self.decoder = None
+        for mailbox in list(self.mailboxes.values()):
+            mailbox.clear()
+
+    def _sync_stream(self, streamoff=True):
+        """
+        Send streamon or streamoff until the Tello streams exactly while the stream runs.
+
+        Called after _start() or _stop() without holding _lock, as a command may take
+        its full timeout. Concurrent callers are serialized, so the commands reach the
+        Tello in the order the stream was started and stopped.
+
+        :param streamoff (bool): Tell the Tello to stop streaming, False if it can no
+            longer be reached.
+        """
+        with self._stream_lock:
+            while self._streaming != self._running:
+                if self._running:
+                    response = self.tello.send_command('streamon')
+                    if response.strip() != 'ok':
+                        print("[INFO] streamon was answered with: {}".format(response))
+                elif streamoff and self.tello.connected:
+                    self.tello.send_command('streamoff')
+                self._streaming = not self._streaming
+
+    def _receive_thread(self):
+        """
+        Listens for video streaming (raw h264) from the Tello.
+
+        Runs as a thread, queues every complete access unit for the decode thread.
+
+        """
+        assembler = self._assembler
+        while self._running:
+            try:
+                access_unit = assembler.receive(self._socket)
+            except socket.timeout:
+                continue
+            except socket.error as exc:
+                if self._running:
+                    print(("Caught exception socket.error : %s" % exc))
+                continue
+
+            if access_unit is not None:
+                # handed over without a copy, its buffer comes back once decoded
+                access_unit = assembler.take()
+                timestamp = time.time()
+                for callback in self.access_unit_subscribers:
+                    callback(access_unit, assembler.keyframe, timestamp)
+                if not self._enqueue(access_unit, assembler.keyframe, timestamp):
+                    assembler.recycle(access_unit)
+
+    def _enqueue(self, access_unit, keyframe, timestamp):
+        """Queue an access unit for the decode thread, return whether it was queued."""
+        with self._queue_cond:
+            self.received += 1
+            if not self._output_list:
+                # no one wants frames, decoding picks up at the next keyframe if they do
+                self._skipping = True
+                return False
+            if self._skipping:
+                if not keyframe:
+                    self._discard(1)
+                    return False
+                self._skipping = False
+
+            limit = self.latency_backlog if self.low_latency else self.queue_size
+            if len(self._queue) >= limit:
+                # decoder fell behind, queued frames are only useful up to the next keyframe
+                self._discard(len(self._queue))
+                for queued, _ in self._queue:
+                    self._assembler.recycle(queued)
+                self._queue.clear()
+                if not keyframe:
+                    self._discard(1)
+                    self._skipping = True
+                    return False
+
+            self._queue.append((access_unit, timestamp))
+            self.max_depth = max(self.max_depth, len(self._queue))
+            self._queue_cond.notify()
+            return True
+
+    def _discard(self, count):
+        # called with _queue_cond held
+        # low latency mode drops on purpose, otherwise the decoder is just too slow
+        if self.low_latency:
+            self.skipped += count
+        else:
+            self.dropped += count
+
+    def _decode_thread(self):
+        """
+        Decodes the queued access units.
+
+        Runs as a thread, puts the most recent frame Tello captured into the mailbox
+        of every output.
+
+        """
+        outputs = None
+        pools = {}  # FramePool of every output, kept while outputs come and go
+        while True:
+            with self._queue_cond:
+                while self._running and not self._queue:
+                    self._queue_cond.wait()
+                if not self._running:
+                    return
+                if self.low_latency:
+                    batch = list(self._queue)
+                    self._queue.clear()
+                else:
+                    batch = [self._queue.popleft()]
+
+            for access_unit, timestamp in batch[:-1]:
+                # keeps the reference frames up to date, converting is left for the newest
+                skipped = self.decoder.skip_frames(access_unit)
+                with self._queue_cond:
+                    # the receive thread counts skipped access units under the same lock
+                    self.skipped += skipped
+                self.decoded += 1
+                # the decoder copies what it keeps, the buffer can be reused right away
+                self._assembler.recycle(access_unit)
+            access_unit, timestamp = batch[-1]
+
+            if outputs is not self._output_list:
+                # consumers changed, the decoder is only reconfigured between frames
+                outputs = self._output_list
+                if outputs:
+                    self.decoder.set_outputs(
+                        [output.decoder_output(pools.setdefault(output, FramePool(output.format)))
+                         for output in outputs])
+            for frames in self.decoder.decode_outputs(access_unit):
+                for output, (frame, w, h, ls) in zip(outputs, frames):
+                    self.mailboxes[output].put(frame_array(frame, w, h, ls, output.format), timestamp)
+            self._assembler.recycle(access_unit)
+            self.decoded += 1